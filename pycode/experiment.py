@@ -7,11 +7,29 @@ Here are contained the main structures that are used to contain the data
 recorded during the experiments.
 """
 
+from collections import OrderedDict
+from functools import partial
 from pathlib import Path
-from typing import Any, Dict, List, Optional, Tuple, TypeVar
+from collections.abc import MutableMapping, Sequence as SequenceABC
+from typing import (Any, Callable, Dict, Iterator, List, Optional, Sequence,
+                    Tuple, TypeVar, Union)
 
 import numpy as np  # type: ignore
 
+from .utils import IntervalSet
+
+
+def read_only(array: Optional[np.ndarray]) -> Optional[np.ndarray]:
+    """
+    Mark an array as read-only, so that it can be shared between structures
+    (see Phase.replace) and its in place changes fail instead of being lost
+    when it could be dropped (see LazyPhases).
+    @returns ARRAY
+    """
+    if isinstance(array, np.ndarray) and array.flags.writeable:
+        array.flags.writeable = False
+    return array
+
 
 class Signal:
     """
@@ -27,6 +45,95 @@ class Signal:
         self.sampling_frequency = sampling_frequency
         self.path = path
 
+    def nbytes(self) -> int:
+        return self.data.nbytes
+
+    def share(self) -> 'Signal':
+        """@returns a new Signal referencing the same, read-only, data"""
+        return Signal(read_only(self.data), self.sampling_frequency,
+                      self.path)
+
+
+class DigitalSignal(Signal):
+    """
+    A digital (on/off) signal, i.e. the stimulation one, stored as the sample
+    indices of its transitions: the signal is ON (its value is HIGH) in
+    [EDGES[2k], EDGES[2k + 1]) and 0 elsewhere. A signal starting ON has
+    EDGES[0] == 0, one ending ON has EDGES[-1] == LENGTH.
+    The dense samples are built at each access of DATA, as a column array.
+    """
+
+    def __init__(self, edges: np.ndarray, length: int,
+                 sampling_frequency: float, high: Any = 1,
+                 path: Optional[Path] = None):
+        """
+        @param [in] edges: the sorted int64 sample indices of the transitions
+        @param [in] length: the number of samples of the signal
+        @param [in] sampling_frequency
+        @param [in] high: the value of the ON samples
+        @param [in] path: of the data in the filesystem
+        """
+        assert len(edges) % 2 == 0, "edges should be couples of on/off"
+        self.edges = np.asarray(edges, dtype=np.int64)
+        self.length = int(length)
+        self.sampling_frequency = sampling_frequency
+        self.high = high
+        self.path = path
+
+    @classmethod
+    def from_dense(cls, data: np.ndarray, sampling_frequency: float,
+                   path: Optional[Path] = None) -> 'DigitalSignal':
+        """
+        Build the DigitalSignal of a dense signal, whose samples greater than
+        its minimum are ON.
+        """
+        data = np.ravel(data)
+        if len(data) == 0:
+            return cls(np.zeros(0, dtype=np.int64), 0, sampling_frequency)
+        low = data.min()
+        on = data > low
+        edges = np.flatnonzero(np.diff(on.view(np.int8), prepend=0,
+                                       append=0))
+        high = data[on].max() - low if len(edges) > 0 else 1
+        return cls(edges, len(data), sampling_frequency, high, path)
+
+    @property
+    def starts(self) -> np.ndarray:
+        """@returns the first sample of each ON interval"""
+        return self.edges[0::2]
+
+    @property
+    def ends(self) -> np.ndarray:
+        """@returns the first sample after each ON interval"""
+        return self.edges[1::2]
+
+    def intervals(self, in_seconds: bool = True) -> IntervalSet:
+        """
+        @param [in] in_seconds: if False the boundaries are sample indices
+        @returns the ON intervals, from their first sample to the first one
+                 after them like utils.intervals_boundaries
+        """
+        if in_seconds:
+            return IntervalSet(self.starts / self.sampling_frequency,
+                               self.ends / self.sampling_frequency)
+        return IntervalSet(self.starts, self.ends)
+
+    @property
+    def data(self) -> np.ndarray:
+        delta = np.zeros(self.length + 1, dtype=np.int8)
+        delta[self.starts] = 1
+        delta[self.ends] -= 1
+        on = np.cumsum(delta[:-1], dtype=np.int8).astype(bool)
+        high = np.asarray(self.high)
+        return np.where(on, high, np.zeros(1, dtype=high.dtype))[:, None]
+
+    def nbytes(self) -> int:
+        return self.edges.nbytes
+
+    def share(self) -> 'DigitalSignal':
+        return DigitalSignal(read_only(self.edges), self.length,
+                             self.sampling_frequency, self.high, self.path)
+
 
 _T = TypeVar('_T', bound='PhaseInfo')
 
@@ -71,6 +178,298 @@ class PhaseInfo:
         self.sampling_frequency = sampling_frequency
 
 
+class SpikeTrains:
+    """
+    The spike trains of the electrodes of a phase in compressed rows: the
+    sample indices of the spikes of all the electrodes are in a single sorted
+    (for each electrode) buffer and the ones of the i-th electrode, whose
+    label is LABELS[i], are INDICES[OFFSETS[i]:OFFSETS[i + 1]]. The optional
+    amplitudes buffer is aligned to the indices one.
+    ON_CHANGE, if set, is called after the buffers are rebuilt by set_times
+    or remove (i.e. to pin a phase of a LazyPhases).
+    """
+
+    on_change: Optional[Callable[[], None]] = None
+
+    def __init__(self, indices: np.ndarray, offsets: np.ndarray,
+                 labels: np.ndarray, sampling_frequency: float,
+                 amplitudes: Optional[np.ndarray] = None):
+        """
+        @param [in] indices: the concatenated sample indices (int64 or int32)
+        @param [in] offsets: len(LABELS) + 1 boundaries in INDICES
+        @param [in] labels: the electrodes labels
+        @param [in] sampling_frequency: to convert the indices in seconds
+        @param [in] amplitudes: the amplitude of each spike, if available
+        """
+        assert len(offsets) == len(labels) + 1, \
+            "offsets should have one more element than labels"
+        assert amplitudes is None or len(amplitudes) == len(indices), \
+            "amplitudes should be aligned to indices"
+        self.sampling_frequency = sampling_frequency
+        self._assign(indices, offsets, labels, amplitudes)
+
+    def _assign(self, indices: np.ndarray, offsets: np.ndarray,
+                labels: np.ndarray, amplitudes: Optional[np.ndarray]):
+        self.indices = indices
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.labels = np.asarray(labels)
+        self.amplitudes = amplitudes
+        self._positions = {label: i for i, label
+                           in enumerate(self.labels.tolist())}
+
+    @classmethod
+    def from_trains(cls, labels: Sequence[int],
+                    trains: Sequence[np.ndarray],
+                    sampling_frequency: float,
+                    amplitudes: Optional[Sequence[np.ndarray]] = None,
+                    dtype: np.dtype = np.int64) -> 'SpikeTrains':
+        """
+        Build the SpikeTrains from the sample indices of each electrode.
+        @param [in] labels: the electrodes labels
+        @param [in] trains: the sample indices of the spikes of each electrode
+        @param [in] sampling_frequency
+        @param [in] amplitudes: the amplitudes of the spikes of each electrode
+        @param [in] dtype: np.int64 or np.int32
+        """
+        offsets = np.zeros(len(trains) + 1, dtype=np.int64)
+        np.cumsum([len(train) for train in trains], out=offsets[1:])
+        indices = np.empty(offsets[-1], dtype=dtype)
+        amplitudes_buffer = None if amplitudes is None \
+            else np.empty(offsets[-1], dtype=np.float32)
+        for i, train in enumerate(trains):
+            order = np.argsort(train, kind='stable')
+            indices[offsets[i]:offsets[i + 1]] = np.asarray(train)[order]
+            if amplitudes_buffer is not None:
+                amplitudes_buffer[offsets[i]:offsets[i + 1]] = \
+                    np.asarray(amplitudes[i])[order]
+        return cls(indices, offsets, np.asarray(labels), sampling_frequency,
+                   amplitudes_buffer)
+
+    @classmethod
+    def from_dict(cls, peaks: Dict[int, np.ndarray],
+                  sampling_frequency: float,
+                  amplitudes: Optional[Dict[int, np.ndarray]] = None,
+                  dtype: np.dtype = np.int64) -> 'SpikeTrains':
+        """
+        Build the SpikeTrains from a map [electrode label -> spikes times in
+        seconds], the times are rounded to the nearest sample.
+        """
+        labels = list(peaks.keys())
+        trains = [np.rint(np.asarray(peaks[label], dtype=np.float64) *
+                          sampling_frequency) for label in labels]
+        return cls.from_trains(
+            labels, trains, sampling_frequency,
+            None if amplitudes is None
+            else [amplitudes[label] for label in labels], dtype)
+
+    def __len__(self) -> int:
+        return len(self.labels)
+
+    def __contains__(self, label: int) -> bool:
+        return label in self._positions
+
+    def n_spikes(self) -> int:
+        return len(self.indices)
+
+    def nbytes(self) -> int:
+        """@returns the size in bytes of the buffers"""
+        return self.indices.nbytes + self.offsets.nbytes + \
+            (self.amplitudes.nbytes if self.amplitudes is not None else 0)
+
+    def position(self, label: int) -> int:
+        """@returns the row of the electrode LABEL"""
+        return self._positions[label]
+
+    def samples(self, label: int) -> np.ndarray:
+        """@returns a view of the sample indices of the spikes of LABEL"""
+        i = self._positions[label]
+        return self.indices[self.offsets[i]:self.offsets[i + 1]]
+
+    def times(self, label: int) -> np.ndarray:
+        """@returns the times in seconds of the spikes of LABEL"""
+        return self.samples(label) / self.sampling_frequency
+
+    def spikes_amplitudes(self, label: int) -> Optional[np.ndarray]:
+        """@returns a view of the amplitudes of the spikes of LABEL"""
+        if self.amplitudes is None:
+            return None
+        i = self._positions[label]
+        return self.amplitudes[self.offsets[i]:self.offsets[i + 1]]
+
+    def _window_mask(self, t_start: Optional[float],
+                     t_stop: Optional[float]) -> np.ndarray:
+        times = self.indices / self.sampling_frequency
+        mask = np.ones(len(times), dtype=bool)
+        if t_start is not None:
+            mask &= times >= t_start
+        if t_stop is not None:
+            mask &= times <= t_stop
+        return mask
+
+    def counts(self, t_start: Optional[float] = None,
+               t_stop: Optional[float] = None) -> np.ndarray:
+        """
+        Count the spikes of every electrode in [T_START, T_STOP] seconds.
+        @returns the counts in the order of LABELS
+        """
+        if t_start is None and t_stop is None:
+            return np.diff(self.offsets)
+        return self.count_matrix(
+            [-np.inf if t_start is None else t_start],
+            [np.inf if t_stop is None else t_stop])[:, 0]
+
+    def count_matrix(self, starts: np.ndarray, stops: np.ndarray,
+                     closed: bool = True) -> np.ndarray:
+        """
+        Count the spikes of every electrode in many intervals at once, with a
+        binary search of the boundaries of all the intervals in each train.
+        @param [in] starts: the beginning of each interval in seconds
+        @param [in] stops: the end of each interval in seconds
+        @param [in] closed: if the ends are included in the intervals, if
+                            False they are [START, STOP) (i.e. for contiguous
+                            bins)
+        @returns a (len(LABELS) x len(STARTS)) matrix of counts
+        """
+        starts = np.asarray(starts, dtype=np.float64).ravel()
+        stops = np.asarray(stops, dtype=np.float64).ravel()
+        assert starts.shape == stops.shape, \
+            "starts and stops should have the same length"
+        # the searches are faster with sorted keys
+        starts_order = np.argsort(starts, kind='stable')
+        stops_order = np.argsort(stops, kind='stable')
+        sorted_starts = starts[starts_order]
+        sorted_stops = stops[stops_order]
+        times = self.indices / self.sampling_frequency
+        counts = np.empty((len(self), len(starts)), dtype=np.int64)
+        for i in range(len(self)):
+            train = times[self.offsets[i]:self.offsets[i + 1]]
+            counts[i, stops_order] = np.searchsorted(
+                train, sorted_stops, 'right' if closed else 'left')
+            counts[i, starts_order] -= np.searchsorted(train, sorted_starts,
+                                                       'left')
+        return np.maximum(counts, 0, out=counts)
+
+    def window(self, t_start: Optional[float] = None,
+               t_stop: Optional[float] = None) -> 'SpikeTrains':
+        """
+        @returns new SpikeTrains with only the spikes in [T_START, T_STOP]
+                 seconds, the indices are left untouched
+        """
+        return self.select(self._window_mask(t_start, t_stop))
+
+    def select(self, mask: np.ndarray) -> 'SpikeTrains':
+        """
+        @param [in] mask: a boolean mask aligned to INDICES
+        @returns new SpikeTrains with only the spikes in MASK, the electrodes
+                 are kept also if they are left without spikes
+        """
+        cumulative = np.zeros(len(self.indices) + 1, dtype=np.int64)
+        np.cumsum(mask, out=cumulative[1:])
+        return SpikeTrains(
+            self.indices[mask], cumulative[self.offsets], self.labels,
+            self.sampling_frequency,
+            None if self.amplitudes is None else self.amplitudes[mask])
+
+    def share(self) -> 'SpikeTrains':
+        """
+        @returns new SpikeTrains referencing the same buffers, that are marked
+                 read-only. Rebuilding one of them (i.e. with set_times)
+                 leaves the other untouched
+        """
+        return SpikeTrains(read_only(self.indices), read_only(self.offsets),
+                           read_only(self.labels), self.sampling_frequency,
+                           read_only(self.amplitudes))
+
+    def set_times(self, label: int, times: np.ndarray,
+                  amplitudes: Optional[np.ndarray] = None):
+        """
+        Replace (or add) the spikes of an electrode, rebuilding the buffers.
+        @param [in] label
+        @param [in] times: the new spikes times in seconds
+        @param [in] amplitudes: their amplitudes, needed only if the other
+                                electrodes have them
+        """
+        labels = self.labels.tolist()
+        trains = [self.samples(other) for other in labels]
+        others_amplitudes = None if self.amplitudes is None \
+            else [self.spikes_amplitudes(other) for other in labels]
+        train = np.rint(np.asarray(times, dtype=np.float64) *
+                        self.sampling_frequency)
+        if label in self._positions:
+            trains[self._positions[label]] = train
+        else:
+            labels.append(label)
+            trains.append(train)
+            if others_amplitudes is not None:
+                others_amplitudes.append(None)
+        if others_amplitudes is not None:
+            if amplitudes is None:
+                amplitudes = np.full(len(train), np.nan, dtype=np.float32)
+            others_amplitudes[labels.index(label)] = amplitudes
+        new = SpikeTrains.from_trains(labels, trains, self.sampling_frequency,
+                                      others_amplitudes, self.indices.dtype)
+        self._assign(new.indices, new.offsets, new.labels, new.amplitudes)
+        self._changed()
+
+    def remove(self, label: int):
+        """Remove the spikes of an electrode, rebuilding the buffers."""
+        keep = [other for other in self.labels.tolist() if other != label]
+        new = SpikeTrains.from_trains(
+            keep, [self.samples(other) for other in keep],
+            self.sampling_frequency,
+            None if self.amplitudes is None
+            else [self.spikes_amplitudes(other) for other in keep],
+            self.indices.dtype)
+        self._assign(new.indices, new.offsets, new.labels, new.amplitudes)
+        self._changed()
+
+    def _changed(self):
+        if self.on_change is not None:
+            self.on_change()
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # the callback is bound to the LazyPhases of this process
+        state = self.__dict__.copy()
+        state.pop('on_change', None)
+        return state
+
+
+class PeaksView(MutableMapping):
+    """
+    The map [electrode label -> times in seconds of the spikes] interface of
+    the SpikeTrains of a Phase. The times are computed from the sample indices
+    at each access, so they are read-only: the changes must be assigned back,
+    and the assignments go to the SpikeTrains.
+    """
+
+    def __init__(self, spikes: SpikeTrains):
+        self.spikes = spikes
+
+    def __getitem__(self, label: int) -> np.ndarray:
+        if label not in self.spikes:
+            raise KeyError(label)
+        return read_only(self.spikes.times(label))
+
+    def __setitem__(self, label: int, times: np.ndarray):
+        self.spikes.set_times(label, times)
+
+    def __delitem__(self, label: int):
+        if label not in self.spikes:
+            raise KeyError(label)
+        self.spikes.remove(label)
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self.spikes.labels.tolist())
+
+    def __len__(self) -> int:
+        return len(self.spikes)
+
+
+# the attributes of a Phase that can be changed by Phase.replace
+_PHASE_FIELDS = ['name', 'spikes', 'digital', 'sampling_frequency', 'durate',
+                 'div', 'phase_type', 'order', 'rest']
+
+
 class Phase:
     """
     The Phase class hold the informations about a single registration, that
@@ -81,23 +480,38 @@ class Phase:
     other.
     All this informations are stored in this class:
     - name: is the name of the mcd file containing the original recordings
-    - peaks: is a map [electrode number -> time of the revealed peaks]
-    - digital: if the phase was a stimulation is the Signal representing the
+    - spikes: the SpikeTrains of the revealed peaks
+    - peaks: is a map [electrode number -> time of the revealed peaks], a
+             view of spikes
+    - digital: if the phase was a stimulation is the (Digital)Signal of the
                presence of stimulation or less.
     - sampling frequency: self explainatory
     - durate: the duration in seconds of the recording
+    - amplitudes: if available, a map [electrode number -> peak to peak
+                  amplitude of the revealed peaks], a view of spikes
     """
 
     def __init__(
         self,
         name: str,
-        peaks: Dict[int, np.ndarray],
+        peaks: Union[Dict[int, np.ndarray], SpikeTrains],
         digital: Optional[Signal],
         sampling_frequency: float,
         durate: float,
+        *,
+        amplitudes: Optional[Dict[int, np.ndarray]] = None,
     ):
+        """
+        PEAKS can be the SpikeTrains or a map [electrode number -> times in
+        seconds], in this case they are converted in SpikeTrains together with
+        the AMPLITUDES map.
+        """
         self.name = name
-        self.peaks = peaks
+        if isinstance(peaks, SpikeTrains):
+            self.spikes = peaks
+        else:
+            self.spikes = SpikeTrains.from_dict(peaks, sampling_frequency,
+                                                amplitudes)
         self.digital = digital
         self.sampling_frequency = sampling_frequency
         self.durate = durate
@@ -106,6 +520,53 @@ class Phase:
         self.order: Optional[int] = None
         self.rest: str = ""
 
+    @property
+    def peaks(self) -> PeaksView:
+        return PeaksView(self.spikes)
+
+    @peaks.setter
+    def peaks(self, peaks: Dict[int, np.ndarray]):
+        self.spikes = SpikeTrains.from_dict(peaks, self.sampling_frequency)
+
+    @property
+    def amplitudes(self) -> Optional[Dict[int, np.ndarray]]:
+        if self.spikes.amplitudes is None:
+            return None
+        return {label: self.spikes.spikes_amplitudes(label)
+                for label in self.spikes.labels.tolist()}
+
+    def replace(self, **changes) -> 'Phase':
+        """
+        Copy-on-write copy of the phase: the new phase references the spikes
+        and digital buffers of this one, marked read-only, and only the
+        attributes in CHANGES are replaced, i.e.:
+
+        phase.replace(spikes=phase.spikes.select(mask))
+
+        @param [in] changes: new values of name, spikes, digital,
+                             sampling_frequency, durate, div, phase_type,
+                             order or rest
+        @returns the new phase
+        """
+        unknown = set(changes) - set(_PHASE_FIELDS)
+        assert len(unknown) == 0, f"unknown phase attributes {unknown}"
+        values = {key: changes[key] if key in changes else getattr(self, key)
+                  for key in _PHASE_FIELDS}
+        if 'spikes' not in changes:
+            values['spikes'] = self.spikes.share()
+        if 'digital' not in changes and self.digital is not None:
+            values['digital'] = self.digital.share()
+        phase = Phase(values['name'], values['spikes'], values['digital'],
+                      values['sampling_frequency'], values['durate'])
+        for key in ['div', 'phase_type', 'order', 'rest']:
+            setattr(phase, key, values[key])
+        return phase
+
+    def nbytes(self) -> int:
+        """@returns the size in bytes of the spikes and digital buffers"""
+        return self.spikes.nbytes() + \
+            (self.digital.nbytes() if self.digital is not None else 0)
+
     def to_dict(self) -> Dict[str, Any]:
         return self.__dict__()
 
@@ -128,6 +589,12 @@ class Phase:
 
         return ret
 
+    def __setstate__(self, state: Dict[str, Any]):
+        # __dict__ is overridden, so the default unpickling can't set the
+        # attributes (i.e. when a Phase is sent back from another process)
+        for key, value in state.items():
+            setattr(self, key, value)
+
     def phase_info(self) -> PhaseInfo:
         ret = PhaseInfo()
         ret.name = self.name
@@ -159,13 +626,164 @@ class Phase:
         return self.name
 
 
+def _identity(phase: Phase) -> Phase:
+    return phase
+
+
+class PhaseProxy:
+    """
+    Stand-in for the i-th phase of a LazyPhases: reading or writing any
+    attribute of the phase through the proxy loads it (if it's not in memory)
+    and forwards the access to it. Setting an attribute, or changing the
+    spikes through the peaks or the spikes, pins the phase in memory,
+    otherwise the change would be lost when it is evicted.
+    """
+
+    __slots__ = ('_phases', '_index')
+
+    def __init__(self, phases: 'LazyPhases', index: int):
+        object.__setattr__(self, '_phases', phases)
+        object.__setattr__(self, '_index', index)
+
+    def load(self) -> Phase:
+        """@returns the proxied phase, loading it if needed"""
+        return self._phases.load(self._index)
+
+    def __getattr__(self, name: str):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return getattr(self.load(), name)
+
+    def __setattr__(self, name: str, value: Any):
+        phase = self.load()
+        setattr(phase, name, value)
+        self._phases[self._index] = phase
+
+    def __reduce_ex__(self, protocol):
+        # copies and pickles are of the phase itself
+        return _identity, (self.load(),)
+
+    def __str__(self):
+        return str(self.load())
+
+
+class LazyPhases(SequenceABC):
+    """
+    The list of the phases of an Experiment whose phases are loaded only when
+    they are first accessed, i.e. from an experiment file (see
+    io.open_experiment). The items are PhaseProxy, the loaded phases are kept
+    in a LRU cache: when their size exceeds MAX_BYTES the least recently used
+    ones are evicted and will be loaded again on the next access. The phases
+    assigned with phases[i] = phase, or changed through their proxy, are
+    never evicted. The buffers of the loaded phases are read-only, so that
+    they can't be changed in place without pinning them.
+    """
+
+    def __init__(self, loader: Callable[[int], Phase], count: int,
+                 max_bytes: Optional[int] = None):
+        """
+        @param [in] loader: a function loading the i-th phase
+        @param [in] count: the number of phases
+        @param [in] max_bytes: the memory budget of the cache (see
+                               Phase.nbytes), None for no limit. The last
+                               loaded phase is kept even if it exceeds it
+        """
+        self.loader = loader
+        self.max_bytes = max_bytes
+        self.proxies = [PhaseProxy(self, i) for i in range(count)]
+        # index -> (phase, size in bytes), from the least recently used
+        self.cache: 'OrderedDict[int, Tuple[Phase, int]]' = OrderedDict()
+        self.pinned: Dict[int, Phase] = {}
+        self.cached_bytes = 0
+
+    def load(self, index: int) -> Phase:
+        """@returns the INDEX-th phase, loading it if it's not in memory"""
+        index = range(len(self))[index]
+        if index in self.pinned:
+            return self.pinned[index]
+        if index in self.cache:
+            self.cache.move_to_end(index)
+            return self.cache[index][0]
+        phase = self.loader(index)
+        self._watch(index, phase)
+        nbytes = phase.nbytes()
+        self.cache[index] = (phase, nbytes)
+        self.cached_bytes += nbytes
+        self._evict()
+        return phase
+
+    def _watch(self, index: int, phase: Phase):
+        # the evictable phases can be changed only by rebuilding their
+        # buffers, which pins them
+        for array in [phase.spikes.indices, phase.spikes.offsets,
+                      phase.spikes.labels, phase.spikes.amplitudes]:
+            read_only(array)
+        if isinstance(phase.digital, DigitalSignal):
+            read_only(phase.digital.edges)
+        elif phase.digital is not None:
+            read_only(phase.digital.data)
+        phase.spikes.on_change = partial(self._pin, index)
+
+    def _pin(self, index: int):
+        if index in self.cache:
+            self[index] = self.cache[index][0]
+
+    def _evict(self):
+        while self.max_bytes is not None and len(self.cache) > 1 \
+                and self.cached_bytes > self.max_bytes:
+            _, (_, nbytes) = self.cache.popitem(last=False)
+            self.cached_bytes -= nbytes
+
+    def set_max_bytes(self, max_bytes: Optional[int]):
+        self.max_bytes = max_bytes
+        self._evict()
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        return self.proxies[index]
+
+    def __setitem__(self, index: int, phase: Union[Phase, PhaseProxy]):
+        index = range(len(self))[index]
+        if isinstance(phase, PhaseProxy):
+            phase = phase.load()
+        if index in self.cache:
+            self.cached_bytes -= self.cache.pop(index)[1]
+        self.pinned[index] = phase
+
+    def __len__(self) -> int:
+        return len(self.proxies)
+
+    def replace(self, index: int, phase: Phase) -> 'LazyPhases':
+        """
+        @returns new LazyPhases with the same loader, sharing the buffers
+                 of the loaded phases (see Phase.replace), where the INDEX-th
+                 phase is PHASE
+        """
+        phases = LazyPhases(self.loader, len(self), self.max_bytes)
+        for i, (cached, nbytes) in self.cache.items():
+            cached = cached.replace()
+            phases._watch(i, cached)
+            phases.cache[i] = (cached, nbytes)
+        phases.cached_bytes = self.cached_bytes
+        phases.pinned = {i: pinned.replace()
+                         for i, pinned in self.pinned.items()}
+        phases[index] = phase
+        return phases
+
+    def is_loaded(self, index: int) -> bool:
+        index = range(len(self))[index]
+        return index in self.pinned or index in self.cache
+
+
 class Experiment:
     """This class is meant to store information about all recording on a
     cellular colture and the information related to them. In particular, it has
     the following fields:
     - name: usually the colture id
     - path: path where the SpyCode files from whom it has been originated were
-    - phases: a list of the experiment phases
+    - phases: a list of the experiment phases (a LazyPhases of PhaseProxy
+      if the phases are loaded on demand)
     - date: date of the reconrdings
     - grounded_el: a list of channels grounded during recording
     - applied_operations: a list of tuple (operation_name, operation_arguments)
@@ -174,8 +792,8 @@ class Experiment:
       that automatically adds it on this list.
     """
 
-    def __init__(self, name, path: str, date: str, phases: List[Phase],
-                 grounded_el=[]):
+    def __init__(self, name, path: str, date: str,
+                 phases: Union[List[Phase], LazyPhases], grounded_el=[]):
         self.name = name
         self.path = path
         self.phases = phases
@@ -183,6 +801,23 @@ class Experiment:
         self.grounded_el: List[int] = grounded_el
         self.applied_operations: List[Tuple[str, List[str]]] = []
 
+    def replace_phase(self, index: int, phase: Phase) -> 'Experiment':
+        """
+        @returns a new experiment with the INDEX-th phase replaced by PHASE,
+                 the other phases share their buffers with the ones of this
+                 experiment (see Phase.replace)
+        """
+        if isinstance(self.phases, LazyPhases):
+            phases: Union[List[Phase], LazyPhases] = \
+                self.phases.replace(index, phase)
+        else:
+            phases = [other.replace() for other in self.phases]
+            phases[index] = phase
+        experiment = Experiment(self.name, self.path, self.date, phases,
+                                list(self.grounded_el))
+        experiment.applied_operations = list(self.applied_operations)
+        return experiment
+
     def to_dict(self) -> Dict[str, Any]:
         return self.__dict__()
 
@@ -198,3 +833,8 @@ class Experiment:
             phases.append(p.to_dict())
         ret["phases"] = np.array(phases, dtype=object)  # type: ignore
         return ret
+
+    def __setstate__(self, state: Dict[str, Any]):
+        # see Phase.__setstate__
+        for key, value in state.items():
+            setattr(self, key, value)
@@ -5,15 +5,349 @@ can be found at
 https://www.multichannelsystems.com/sites/multichannelsystems.com/files/documents/manuals/HDF5%20MCS%20Raw%20Data%20Definition.pdf
 '''
 
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from pathlib import Path
-from typing import Dict, List, Optional
+from threading import Lock
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
 
 import numpy as np  # type: ignore
-from h5py import Dataset, File, Group  # type: ignore
+from h5py import Dataset, File, Group, h5d, h5p  # type: ignore
+
+
+def clip_range(n_samples: int, start: Optional[int] = None,
+               stop: Optional[int] = None) -> Tuple[int, int]:
+    """
+    Clip a range of samples [START, STOP) inside [0, N_SAMPLES), None meaning
+    the beginning or the end.
+    @returns the couple (start, stop)
+    """
+    start = 0 if start is None else min(max(int(start), 0), n_samples)
+    stop = n_samples if stop is None else min(max(int(stop), start),
+                                              n_samples)
+    return start, stop
+
+
+def time_to_samples(tick: float, n_samples: int,
+                    t_start: Optional[float] = None,
+                    t_stop: Optional[float] = None) -> Tuple[int, int]:
+    """
+    Convert a time range [T_START, T_STOP) in seconds into the range of the
+    samples inside it.
+    @param [in] tick: the sampling period in microseconds (as in InfoChannel)
+    @param [in] n_samples: the number of samples of the channel
+    @param [in] t_start: None means the beginning of the recording
+    @param [in] t_stop: None means the end of the recording
+    @returns the couple (start, stop) of sample indices
+    """
+    SCALING_S_TO_US = 1e6
+    # the tolerance absorbs the rounding of times that fall on a sample
+    TOLERANCE = 1e-6
+
+    def to_sample(t: Optional[float]) -> Optional[int]:
+        if t is None:
+            return None
+        return int(np.ceil(t * SCALING_S_TO_US / tick - TOLERANCE))
+    return clip_range(n_samples, to_sample(t_start), to_sample(t_stop))
+
+
+def read_rows(dataset: Dataset, rows: Sequence[int], out: np.ndarray,
+              start: int = 0, stop: Optional[int] = None) -> np.ndarray:
+    """
+    Read some rows of a 2D dataset directly into a preallocated buffer,
+    converting them to its dtype. Consecutive rows are read with a single
+    hyperslab selection.
+    @param [in] dataset
+    @param [in] rows: indices of the rows to read
+    @param [out] out: (len(ROWS) x (STOP - START)) buffer
+    @param [in] start: first column to read
+    @param [in] stop: last column to read (excluded), the last one if None
+    @returns OUT
+    """
+    if stop is None:
+        stop = dataset.shape[1]
+    if stop <= start:
+        return out
+    i = 0
+    while i < len(rows):
+        j = i + 1
+        while j < len(rows) and rows[j] == rows[j - 1] + 1:
+            j += 1
+        dataset.read_direct(out, np.s_[rows[i]:rows[j - 1] + 1, start:stop],
+                            np.s_[i:j, :])
+        i = j
+    return out
+
+
+def convert_mantissas(data: np.ndarray, adc_offset, conversion_factor,
+                      exponent) -> np.ndarray:
+    """
+    Convert in place the ADC values in DATA into voltages:
+        (data - adc_offset) * conversion_factor * 10^exponent
+    The parameters can be scalars or arrays that broadcast against DATA
+    (e.g. a column with a value for each row).
+    @returns DATA
+    """
+    np.subtract(data, adc_offset, out=data)
+    np.multiply(data, conversion_factor, out=data)
+    np.multiply(data, np.power(10., exponent), out=data)
+    return data
+
+
+class H5FilePool:
+    """
+    A pool of HDF5 files opened in read mode, shared by the loaders.
+
+    At most MAX_OPEN files are kept open: when a new file is needed the least
+    recently used one that is not borrowed is closed. Borrowed files are never
+    closed by the pool, so if all of them are in use the limit can be
+    temporarily exceeded.
+
+    with H5_FILES.borrow(path) as h5file:
+        ...
+    """
+
+    def __init__(self, max_open: int = 64):
+        """
+        @param [in] max_open: maximum number of files kept open
+        """
+        assert max_open > 0, "max_open should be positive"
+        self.max_open = max_open
+        # path -> (file, number of borrows), from the least recently used
+        self._files: OrderedDict[Path, List] = OrderedDict()
+        self._lock = Lock()
+
+    def acquire(self, path: Path) -> File:
+        """
+        Borrow the file at PATH, opening it if it isn't already. Every acquire
+        should be followed by a release of the same path.
+        """
+        path = Path(path).absolute()
+        with self._lock:
+            entry = self._files.get(path)
+            if entry is None:
+                entry = [File(path, 'r'), 0]
+                self._files[path] = entry
+            self._files.move_to_end(path)
+            entry[1] += 1
+            self._evict()
+            return entry[0]
+
+    def release(self, path: Path):
+        """
+        Give back a file borrowed with acquire, it stays open until it is
+        evicted.
+        """
+        path = Path(path).absolute()
+        with self._lock:
+            entry = self._files.get(path)
+            if entry is None or entry[1] == 0:
+                print(f'ERROR: H5FilePool release, {path} is not borrowed')
+                return
+            entry[1] -= 1
+            self._evict()
+
+    @contextmanager
+    def borrow(self, path: Path) -> Iterator[File]:
+        """Context manager version of acquire and release."""
+        h5file = self.acquire(path)
+        try:
+            yield h5file
+        finally:
+            self.release(path)
+
+    def close(self, path: Path) -> bool:
+        """
+        Close the file at PATH if it is open and not borrowed, i.e. before
+        writing it.
+        @returns True if the file is not open anymore
+        """
+        path = Path(path).absolute()
+        with self._lock:
+            entry = self._files.get(path)
+            if entry is None:
+                return True
+            if entry[1] > 0:
+                return False
+            del self._files[path]
+            entry[0].close()
+            return True
+
+    def close_all(self):
+        """Close all the files that are not borrowed."""
+        with self._lock:
+            for path in [path for path, entry in self._files.items()
+                         if entry[1] == 0]:
+                self._files.pop(path)[0].close()
+
+    def set_max_open(self, max_open: int):
+        """Change the maximum number of open files, evicting if needed."""
+        assert max_open > 0, "max_open should be positive"
+        with self._lock:
+            self.max_open = max_open
+            self._evict()
+
+    def _evict(self):
+        # must be called holding the lock
+        if len(self._files) <= self.max_open:
+            return
+        for path in [path for path, entry in self._files.items()
+                     if entry[1] == 0]:
+            self._files.pop(path)[0].close()
+            if len(self._files) <= self.max_open:
+                return
+
+    def __len__(self) -> int:
+        return len(self._files)
+
+    def __contains__(self, path: Path) -> bool:
+        return Path(path).absolute() in self._files
+
+
+# the pool used by every loader of PyCode
+H5_FILES = H5FilePool()
+
+
+# the access patterns of ChannelData the chunk cache can be tuned for:
+# - by_channel: whole channels (or long parts of them) one after the other
+# - by_time: blocks of samples of all the channels
+# - random: short windows anywhere in the dataset
+ACCESS_PATTERNS = ['by_channel', 'by_time', 'random']
+# upper bound of the chunk cache of a single dataset
+MAX_CHUNK_CACHE_BYTES = 256 << 20
+# the HDF5 default, used as lower bound
+MIN_CHUNK_CACHE_BYTES = 1 << 20
+
+
+def _next_prime(n: int) -> int:
+    n = max(n, 2)
+    while any(n % d == 0 for d in range(2, int(n ** 0.5) + 1)):
+        n += 1
+    return n
+
+
+def chunk_cache_settings(dataset: Dataset, access: str = 'random'
+                         ) -> Optional[Tuple[int, int, float]]:
+    """
+    Compute the raw data chunk cache parameters suited to read a 2D
+    (channels x samples) dataset with the given access pattern.
+    - by_channel: a whole band of chunks along the time is cached, so that
+      each chunk is read (and decompressed) once even if its rows are read
+      one channel at a time
+    - by_time: a whole column of chunks along the channels is cached, it is
+      discarded once fully read
+    - random: a few chunks are cached
+    @param [in] dataset: a chunked dataset
+    @param [in] access: one of ACCESS_PATTERNS
+    @returns (rdcc_nbytes, rdcc_nslots, rdcc_w0), None if the dataset is
+             contiguous and has no chunk cache
+    """
+    assert access in ACCESS_PATTERNS, \
+        f"access should be one of {ACCESS_PATTERNS}"
+    if dataset.chunks is None:
+        return None
+    chunk_bytes = int(np.prod(dataset.chunks)) * dataset.dtype.itemsize
+    time_chunks = -(-dataset.shape[1] // dataset.chunks[1])
+    channel_chunks = -(-dataset.shape[0] // dataset.chunks[0])
+    if access == 'by_channel':
+        n_chunks, w0 = time_chunks, 0.
+    elif access == 'by_time':
+        n_chunks, w0 = channel_chunks, 1.
+    else:
+        n_chunks, w0 = 16, 0.75
+    nbytes = min(max(n_chunks * chunk_bytes, MIN_CHUNK_CACHE_BYTES),
+                 MAX_CHUNK_CACHE_BYTES)
+    # the HDF5 documentation suggests a prime number of slots, about 100
+    # times the number of chunks fitting in the cache
+    nslots = _next_prime(100 * max(nbytes // chunk_bytes, 1))
+    return nbytes, nslots, w0
+
+
+def open_dataset(group: Group, name: str, access: str = 'random') -> Dataset:
+    """
+    Open a dataset with the chunk cache tuned for the given access pattern
+    (see chunk_cache_settings). HDF5 has a single cache for the openings of
+    a dataset in a file, so if the dataset is already open elsewhere its
+    current cache is kept.
+    @param [in] group: the group containing the dataset
+    @param [in] name: the name of the dataset in GROUP
+    @param [in] access: one of ACCESS_PATTERNS
+    """
+    dataset = group[name]
+    settings = chunk_cache_settings(dataset, access)
+    if settings is None:
+        return dataset
+    # HDF5 shares the cache between the openings of a dataset, so it has to
+    # be closed for the new settings to be applied
+    del dataset
+    nbytes, nslots, w0 = settings
+    dapl = h5p.create(h5p.DATASET_ACCESS)
+    dapl.set_chunk_cache(nslots, nbytes, w0)
+    return Dataset(h5d.open(group.id, name.encode(), dapl=dapl))
+
+
+def aligned_block_size(dataset: Dataset, block_size: int) -> int:
+    """
+    Round a number of samples to read at once to a multiple of the chunks
+    width of a (channels x samples) dataset, so that each read covers whole
+    chunks.
+    @returns the aligned block size, at least one chunk wide
+    """
+    if dataset.chunks is None:
+        return max(int(block_size), 1)
+    width = dataset.chunks[1]
+    return max(int(block_size) // width, 1) * width
+
+
+# a contiguous dataset as (file name, byte offset, dtype, shape)
+ContiguousLayout = Tuple[str, int, np.dtype, Tuple[int, ...]]
+
+
+def contiguous_layout(dataset: Dataset) -> Optional[ContiguousLayout]:
+    """
+    Get where the data of a dataset stored contiguously and uncompressed lies
+    in its file, so that it can be memory mapped (see map_layout).
+    @param [in] dataset
+    @returns (file name, byte offset, dtype, shape) or None if the dataset is
+             chunked (compressed datasets always are), stored outside the
+             file, not allocated yet, in a file not opened with the default
+             driver or not of a numerical type
+    """
+    if dataset.chunks is not None or dataset.external is not None:
+        return None
+    if dataset.file.driver not in ['sec2', 'stdio']:
+        return None
+    if dataset.dtype.kind not in 'iuf':
+        return None
+    offset = dataset.id.get_offset()
+    if offset is None:
+        return None
+    return dataset.file.filename, offset, dataset.dtype, dataset.shape
+
+
+def map_layout(layout: ContiguousLayout) -> np.memmap:
+    """
+    Memory map in read mode a contiguous dataset: the slices of it are views
+    on the page cache, shared by all the processes mapping the same file.
+    @param [in] layout: as returned by contiguous_layout
+    """
+    filename, offset, dtype, shape = layout
+    return np.memmap(filename, dtype=dtype, mode='r', offset=offset,
+                     shape=shape)
+
+
+def memmap_dataset(dataset: Dataset) -> Optional[np.memmap]:
+    """
+    Memory map a dataset if it is contiguous and uncompressed.
+    @returns the np.memmap or None, in this case it should be read with h5py
+    """
+    layout = contiguous_layout(dataset)
+    return None if layout is None else map_layout(layout)
 
 
 class InfoChannel:
-    def __init__(self, info_data: Dataset):
+    def __init__(self, info_data: np.void):
         self.who_knows = info_data[0]
         self.channel_id = info_data[1]
         self.row_index = info_data[2]
@@ -47,20 +381,43 @@ conversion factor:  {self.conversion_factor}
 
 
 class AnalogStream:
-    def __init__(self, base_group: Group, key: str):
+    def __init__(self, base_group: Group, key: str, access: str = 'random',
+                 memmap: bool = False):
+        """
+        @param [in] base_group: the AnalogStream group
+        @param [in] key: the name of the stream
+        @param [in] access: the expected access pattern of ChannelData (see
+                            ACCESS_PATTERNS), its chunk cache is tuned on it
+        @param [in] memmap: if True and ChannelData is contiguous and
+                            uncompressed it is read through a memory map
+                            instead of h5py
+        """
         self.name = key
+        self.access = access
+        self.mapped_channels: Optional[np.memmap] = None
         stream_group = base_group[key]
         self.label_dict: Dict[int, int] = {}
         try:
-            self.length = stream_group['InfoChannel'].shape[0]
-            self.info_channels: List[InfoChannel] = []
-            for i in range(self.length):
-                self.info_channels.append(
-                    InfoChannel(stream_group['InfoChannel'][i]))
-            self.data_channels = stream_group['ChannelData']
-            for info_channel in self.info_channels:
-                self.label_dict[int(info_channel.label)] = int(
-                    info_channel.channel_id)
+            # the whole InfoChannel compound dataset is read at once, the
+            # fields of the channels are then column views of it
+            self.info_table: np.ndarray = stream_group['InfoChannel'][()]
+            fields = self.info_table.dtype.names
+            self.length = self.info_table.shape[0]
+            self.channel_ids = self.info_table[fields[1]]
+            self.labels = self.info_table[fields[4]]
+            self.exponents = self.info_table[fields[7]]
+            self.adc_offsets = self.info_table[fields[8]]
+            self.ticks = self.info_table[fields[9]]
+            self.conversion_factors = self.info_table[fields[10]]
+            self.info_channels: List[InfoChannel] = [
+                InfoChannel(info_data) for info_data in self.info_table]
+            self.data_channels = open_dataset(stream_group, 'ChannelData',
+                                              access)
+            if memmap:
+                self.mapped_channels = memmap_dataset(self.data_channels)
+            self.label_dict = dict(zip(
+                self.labels.astype(np.int64).tolist(),
+                self.channel_ids.astype(np.int64).tolist()))
         except Exception as e:
             print(
                 f'ERROR: AnalogStream __init__, {key} could be corrupted',
@@ -73,18 +430,160 @@ class AnalogStream:
             'label': str(info_channel.label),
         }
 
-    def parse_signal(self, label: int) -> np.ndarray:
+    def samples_range(self, t_start: Optional[float] = None,
+                      t_stop: Optional[float] = None) -> Tuple[int, int]:
+        """
+        Convert a time range into the range of samples of the channels, using
+        the channels tick.
+        @param [in] t_start: in seconds, the beginning of the recording if None
+        @param [in] t_stop: in seconds (excluded), the end of the recording if
+                            None
+        @returns a couple (start, stop) of sample indices
+        """
+        return time_to_samples(self.ticks[0], self.data_channels.shape[1],
+                               t_start, t_stop)
+
+    def parse_signal(self, label: int,
+                     t_start: Optional[float] = None,
+                     t_stop: Optional[float] = None,
+                     dtype: np.dtype = np.float64,
+                     out: Optional[np.ndarray] = None) -> np.ndarray:
+        """
+        Read and convert in voltages the signal of a channel. The ADC values
+        are read directly in the output buffer and converted in place.
+        @param [in] label: the label of the channel
+        @param [in] t_start: in seconds, if given only the samples from here
+                             are read
+        @param [in] t_stop: in seconds, if given only the samples before here
+                            are read
+        @param [in] dtype: np.float64 or np.float32
+        @param [out] out: optional preallocated buffer of DTYPE with as many
+                          elements as the samples read
+        @returns the signal as a column array
+        """
+        return self.parse_signal_samples(label,
+                                         *self.samples_range(t_start, t_stop),
+                                         dtype=dtype, out=out)
+
+    def parse_signal_samples(self, label: int,
+                             start: Optional[int] = None,
+                             stop: Optional[int] = None,
+                             dtype: np.dtype = np.float64,
+                             out: Optional[np.ndarray] = None) -> np.ndarray:
+        """
+        Same as parse_signal, but the range is given in samples: only the
+        hyperslab [START, STOP) of the channel is read.
+        """
         index = self.label_dict[label]
         info_channel = self.info_channels[index]
-        offset = info_channel.adc_offset
-        conversion_factor = info_channel.conversion_factor
-        exponent = info_channel.exponent
-        mantissas = np.expand_dims(self.data_channels[index][:], 1)
+        start, stop = clip_range(self.data_channels.shape[1], start, stop)
+        if out is None:
+            out = np.empty(stop - start, dtype=dtype)
+        buffer = out.reshape(1, -1)
+        self._read_rows([index], buffer, start, stop)
+        convert_mantissas(buffer, info_channel.adc_offset,
+                          info_channel.conversion_factor,
+                          info_channel.exponent)
+        return buffer.reshape(-1, 1)
+
+    def parse_signals(self, labels: Sequence[int],
+                      t_start: Optional[float] = None,
+                      t_stop: Optional[float] = None,
+                      dtype: np.dtype = np.float64,
+                      out: Optional[np.ndarray] = None) -> np.ndarray:
+        """
+        Read and convert in voltages the signals of some channels in a single
+        pass: the ADC values are read directly in the output buffer and the
+        conversion parameters of each channel are broadcasted on its row.
+        @param [in] labels: the labels of the channels
+        @param [in] t_start: in seconds, if given only the samples from here
+                             are read
+        @param [in] t_stop: in seconds, if given only the samples before here
+                            are read
+        @param [in] dtype: np.float64 or np.float32
+        @param [out] out: optional preallocated (len(LABELS) x samples) buffer
+                          of DTYPE
+        @returns a (len(LABELS) x samples) array
+        """
+        return self.parse_signals_samples(
+            labels, *self.samples_range(t_start, t_stop), dtype=dtype,
+            out=out)
+
+    def parse_signals_samples(self, labels: Sequence[int],
+                              start: Optional[int] = None,
+                              stop: Optional[int] = None,
+                              dtype: np.dtype = np.float64,
+                              out: Optional[np.ndarray] = None) -> np.ndarray:
+        """
+        Same as parse_signals, but the range is given in samples: only the
+        hyperslab [START, STOP) of the channels is read.
+        """
+        indices = [self.label_dict[label] for label in labels]
+        start, stop = clip_range(self.data_channels.shape[1], start, stop)
+        if out is None:
+            out = np.empty((len(indices), stop - start), dtype=dtype)
+        self._read_rows(indices, out, start, stop)
+        convert_mantissas(out,
+                          self.adc_offsets[indices, None],
+                          self.conversion_factors[indices, None],
+                          self.exponents[indices, None])
+        return out
+
+    def raw_signal(self, label: int, start: Optional[int] = None,
+                   stop: Optional[int] = None) -> np.ndarray:
+        """
+        Get the ADC values of a channel in the samples [START, STOP), without
+        conversion. If the stream is memory mapped this is a view on the file,
+        otherwise the values are read with h5py.
+        @param [in] label: the label of the channel
+        @param [in] start: the first sample, 0 if None
+        @param [in] stop: the last sample (excluded), the last one if None
+        @returns a row array of the ADC values
+        """
+        index = self.label_dict[label]
+        start, stop = clip_range(self.data_channels.shape[1], start, stop)
+        if self.mapped_channels is not None:
+            return self.mapped_channels[index, start:stop]
+        return self.data_channels[index, start:stop]
 
-        converted_data = (mantissas - np.ones(shape=mantissas.shape) *
-                          offset) * conversion_factor * np.power(10., exponent)
+    def _read_rows(self, indices: Sequence[int], out: np.ndarray, start: int,
+                   stop: int):
+        if self.mapped_channels is None:
+            read_rows(self.data_channels, indices, out, start, stop)
+            return
+        # each row is copied (and converted to the dtype of OUT) straight
+        # from the mapped pages
+        for i, index in enumerate(indices):
+            out[i] = self.mapped_channels[index, start:stop]
 
-        return converted_data
+    def iter_signals(self, labels: Optional[Sequence[int]] = None,
+                     t_start: Optional[float] = None,
+                     t_stop: Optional[float] = None,
+                     block_size: int = 1 << 16,
+                     dtype: np.dtype = np.float64
+                     ) -> Iterator[Tuple[int, np.ndarray]]:
+        """
+        Read and convert the signals of some channels in consecutive blocks of
+        samples. The blocks boundaries are aligned to the chunks of
+        ChannelData, so that each chunk is read once (open the stream with
+        the 'by_time' access pattern).
+        @param [in] labels: the labels of the channels, all if None
+        @param [in] t_start: in seconds, the beginning of the recording if None
+        @param [in] t_stop: in seconds, the end of the recording if None
+        @param [in] block_size: about the number of samples of each block, it
+                                is rounded to a multiple of the chunks width
+        @param [in] dtype: np.float64 or np.float32
+        @returns an iterator of (first sample, (len(LABELS) x samples) block)
+        """
+        if labels is None:
+            labels = self.labels.astype(np.int64).tolist()
+        start, stop = self.samples_range(t_start, t_stop)
+        block_size = aligned_block_size(self.data_channels, block_size)
+        while start < stop:
+            block_stop = min((start // block_size + 1) * block_size, stop)
+            yield start, self.parse_signals_samples(labels, start, block_stop,
+                                                    dtype)
+            start = block_stop
 
     def __str__(self):
         return f'''
@@ -115,33 +614,127 @@ source label:       {self.source_label}
         '''
 
 
+class EventsBuffer:
+    """
+    The events of many channels in a single buffer: the events of the i-th
+    channel are VALUES[OFFSETS[i]:OFFSETS[i + 1]].
+    """
+
+    def __init__(self, values: np.ndarray, offsets: np.ndarray,
+                 channel_ids: np.ndarray):
+        """
+        @param [in] values: the concatenated events of all the channels
+        @param [in] offsets: len(CHANNEL_IDS) + 1 boundaries in VALUES
+        @param [in] channel_ids: the id of each channel
+        """
+        self.values = values
+        self.offsets = offsets
+        self.channel_ids = channel_ids
+
+    def __len__(self) -> int:
+        return len(self.channel_ids)
+
+    def __getitem__(self, index: int) -> np.ndarray:
+        """@returns a view of the events of the INDEX-th channel"""
+        return self.values[self.offsets[index]:self.offsets[index + 1]]
+
+    def split(self) -> List[np.ndarray]:
+        """@returns the views of the events of every channel"""
+        return [self[i] for i in range(len(self))]
+
+
+def read_time_stamps(stream_group: Group, workers: int = 1,
+                     in_seconds: bool = False) -> EventsBuffer:
+    """
+    Read all the TimeStampEntity datasets of a TimeStampStream in a single
+    buffer, in the order of InfoTimeStamp. The sizes of the entities are
+    read first so that each one is read directly in its slice of the buffer.
+    @param [in] stream_group: the TimeStampStream/Stream_N group
+    @param [in] workers: number of threads the reads are distributed on
+    @param [in] in_seconds: if True the time stamps are converted in seconds
+                            with the exponent of each channel, otherwise they
+                            are the stored integers (usually microseconds)
+    @returns the EventsBuffer with the time stamps of every channel
+    """
+    info_table = stream_group['InfoTimeStamp'][()]
+    fields = info_table.dtype.names
+    channel_ids = info_table[fields[0]]
+    datasets = [stream_group.get(f'TimeStampEntity_{channel_id}')
+                for channel_id in channel_ids]
+    sizes = np.array([0 if dataset is None else dataset.size
+                      for dataset in datasets], dtype=np.int64)
+    offsets = np.zeros(len(datasets) + 1, dtype=np.int64)
+    np.cumsum(sizes, out=offsets[1:])
+    values = np.empty(offsets[-1], dtype=np.int64)
+
+    def read(i: int):
+        if sizes[i] > 0:
+            datasets[i].read_direct(values, np.s_[0, :],
+                                    np.s_[offsets[i]:offsets[i + 1]])
+
+    if workers > 1:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(read, range(len(datasets))))
+    else:
+        for i in range(len(datasets)):
+            read(i)
+
+    if in_seconds:
+        scales = np.power(10., info_table[fields[4]].astype(np.float64))
+        values = values * np.repeat(scales, sizes)
+    return EventsBuffer(values, offsets, channel_ids)
+
+
 class TimeStampStream:
     def __init__(self, base_group: Group, key: str):
         self.name = key
         self.stream_group = base_group[key]
         self.label_dict: Dict[int, int] = {}
+        # filled by load_events
+        self.events: Optional[EventsBuffer] = None
+        self.event_indices: Dict[int, int] = {}
         try:
-            info_time_stamps = self.stream_group['InfoTimeStamp']
-            self.info_time_stamps = []
-            self.length = info_time_stamps.shape[0]
-            for i in range(self.length):
-                self.info_time_stamps.append(
-                    InfoTimeStamp(info_time_stamps[i]))
-            for i in range(self.length):
-                self.label_dict[int(self.info_time_stamps[i].source_label)] = \
-                    int(self.info_time_stamps[i].channel_id)
+            # single read of the InfoTimeStamp compound dataset
+            self.info_table: np.ndarray = \
+                self.stream_group['InfoTimeStamp'][()]
+            fields = self.info_table.dtype.names
+            self.length = self.info_table.shape[0]
+            self.channel_ids = self.info_table[fields[0]]
+            self.source_labels = self.info_table[fields[6]]
+            self.info_time_stamps = [
+                InfoTimeStamp(info_time_stamp)
+                for info_time_stamp in self.info_table]
+            self.label_dict = dict(zip(
+                self.source_labels.astype(np.int64).tolist(),
+                self.channel_ids.astype(np.int64).tolist()))
 
         except Exception as e:
             print(
                 f'ERROR: TimeStampStream __init__, {key} could be corrupted',
                 e.args)
 
+    def load_events(self, workers: int = 1) -> EventsBuffer:
+        """
+        Read the events of all the channels at once (see read_time_stamps),
+        after this get_channel_events returns views of the buffer.
+        @param [in] workers: number of threads the reads are distributed on
+        @returns the EventsBuffer of the time stamps, in the InfoTimeStamp
+                 order
+        """
+        if self.events is None:
+            self.events = read_time_stamps(self.stream_group, workers)
+            self.event_indices = {
+                int(channel_id): i
+                for i, channel_id in enumerate(self.events.channel_ids)}
+        return self.events
+
     def get_channel_events(self, channel_label: int) -> Optional[np.ndarray]:
         channel_id = self.label_dict.get(channel_label)
-        if channel_id is not None:
-            return self.stream_group[f'TimeStampEntity_{channel_id}'][0, :]
-        else:
+        if channel_id is None:
             return None
+        if self.events is not None:
+            return self.events[self.event_indices[channel_id]]
+        return self.stream_group[f'TimeStampEntity_{channel_id}'][0, :]
 
     def quick_info_list(self, index: int) -> Dict[str, str]:
         info_time_stamp = self.info_time_stamps[index]
@@ -158,7 +751,16 @@ Number of channels:     {self.length}
 
 
 class H5Content:
-    def __init__(self, filepath: Path):
+    def __init__(self, filepath: Path, access: str = 'random',
+                 memmap: bool = False):
+        """
+        @param [in] filepath: the path of the HDF5 file
+        @param [in] access: the expected access pattern of the analog signals
+                            (see ACCESS_PATTERNS), the chunk caches are tuned
+                            on it
+        @param [in] memmap: memory map the contiguous analog streams (see
+                            AnalogStream)
+        """
         self.name = str(filepath.name)
         try:
             filepath = Path(filepath)
@@ -167,8 +769,11 @@ class H5Content:
                 'ERROR: H5Content __init__, filepath should be a Path and is ',
                 type(filepath), '\n', e)
 
+        # the path of the file borrowed from H5_FILES, None once closed
+        self.path: Optional[Path] = None
         try:
-            data = File(filepath)
+            data = H5_FILES.acquire(filepath)
+            self.path = filepath
             data = data['/Data/Recording_0']
             keys = data.keys()
             if 'AnalogStream' in keys:
@@ -176,7 +781,8 @@ class H5Content:
                 analog_group = data['AnalogStream']
                 analog_keys = analog_group.keys()
                 for key in analog_keys:
-                    self.analogs.append(AnalogStream(analog_group, key))
+                    self.analogs.append(
+                        AnalogStream(analog_group, key, access, memmap))
 
             else:
                 self.analogs = None
@@ -212,6 +818,38 @@ class H5Content:
         else:
             return None
 
+    def get_signal(self, stream: int, channel_label: int,
+                   t_start: Optional[float] = None,
+                   t_stop: Optional[float] = None,
+                   dtype: np.dtype = np.float64) -> np.ndarray:
+        """
+        Read the converted signal of a channel in the time range
+        [T_START, T_STOP) seconds, reading from the file only those samples.
+        @param [in] stream: the index of the analog stream
+        @param [in] channel_label: the label of the channel
+        @param [in] t_start: None means the beginning of the recording
+        @param [in] t_stop: None means the end of the recording
+        @param [in] dtype: np.float64 or np.float32
+        @returns the signal as a column array
+        """
+        return self.analogs[stream].parse_signal(channel_label, t_start,
+                                                 t_stop, dtype)
+
+    def close(self):
+        """
+        Give back the file to H5_FILES. The streams should not be used after
+        closing the content.
+        """
+        if self.path is not None:
+            H5_FILES.release(self.path)
+            self.path = None
+
+    def __enter__(self) -> 'H5Content':
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
     def __str__(self):
         return f'''
 AnalogStreams: {len(self.analogs)}
@@ -0,0 +1,326 @@
+"""PyCode index of the phase files.
+
+This file contains the PhaseIndex, a sidecar SQLite database with the
+metadata of the HDF5 phase files of a directory tree, so that they can be
+browsed and queried without opening every file. Only the files that changed
+since the last scan are opened again.
+"""
+
+import sqlite3
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence
+
+from h5py import File  # type: ignore
+
+from .experiment import PhaseInfo
+
+# name of the index database, in the root of the indexed directory
+INDEX_FILENAME = '.pycode_index.sqlite'
+
+# the columns of the index, after the path of the file relative to the root
+_COLUMNS = [
+    ('name', 'TEXT'),
+    ('div', 'INTEGER'),
+    ('phase_type', 'TEXT'),
+    ('phase_order', 'INTEGER'),
+    ('digital', 'INTEGER'),
+    ('other', 'TEXT'),
+    ('analog_streams', 'INTEGER'),
+    ('channels', 'INTEGER'),
+    ('sampling_frequency', 'REAL'),
+    ('durate', 'REAL'),
+    ('spikes', 'INTEGER'),
+    ('mtime', 'REAL'),
+    ('size', 'INTEGER'),
+    ('error', 'TEXT'),
+]
+
+
+class PhaseRecord:
+    """
+    The metadata of a phase file as stored in the index:
+    - path: the absolute path of the file
+    - name, div, phase_type, order, digital, other: as parsed by PhaseInfo
+    - analog_streams: the number of AnalogStreams
+    - channels: the number of channels of the last AnalogStream
+    - sampling_frequency: of the last AnalogStream
+    - durate: the duration in seconds of the recording
+    - spikes: the number of time stamps of the first TimeStampStream
+    - mtime, size: of the file when it was scanned
+    - error: why the file could not be scanned, None if it was
+    Fields that could not be known are None.
+    """
+
+    def __init__(self, path: Path, values: Dict[str, Any]):
+        self.path = path
+        self.name: Optional[str] = values['name']
+        self.div: Optional[int] = values['div']
+        self.phase_type: Optional[str] = values['phase_type']
+        self.order: Optional[int] = values['phase_order']
+        self.digital: Optional[bool] = None if values['digital'] is None \
+            else bool(values['digital'])
+        self.other: Optional[str] = values['other']
+        self.analog_streams: Optional[int] = values['analog_streams']
+        self.channels: Optional[int] = values['channels']
+        self.sampling_frequency: Optional[float] = \
+            values['sampling_frequency']
+        self.durate: Optional[float] = values['durate']
+        self.spikes: Optional[int] = values['spikes']
+        self.mtime: float = values['mtime']
+        self.size: int = values['size']
+        self.error: Optional[str] = values['error']
+
+    def phase_info(self) -> PhaseInfo:
+        """@returns the PhaseInfo of the file, without parsing its name"""
+        info = PhaseInfo()
+        info.name = self.name
+        info.div = self.div
+        info.phase_type = self.phase_type
+        info.digital = self.digital
+        info.order = self.order
+        info.other = self.other
+        if self.sampling_frequency is not None:
+            info.set_sampling_frequency(self.sampling_frequency)
+        return info
+
+    def __str__(self):
+        return f'''
+File:                   {self.path.name}
+Name:                   {self.name}
+DIV:                    {self.div}
+Type:                   {self.phase_type}
+Order:                  {self.order}
+Channels:               {self.channels}
+Sampling frequency:     {self.sampling_frequency} Hz
+Durate:                 {self.durate} seconds
+Spikes:                 {self.spikes}
+        '''
+
+
+def scan_phase_file(path: Path) -> Dict[str, Any]:
+    """
+    Collect the metadata of a phase file: the name is parsed with
+    PhaseInfo.default_parse and only the metadata of the datasets are read
+    from the file (no signal nor time stamp).
+    @param [in] path: the path of the HDF5 file
+    @returns a map {column -> value} with the columns of the index
+    """
+    info = PhaseInfo().default_parse(path)
+    stat = path.stat()
+    values: Dict[str, Any] = {
+        'name': getattr(info, 'name', None),
+        'div': getattr(info, 'div', None),
+        'phase_type': getattr(info, 'phase_type', None),
+        'phase_order': getattr(info, 'order', None),
+        'digital': getattr(info, 'digital', None),
+        'other': getattr(info, 'other', None),
+        'analog_streams': None,
+        'channels': None,
+        'sampling_frequency': None,
+        'durate': None,
+        'spikes': None,
+        'mtime': stat.st_mtime,
+        'size': stat.st_size,
+        'error': None,
+    }
+    try:
+        # the file is not kept open in H5_FILES, it's unlikely to be read
+        # again soon
+        with File(path, 'r') as h5file:
+            data = h5file['/Data/Recording_0']
+            if 'AnalogStream' in data:
+                analogs = data['AnalogStream']
+                values['analog_streams'] = len(analogs)
+                stream = analogs[f'Stream_{len(analogs) - 1}']
+                InfoChannel = stream['InfoChannel']
+                values['channels'] = InfoChannel.shape[0]
+                if InfoChannel.shape[0] > 0:
+                    # the tick is in microseconds
+                    tick = float(InfoChannel[0][9])
+                    values['sampling_frequency'] = 1e6 / tick
+                    values['durate'] = \
+                        stream['ChannelData'].shape[1] * tick / 1e6
+            if 'TimeStampStream/Stream_0' in data:
+                time_stamps = data['TimeStampStream/Stream_0']
+                values['spikes'] = sum(
+                    time_stamps[key].size for key in time_stamps
+                    if key.startswith('TimeStampEntity_'))
+    except Exception as e:
+        values['error'] = str(e)
+    return values
+
+
+class PhaseIndex:
+    """
+    Index of the phase files (*.h5) of a directory tree, stored in ROOT in an
+    SQLite database. The paths are stored relative to ROOT, so the directory
+    can be moved with its index.
+
+    with PhaseIndex(Path('experiments')) as index:
+        index.update()
+        for record in index.find(phase_type='Stim', min_div=41):
+            print(record.path, record.spikes)
+    """
+
+    def __init__(self, root: Path, index_path: Optional[Path] = None):
+        """
+        @param [in] root: the indexed directory
+        @param [in] index_path: where the database is, ROOT/INDEX_FILENAME if
+                                None
+        """
+        self.root = Path(root).absolute()
+        self.index_path = self.root.joinpath(INDEX_FILENAME) \
+            if index_path is None else Path(index_path)
+        self.connection = sqlite3.connect(self.index_path)
+        self.connection.row_factory = sqlite3.Row
+        columns = ', '.join(f'{name} {kind}' for name, kind in _COLUMNS)
+        try:
+            with self.connection:
+                self.connection.execute(
+                    f'CREATE TABLE IF NOT EXISTS phases '
+                    f'(path TEXT PRIMARY KEY, {columns})')
+        except sqlite3.Error:
+            self.connection.close()
+            raise
+
+    def _relative(self, path: Path) -> str:
+        return Path(path).absolute().relative_to(self.root).as_posix()
+
+    def _store(self, relative_path: str, values: Dict[str, Any]):
+        names = ['path'] + [name for name, _ in _COLUMNS]
+        self.connection.execute(
+            f'INSERT OR REPLACE INTO phases ({", ".join(names)}) '
+            f'VALUES ({", ".join("?" * len(names))})',
+            [relative_path] + [values[name] for name, _ in _COLUMNS])
+
+    def _is_stale(self, path: Path, row: Optional[sqlite3.Row]) -> bool:
+        if row is None:
+            return True
+        stat = path.stat()
+        return row['mtime'] != stat.st_mtime or row['size'] != stat.st_size
+
+    def update(self) -> int:
+        """
+        Scan the new and changed phase files under the root and forget the
+        deleted ones.
+        @returns the number of scanned files
+        """
+        rows = {row['path']: row for row in
+                self.connection.execute('SELECT * FROM phases')}
+        scanned = 0
+        found = set()
+        with self.connection:
+            for path in sorted(self.root.rglob('*.h5')):
+                relative_path = self._relative(path)
+                found.add(relative_path)
+                if self._is_stale(path, rows.get(relative_path)):
+                    self._store(relative_path, scan_phase_file(path))
+                    scanned += 1
+            for relative_path in set(rows) - found:
+                self.connection.execute('DELETE FROM phases WHERE path = ?',
+                                        (relative_path,))
+        return scanned
+
+    def get(self, path: Path) -> Optional[PhaseRecord]:
+        """
+        Get the record of a phase file under the root, scanning it if it is
+        not indexed or if it changed.
+        @returns the record, None if the file does not exists or it's not an
+                 *.h5 file
+        """
+        path = Path(path).absolute()
+        if path.suffix != '.h5' or not path.is_file():
+            return None
+        relative_path = self._relative(path)
+        row = self.connection.execute('SELECT * FROM phases WHERE path = ?',
+                                      (relative_path,)).fetchone()
+        if self._is_stale(path, row):
+            with self.connection:
+                self._store(relative_path, scan_phase_file(path))
+            row = self.connection.execute(
+                'SELECT * FROM phases WHERE path = ?',
+                (relative_path,)).fetchone()
+        return self._record(row)
+
+    def query(self, where: str = '', parameters: Sequence[Any] = ()
+              ) -> List[PhaseRecord]:
+        """
+        Select the indexed files with an SQL condition on the columns of the
+        index (path, name, div, phase_type, phase_order, digital, other,
+        analog_streams, channels, sampling_frequency, durate, spikes, mtime,
+        size, error), i.e.:
+
+        index.query('phase_type = ? AND div > ?', ('Stim', 40))
+
+        @param [in] where: the condition, all the files if empty
+        @param [in] parameters: the values of the ? placeholders of WHERE
+        @returns the records ordered by path
+        """
+        condition = f'WHERE {where}' if where else ''
+        return [self._record(row) for row in self.connection.execute(
+            f'SELECT * FROM phases {condition} ORDER BY path', parameters)]
+
+    def find(self, name: Optional[str] = None,
+             phase_type: Optional[str] = None,
+             min_div: Optional[int] = None,
+             max_div: Optional[int] = None,
+             digital: Optional[bool] = None) -> List[PhaseRecord]:
+        """
+        Select the indexed files matching all the given fields.
+        @param [in] name: the colture id
+        @param [in] phase_type: compared ignoring the case
+        @param [in] min_div: the minimum DIV (included)
+        @param [in] max_div: the maximum DIV (included)
+        @param [in] digital: if the phases have a digital signal or not
+        @returns the records ordered by path
+        """
+        conditions: List[str] = []
+        parameters: List[Any] = []
+        for condition, value in [('name = ?', name),
+                                 ('UPPER(phase_type) = UPPER(?)', phase_type),
+                                 ('div >= ?', min_div),
+                                 ('div <= ?', max_div),
+                                 ('digital = ?', digital)]:
+            if value is not None:
+                conditions.append(condition)
+                parameters.append(value)
+        return self.query(' AND '.join(conditions), parameters)
+
+    def _record(self, row: sqlite3.Row) -> PhaseRecord:
+        return PhaseRecord(self.root.joinpath(row['path']), dict(row))
+
+    def __len__(self) -> int:
+        return self.connection.execute(
+            'SELECT COUNT(*) FROM phases').fetchone()[0]
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self) -> 'PhaseIndex':
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def phase_record(path: Path) -> Optional[PhaseRecord]:
+    """
+    Get the record of a phase file from the nearest index among its parent
+    directories, without creating one. If there is no index, or it can't be
+    opened or written (i.e. in a read-only directory), the file is scanned
+    without storing its record.
+    @param [in] path: the path of the HDF5 file
+    @returns the record, None if the file does not exists or it's not an
+             *.h5 file
+    """
+    path = Path(path).absolute()
+    if path.suffix != '.h5' or not path.is_file():
+        return None
+    for root in path.parents:
+        if root.joinpath(INDEX_FILENAME).is_file():
+            try:
+                with PhaseIndex(root) as index:
+                    return index.get(path)
+            except sqlite3.Error:
+                break
+    return PhaseRecord(path, scan_phase_file(path))
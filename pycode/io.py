@@ -7,15 +7,26 @@ This file contains a collection of functions for reading or writing the
 experiment structures to file.
 """
 
+import json
+from concurrent.futures import (FIRST_COMPLETED, ProcessPoolExecutor,
+                                ThreadPoolExecutor, wait)
+from functools import partial
+from multiprocessing import get_context
 from pathlib import Path
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Sequence, Tuple, Union
 
 import numpy as np
 from h5py import File
 from scipy.io import loadmat
 
-from .experiment import Experiment, Phase, PhaseInfo, Signal
-from .utils import make_row
+from .experiment import (DigitalSignal, Experiment, LazyPhases, Phase,
+                         PhaseInfo, PhaseProxy, Signal, SpikeTrains)
+from .hdf5 import (H5_FILES, ContiguousLayout, aligned_block_size,
+                   contiguous_layout, convert_mantissas, map_layout,
+                   open_dataset, read_rows, read_time_stamps,
+                   time_to_samples)
+from .operation import (DetectedSpikes, SpikeDetectionParams,
+                        detect_spikes, detect_spikes_chunked)
 
 
 ###############################################################################
@@ -71,7 +82,8 @@ def load_experiment_from_mat(filename: Path) -> Experiment:
                 except Exception:
                     peaks[el[0][0][0]] = np.array([])
             if phase["digital"][0][0].shape[0] > 1:
-                digital = Signal(phase["digital"][0][0], 10e3)
+                digital = DigitalSignal.from_dense(phase["digital"][0][0],
+                                                   10e3)
             else:
                 digital = None
             # here i set a default sampling frequency of 10 KHz and a duration
@@ -114,7 +126,10 @@ def load_experiment_from_mat(filename: Path) -> Experiment:
 
 
 def load_raw_signal_from_hdf5(filename: Path, electrode_index: int,
-                              debug: bool = False) -> np.ndarray:
+                              debug: bool = False,
+                              dtype: np.dtype = np.float64,
+                              t_start: Optional[float] = None,
+                              t_stop: Optional[float] = None) -> np.ndarray:
     """
     Load and convert a raw signal acquired with Multichannel Systems
     instrumentation.
@@ -122,68 +137,140 @@ def load_raw_signal_from_hdf5(filename: Path, electrode_index: int,
     @param [in] electrode_index: the index of the electrode
     TODO convert it into the label of the electrode
     @param [in] debug: debug flag (prints the InfoChannel fields if True)
+    @param [in] dtype: np.float64 or np.float32
+    @param [in] t_start: in seconds, if given only the samples from here are
+                         read
+    @param [in] t_stop: in seconds, if given only the samples before here are
+                        read
     @returns an array with the recorded voltages values
-    """
-
-    h5file = File(filename.absolute(), 'r')
-
-    # get the last stream if the AnalogStream level, the previous ones may be
-    # some recorded trigger events
-    last_stream = len(h5file['/Data/Recording_0/AnalogStream'].keys()) - 1
-
-    InfoChannel = h5file[('/Data/Recording_0/AnalogStream/'
-                         f'Stream_{last_stream}/InfoChannel')]
-    print(InfoChannel[electrode_index]) if debug else None
 
-    ChannelData = h5file[('/Data/Recording_0/AnalogStream/'
-                         f'Stream_{last_stream}/ChannelData')]
-
-    # here all the parameter for converting the ADC values to the actual
-    # voltage are got from the InfoChannel struct
-    ADC_offset = InfoChannel[electrode_index][8]
-    conversion_factor = InfoChannel[electrode_index][10]
-    SCALING_FROM_VOLT_TO_MILLIVOLT = 6
-    exponent = InfoChannel[electrode_index][7] + SCALING_FROM_VOLT_TO_MILLIVOLT
-    mantissas = np.expand_dims(ChannelData[electrode_index][:], 1)
+    To load more electrodes use load_raw_signals_from_hdf5, that opens the
+    file and reads them only once.
+    """
 
-    converted_data = (mantissas-np.ones(shape=mantissas.shape)*ADC_offset) *\
-        conversion_factor * np.power(10., exponent)
+    data, _ = load_raw_signals_from_hdf5(filename, [electrode_index], dtype,
+                                         t_start, t_stop, debug)
+    return data
 
-    return make_row(converted_data)
 
+def load_raw_signals_from_hdf5(filename: Path,
+                               electrodes: Union[Sequence[int], str] = 'all',
+                               dtype: np.dtype = np.float64,
+                               t_start: Optional[float] = None,
+                               t_stop: Optional[float] = None,
+                               debug: bool = False
+                               ) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Load and convert the raw signals of some electrodes acquired with
+    Multichannel Systems instrumentation. The file and its InfoChannel are
+    read once, the consecutive rows of ChannelData are read with a single
+    hyperslab and all the rows are converted as a block.
+    @param [in] filename: the path of the raw file
+    @param [in] electrodes: the indices of the electrodes or 'all'
+    @param [in] dtype: np.float64 or np.float32
+    @param [in] t_start: in seconds, if given only the samples from here are
+                         read
+    @param [in] t_stop: in seconds, if given only the samples before here are
+                        read
+    @param [in] debug: debug flag (prints the InfoChannel fields if True)
+    @returns a couple (data, labels): the (electrodes x samples) array of the
+             recorded voltages values and the label of the electrode of each
+             row
+    """
 
-def load_peaks_from_hdf5(data) -> Dict[int, np.ndarray]:
+    with H5_FILES.borrow(filename) as h5file:
+        # get the last stream if the AnalogStream level, the previous ones
+        # may be some recorded trigger events
+        analogs = h5file['/Data/Recording_0/AnalogStream']
+        stream = analogs[f'Stream_{len(analogs.keys()) - 1}']
+        InfoChannel = stream['InfoChannel'][()]
+        ChannelData = open_dataset(stream, 'ChannelData', 'by_time')
+
+        if isinstance(electrodes, str):
+            assert electrodes == 'all', "electrodes should be a list or 'all'"
+            electrodes = range(len(InfoChannel))
+        rows = [int(electrode) for electrode in electrodes]
+        infos = InfoChannel[rows]
+        for info in infos:
+            print(info) if debug else None
+
+        fields = InfoChannel.dtype.names
+        labels = infos[fields[4]].astype(np.int64)
+
+        # here all the parameter for converting the ADC values to the actual
+        # voltage are got from the InfoChannel struct, as columns to be
+        # broadcasted on the rows
+        ADC_offsets = infos[fields[8]][:, None]
+        conversion_factors = infos[fields[10]][:, None]
+        SCALING_FROM_VOLT_TO_MILLIVOLT = 6
+        exponents = infos[fields[7]][:, None] + SCALING_FROM_VOLT_TO_MILLIVOLT
+
+        # the ADC values are read directly in the returned array and converted
+        # in place
+        start, stop = time_to_samples(InfoChannel[0][9], ChannelData.shape[1],
+                                      t_start, t_stop)
+        converted_data = np.empty((len(rows), stop - start), dtype=dtype)
+        read_rows(ChannelData, rows, converted_data, start, stop)
+        return convert_mantissas(converted_data, ADC_offsets,
+                                 conversion_factors, exponents), labels
+
+
+def load_peaks_from_hdf5(data, workers: int = 1) -> Dict[int, np.ndarray]:
     """
     Load the peaks event times for each electrode
     Meant to be used only from load_phase_from_hdf5 function
     @param [in] data: the HDF5 data struct
-    @returns a map {electrode_index -> array of times}
+    @param [in] workers: number of threads reading the TimeStampEntities
+    @returns a map {electrode_index -> array of times}, the arrays are views
+             of a single buffer (see read_time_stamps)
     """
-    InfoTimeStamp = data['InfoTimeStamp']
-
-    indices = []
-    map: Dict[int, int] = {}
-    # here we construct a map from the position of an electrode in the array
-    # and its actual name (label)
-    for el in InfoTimeStamp[:]:
-        indices.append(el[0])
-        map[el[0]] = el[2]
-
-    ret: Dict[int, np.ndarray] = {}
+    events = read_time_stamps(data, workers)
+    InfoTimeStamp = data['InfoTimeStamp'][()]
+    # here we map the position of an electrode in the array to its actual
+    # name (label)
+    labels = InfoTimeStamp[InfoTimeStamp.dtype.names[2]].tolist()
+    return dict(zip(labels, events.split()))
 
-    for entry in data.keys():
-        if entry.startswith('TimeStampEntity_'):
-            index = int(entry[16:])
-            ret[map[index]] = np.array(data[f'TimeStampEntity_{index}'])[0]
 
-    return ret
-
-
-def load_digital_from_hdf5(data) -> Signal:
+def load_spike_trains_from_hdf5(data, sampling_frequency: float,
+                                workers: int = 1) -> SpikeTrains:
     """
-    Extract the digital signal from an hdf5 file.
+    Load the peaks of every electrode as SpikeTrains: the time stamps are
+    read in a single buffer (see read_time_stamps) and converted in sample
+    indices at once.
     Meant to be used only from load_phase_from_hdf5 function
     @param [in] data: the HDF5 data struct
+    @param [in] sampling_frequency: of the samples indices
+    @param [in] workers: number of threads reading the TimeStampEntities
+    @returns the SpikeTrains, labeled with the electrodes labels
+    """
+    events = read_time_stamps(data, workers, in_seconds=True)
+    InfoTimeStamp = data['InfoTimeStamp'][()]
+    labels = InfoTimeStamp[InfoTimeStamp.dtype.names[2]].astype(np.int64)
+    indices = np.rint(events.values * sampling_frequency).astype(np.int64)
+    # the time stamps of each entity should already be sorted, the buffer is
+    # rebuilt only if some are not
+    decreasing = np.diff(indices) < 0
+    boundaries = events.offsets[1:-1]
+    decreasing[boundaries[(boundaries > 0) &
+                          (boundaries < len(indices))] - 1] = False
+    if np.any(decreasing):
+        return SpikeTrains.from_trains(
+            labels, [indices[a:b] for a, b in
+                     zip(events.offsets[:-1], events.offsets[1:])],
+            sampling_frequency)
+    return SpikeTrains(indices, events.offsets, labels, sampling_frequency)
+
+
+def load_digital_from_hdf5(data, block_size: int = 1 << 20
+                           ) -> DigitalSignal:
+    """
+    Extract the digital signal from an hdf5 file.
+    Meant to be used only from load_phase_from_hdf5 function. The signal is
+    read in blocks of BLOCK_SIZE samples and only its transitions are kept
+    (see DigitalSignal): the samples greater than its minimum are ON.
+    @param [in] data: the HDF5 data struct
+    @param [in] block_size: the number of samples read at once
     @returns the digital Signal
     """
 
@@ -192,15 +279,40 @@ def load_digital_from_hdf5(data) -> Signal:
     sampling_frequency: float = 1e6 / \
         InfoChannel[data_index][9]  # TODO check correct index
 
-    ChannelData = data['ChannelData']
-    signal_data = ChannelData[data_index]
-    signal_data -= np.min(signal_data)
-
-    return Signal(signal_data, sampling_frequency)
+    ChannelData = open_dataset(data, 'ChannelData', 'by_channel')
+    n_samples = ChannelData.shape[1]
+    if n_samples == 0:
+        return DigitalSignal(np.zeros(0, dtype=np.int64), 0,
+                             sampling_frequency)
+    block_size = aligned_block_size(ChannelData, block_size)
+    buffer = np.empty((1, min(block_size, n_samples)), dtype=ChannelData.dtype)
+    # run-length encode the signal block by block, a run can span more blocks
+    starts: List[np.ndarray] = []
+    values: List[np.ndarray] = []
+    for start in range(0, n_samples, block_size):
+        stop = min(start + block_size, n_samples)
+        block = read_rows(ChannelData, [data_index],
+                          buffer[:, :stop - start], start, stop)[0]
+        runs = np.flatnonzero(np.diff(block)) + 1
+        if start == 0 or block[0] != last:
+            runs = np.concatenate(([0], runs))
+        starts.append(runs + start)
+        values.append(block[runs])
+        last = block[-1]
+    run_starts = np.concatenate(starts)
+    run_values = np.concatenate(values)
+    low = run_values.min()
+    on = run_values > low
+    # the ON runs boundaries among the runs, then in samples
+    edges = np.flatnonzero(np.diff(on.view(np.int8), prepend=0, append=0))
+    high = run_values[on].max() - low if len(edges) > 0 else 1
+    return DigitalSignal(np.append(run_starts, n_samples)[edges], n_samples,
+                         sampling_frequency, high)
 
 
 def load_phase_from_hdf5(filename: Path,
-                         info: Optional[PhaseInfo] = None) -> Phase:
+                         info: Optional[PhaseInfo] = None,
+                         workers: int = 1) -> Phase:
     """
     Build a Phase instance from an HDF5 file and some metadata.
     @param [in] filename: the path of the HDF5 file
@@ -209,6 +321,7 @@ def load_phase_from_hdf5(filename: Path,
                       PhaseInfo for the details. This, however does not
                       prevent from using the default parsing and adding
                       information to it.
+    @param [in] workers: number of threads reading the peaks
     @returns a Phase instance
 
     An example of customizing the default parsing could be:
@@ -223,33 +336,55 @@ def load_phase_from_hdf5(filename: Path,
     else:
         info = PhaseInfo().default_parse(Path(filename))
 
-    data = File(filename)['/Data/Recording_0']
+    with H5_FILES.borrow(filename) as h5file:
+        data = h5file['/Data/Recording_0']
 
-    # checks if the data has a digital signal and the phase info too
-    if info.digital and len(data['AnalogStream']) == 1:
-        raise Exception("info.digital is True but the phase does not contain"
-                        " two Analog Streams")
-    digital = load_digital_from_hdf5(
-        data['AnalogStream/Stream_0/']) if info.digital\
-        else None
+        # checks if the data has a digital signal and the phase info too
+        if info.digital and len(data['AnalogStream']) == 1:
+            raise Exception("info.digital is True but the phase does not "
+                            "contain two Analog Streams")
+        digital = load_digital_from_hdf5(
+            data['AnalogStream/Stream_0/']) if info.digital\
+            else None
 
-    return Phase(info.name,
-                 peaks=load_peaks_from_hdf5(
-                     data['TimeStampStream/Stream_0']),
-                 digital=digital,
-                 sampling_frequency=info.sampling_frequency,
-                 durate=0,  # info.durate, # TODO compute durate from hdf5
-                 )
+        return Phase(info.name,
+                     peaks=load_spike_trains_from_hdf5(
+                         data['TimeStampStream/Stream_0'],
+                         info.sampling_frequency, workers),
+                     digital=digital,
+                     sampling_frequency=info.sampling_frequency,
+                     durate=0,  # info.durate, # TODO compute durate from hdf5
+                     )
 
 
 def load_experiment_from_hdf5_files(path_list: List[Path],
                                     info_list: Optional[Dict[Path, PhaseInfo]]
-                                    = None) -> Experiment:
+                                    = None,
+                                    workers: int = 1,
+                                    executor: str = 'process',
+                                    errors: Optional[Dict[Path, Exception]]
+                                    = None,
+                                    lazy: bool = False,
+                                    max_bytes: Optional[int] = None
+                                    ) -> Experiment:
     """
     Build an experiment instance from a list of files that contain its phases.
     @param [in] path_list: list of path of the phases files
     @param [in] info_list: map from a file path to it's phase's info
-    @returns the converted experiment
+    @param [in] workers: number of phases loaded concurrently. With 1 they are
+                         loaded one after the other in this process
+    @param [in] executor: 'process' or 'thread', the kind of pool used with
+                          more workers. h5py serializes its calls inside a
+                          process, so only processes overlap the reads
+    @param [out] errors: if given, it's filled with the exception raised by
+                         each file that could not be loaded
+    @param [in] lazy: if True the phases are loaded when first accessed (see
+                      LazyPhases), only the missing files are skipped and
+                      WORKERS is ignored
+    @param [in] max_bytes: the memory budget of the lazily loaded phases
+    @returns the converted experiment, with the phases in the order of
+             PATH_LIST. The files that could not be loaded are reported and
+             skipped
 
     A possible usage is to get all h5 files from a directory and, if the names
     respect the naming convention, let the default parse get the metadata:
@@ -265,11 +400,450 @@ def load_experiment_from_hdf5_files(path_list: List[Path],
     exp = load_experiment_from_hdf5_files(path_list)
     """
 
-    phases = []
-    for path in path_list:
-        if not path.exists():
-            raise (f'ERROR: load_experiment_from_hdf5_files. Some {path} does'
-                   'not exists')
-        phases.append(load_phase_from_hdf5(
-            path,
-            info_list[Path] if info_list is not None else None))
+    assert executor in ['process', 'thread'], \
+        "executor should be 'process' or 'thread'"
+    infos = [info_list.get(path) if info_list is not None else None
+             for path in path_list]
+    if lazy:
+        return _lazy_experiment(path_list, infos, errors, max_bytes)
+
+    results: List[Optional[Phase]] = [None] * len(path_list)
+    failures: Dict[Path, Exception] = {}
+    if workers <= 1:
+        for i, (path, info) in enumerate(zip(path_list, infos)):
+            try:
+                results[i] = _load_existing_phase(path, info)
+            except Exception as e:
+                failures[path] = e
+    else:
+        # HDF5 is not fork safe and this process may have files open (i.e. in
+        # H5_FILES), so the processes are spawned
+        pool = ProcessPoolExecutor(max_workers=workers,
+                                   mp_context=get_context('spawn')) \
+            if executor == 'process' \
+            else ThreadPoolExecutor(max_workers=workers)
+        with pool:
+            futures = [pool.submit(_load_existing_phase, path, info)
+                       for path, info in zip(path_list, infos)]
+            for i, future in enumerate(futures):
+                try:
+                    results[i] = future.result()
+                except Exception as e:
+                    failures[path_list[i]] = e
+
+    for path, e in failures.items():
+        print(f'ERROR: load_experiment_from_hdf5_files, {path} could not be '
+              'loaded', e.args)
+    if errors is not None:
+        errors.update(failures)
+
+    phases = [phase for phase in results if phase is not None]
+    name = phases[0].name if len(phases) > 0 else ''
+    path = str(Path(path_list[0]).parent) if len(path_list) > 0 else ''
+    return Experiment(name, path, '', phases)
+
+
+def _lazy_experiment(path_list: List[Path], infos: List[Optional[PhaseInfo]],
+                     errors: Optional[Dict[Path, Exception]],
+                     max_bytes: Optional[int]) -> Experiment:
+    """
+    load_experiment_from_hdf5_files with lazy loading, the name of the
+    experiment is taken from the PhaseInfo of the first file.
+    """
+    existing = []
+    for path, info in zip(path_list, infos):
+        if Path(path).exists():
+            existing.append((Path(path), info))
+        else:
+            print(f'ERROR: load_experiment_from_hdf5_files, {path} does not '
+                  'exists')
+            if errors is not None:
+                errors[path] = FileNotFoundError(f'{path} does not exists')
+
+    name = ''
+    if len(existing) > 0:
+        path, info = existing[0]
+        name = info.name if info is not None \
+            else PhaseInfo().default_parse(path).name
+    path = str(Path(path_list[0]).parent) if len(path_list) > 0 else ''
+    return Experiment(name, path, '',
+                      LazyPhases(partial(_load_listed_phase, existing),
+                                 len(existing), max_bytes))
+
+
+def _load_listed_phase(phases: List[Tuple[Path, Optional[PhaseInfo]]],
+                       index: int) -> Phase:
+    """Loader of the LazyPhases of _lazy_experiment."""
+    return load_phase_from_hdf5(*phases[index])
+
+
+def _load_existing_phase(path: Path, info: Optional[PhaseInfo]) -> Phase:
+    """
+    Worker of load_experiment_from_hdf5_files. It's a module level function so
+    that it can be sent to the processes of the pool.
+    """
+    if not Path(path).exists():
+        raise FileNotFoundError(f'{path} does not exists')
+    return load_phase_from_hdf5(Path(path), info)
+
+
+###############################################################################
+#
+#                       SPIKE DETECTION FROM HDF5 FILES
+#
+###############################################################################
+
+
+def _detect_channel(label: int, data: np.ndarray, sampling_frequency: float,
+                    params: SpikeDetectionParams
+                    ) -> Tuple[int, DetectedSpikes]:
+    """
+    Worker of detect_phase. It's a module level function so that it can be
+    sent to the processes of the pool.
+    """
+    return label, detect_spikes(data, sampling_frequency, params)
+
+
+def _read_converted_row(source, info_channel: np.void,
+                        n_samples: int) -> np.ndarray:
+    """
+    Read and convert a row of ChannelData, same conversion of
+    load_raw_signal_from_hdf5.
+    @param [in] source: the ChannelData Dataset or its memory map
+    @param [in] info_channel: the InfoChannel entry of the row
+    @param [in] n_samples: the number of samples of the row
+    @returns a (1 x N_SAMPLES) array
+    """
+    SCALING_FROM_VOLT_TO_MILLIVOLT = 6
+    converted_data = np.empty((1, n_samples))
+    if isinstance(source, np.ndarray):
+        converted_data[0] = source[int(info_channel[1])]
+    else:
+        read_rows(source, [int(info_channel[1])], converted_data)
+    return convert_mantissas(converted_data, info_channel[8],
+                             info_channel[10],
+                             info_channel[7] + SCALING_FROM_VOLT_TO_MILLIVOLT)
+
+
+def _detect_mapped_channel(layout: ContiguousLayout, info_channel: np.void,
+                           sampling_frequency: float,
+                           params: SpikeDetectionParams
+                           ) -> Tuple[int, DetectedSpikes]:
+    """
+    Worker of detect_phase for contiguous ChannelData: the row is read from
+    the memory mapped file, sharing the page cache with the other workers.
+    """
+    converted_data = _read_converted_row(map_layout(layout), info_channel,
+                                         layout[3][1])
+    return int(info_channel[4]), detect_spikes(converted_data,
+                                               sampling_frequency, params)
+
+
+def detect_phase(h5_path: Path,
+                 params: Optional[SpikeDetectionParams] = None,
+                 workers: int = 1,
+                 info: Optional[PhaseInfo] = None) -> Phase:
+    """
+    Build a Phase running the spike detection on every electrode of the raw
+    recording contained in an HDF5 file.
+    @param [in] h5_path: the path of the HDF5 file
+    @param [in] params: the spike detection parameters, SpyCode ones if None
+    @param [in] workers: number of processes the electrodes are distributed
+                         on. With 1 the detection runs in this process
+    @param [in] info: a custom PhaseInfo (see load_phase_from_hdf5)
+    @returns a Phase whose spikes (the sample indices of the peaks) and
+             amplitudes cover every electrode label of the last AnalogStream
+             of the file
+
+    The file is opened only once: the rows of ChannelData are read and
+    converted here and only the converted rows are sent to the workers. If
+    ChannelData is contiguous and uncompressed the workers memory map the
+    file and read their rows by themselves instead.
+    """
+
+    if params is None:
+        params = SpikeDetectionParams()
+    if info is None:
+        info = PhaseInfo().default_parse(Path(h5_path))
+
+    with H5_FILES.borrow(h5_path) as h5file:
+        data = h5file['/Data/Recording_0']
+        analogs = data['AnalogStream']
+        # the last stream is the one with the electrodes, the previous ones
+        # may be some recorded trigger events
+        stream = analogs[f'Stream_{len(analogs.keys()) - 1}']
+        InfoChannel = stream['InfoChannel'][:]
+        # the rows are read one at a time
+        ChannelData = open_dataset(stream, 'ChannelData', 'by_channel')
+        n_samples = ChannelData.shape[1]
+        sampling_frequency = 1e6 / InfoChannel[0][9]
+
+        layout = contiguous_layout(ChannelData)
+        source = ChannelData if layout is None else map_layout(layout)
+
+        def channels():
+            for info_channel in InfoChannel:
+                # each row gets its own buffer since it could still be waiting
+                # to be sent to a worker
+                yield int(info_channel[4]), _read_converted_row(
+                    source, info_channel, n_samples)
+
+        # HDF5 is not fork safe and the file is open here, so the processes
+        # are spawned
+        spikes: Dict[int, DetectedSpikes] = {}
+        if workers <= 1:
+            for label, converted_data in channels():
+                spikes[label] = detect_spikes(converted_data,
+                                              sampling_frequency, params)
+        elif layout is not None:
+            with ProcessPoolExecutor(max_workers=workers,
+                                     mp_context=get_context('spawn')) as pool:
+                futures = [pool.submit(_detect_mapped_channel, layout,
+                                       info_channel, sampling_frequency,
+                                       params)
+                           for info_channel in InfoChannel]
+                for future in futures:
+                    label, detected = future.result()
+                    spikes[label] = detected
+        else:
+            with ProcessPoolExecutor(max_workers=workers,
+                                     mp_context=get_context('spawn')) as pool:
+                # no more than two rows per worker are kept in memory
+                pending = set()
+                for label, converted_data in channels():
+                    if len(pending) >= 2 * workers:
+                        done, pending = wait(pending,
+                                             return_when=FIRST_COMPLETED)
+                        for future in done:
+                            label_, detected = future.result()
+                            spikes[label_] = detected
+                    pending.add(pool.submit(_detect_channel, label,
+                                            converted_data,
+                                            sampling_frequency, params))
+                for future in pending:
+                    label_, detected = future.result()
+                    spikes[label_] = detected
+
+        digital = load_digital_from_hdf5(data['AnalogStream/Stream_0/'])\
+            if info.digital and len(analogs) > 1 else None
+
+    labels = sorted(spikes.keys())
+    phase = Phase(info.name,
+                  peaks=SpikeTrains.from_trains(
+                      labels, [spikes[label].indices for label in labels],
+                      sampling_frequency,
+                      [spikes[label].amplitudes for label in labels]),
+                  digital=digital,
+                  sampling_frequency=sampling_frequency,
+                  durate=n_samples / sampling_frequency)
+    phase.div = info.div
+    phase.phase_type = info.phase_type
+    phase.order = info.order
+    return phase
+
+
+def detect_spikes_from_hdf5(filename: Path,
+                            electrode_index: int,
+                            params: Optional[SpikeDetectionParams] = None,
+                            chunk_size: int = 1 << 20) -> DetectedSpikes:
+    """
+    Run the spike detection on an electrode of a raw recording reading it in
+    hyperslabs of CHUNK_SIZE samples (see detect_spikes_chunked), so that
+    also recordings that does not fit in memory can be processed.
+    @param [in] filename: the path of the raw file
+    @param [in] electrode_index: the index of the electrode
+    @param [in] params: the spike detection parameters, SpyCode ones if None
+    @param [in] chunk_size: number of samples read at once, rounded to a
+                            multiple of the chunks width of ChannelData
+    @returns the detected peaks
+    """
+
+    with H5_FILES.borrow(filename) as h5file:
+        analogs = h5file['/Data/Recording_0/AnalogStream']
+        stream = analogs[f'Stream_{len(analogs.keys()) - 1}']
+        info_channel = stream['InfoChannel'][electrode_index]
+        ChannelData = stream['ChannelData']
+
+        # same conversion of load_raw_signal_from_hdf5
+        SCALING_FROM_VOLT_TO_MILLIVOLT = 6
+
+        def read(start: int, stop: int) -> np.ndarray:
+            return convert_mantissas(
+                ChannelData[electrode_index, start:stop].astype(np.float64),
+                info_channel[8], info_channel[10],
+                info_channel[7] + SCALING_FROM_VOLT_TO_MILLIVOLT)
+
+        return detect_spikes_chunked(read, ChannelData.shape[1],
+                                     1e6 / info_channel[9], params,
+                                     aligned_block_size(ChannelData,
+                                                        chunk_size))
+
+
+###############################################################################
+#
+#                           EXPERIMENT FILES
+#
+###############################################################################
+
+# the value of the format attribute of the experiment files
+EXPERIMENT_FORMAT = 'pycode-experiment'
+EXPERIMENT_FORMAT_VERSION = 1
+
+
+def encode_digital(data: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Run-length encode a digital signal.
+    @param [in] data: the samples of the signal
+    @returns a couple (starts, values): the first sample of each run of equal
+             samples and their value
+    """
+    data = np.ravel(data)
+    if len(data) == 0:
+        return np.zeros(0, dtype=np.int64), data[:0]
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(data)) + 1))
+    return starts.astype(np.int64), data[starts]
+
+
+def decode_digital(starts: np.ndarray, values: np.ndarray,
+                   length: int) -> np.ndarray:
+    """
+    Expand a run-length encoded digital signal (see encode_digital).
+    @param [in] starts: the first sample of each run
+    @param [in] values: the value of each run
+    @param [in] length: the number of samples of the signal
+    @returns the samples of the signal
+    """
+    return np.repeat(values, np.diff(np.append(starts, length)))
+
+
+def save_experiment(experiment: Experiment, filename: Path):
+    """
+    Save an experiment in an HDF5 file with the PyCode layout:
+    - the root attributes hold the experiment metadata
+    - /phases/NNNNN is the group of the NNNNN-th phase, with its metadata as
+      attributes and:
+      - spikes/{indices, offsets, labels, amplitudes}: the SpikeTrains
+      - digital/edges: the transitions of a DigitalSignal, its length,
+        sampling frequency and high value are attributes of the group, or
+      - digital/{starts, values}: the run-length encoded digital signal, its
+        length and sampling frequency are attributes of the group
+    The file can be opened with open_experiment.
+    @param [in] experiment
+    @param [in] filename: the path of the file, it is overwritten if exists.
+                          An OSError is raised if it's borrowed from H5_FILES
+    """
+
+    # the phases not loaded yet could come from the same file
+    phases = [phase.load() if isinstance(phase, PhaseProxy) else phase
+              for phase in experiment.phases]
+    # a file still open for reading can't be written
+    if not H5_FILES.close(filename):
+        raise OSError(f'{filename} is in use')
+    with File(Path(filename), 'w') as h5file:
+        h5file.attrs['format'] = EXPERIMENT_FORMAT
+        h5file.attrs['version'] = EXPERIMENT_FORMAT_VERSION
+        h5file.attrs['name'] = str(experiment.name)
+        h5file.attrs['path'] = str(experiment.path)
+        h5file.attrs['date'] = str(experiment.date)
+        h5file.attrs['grounded_el'] = np.asarray(experiment.grounded_el,
+                                                 dtype=np.int64)
+        h5file.attrs['applied_operations'] = \
+            json.dumps(experiment.applied_operations)
+        h5file.attrs['phases'] = len(phases)
+        phases_group = h5file.create_group('phases')
+        for i, phase in enumerate(phases):
+            group = phases_group.create_group(f'{i:05d}')
+            for key in ['name', 'sampling_frequency', 'durate', 'div',
+                        'phase_type', 'order', 'rest']:
+                value = getattr(phase, key, None)
+                if value is not None:
+                    group.attrs[key] = value
+            spikes = group.create_group('spikes')
+            spikes['indices'] = phase.spikes.indices
+            spikes['offsets'] = phase.spikes.offsets
+            spikes['labels'] = phase.spikes.labels
+            spikes.attrs['sampling_frequency'] = \
+                phase.spikes.sampling_frequency
+            if phase.spikes.amplitudes is not None:
+                spikes['amplitudes'] = phase.spikes.amplitudes
+            if isinstance(phase.digital, DigitalSignal):
+                digital = group.create_group('digital')
+                digital['edges'] = phase.digital.edges
+                digital.attrs['high'] = phase.digital.high
+                digital.attrs['length'] = phase.digital.length
+                digital.attrs['sampling_frequency'] = \
+                    phase.digital.sampling_frequency
+            elif phase.digital is not None:
+                digital = group.create_group('digital')
+                starts, values = encode_digital(phase.digital.data)
+                digital['starts'] = starts
+                digital['values'] = values
+                digital.attrs['length'] = np.size(phase.digital.data)
+                digital.attrs['sampling_frequency'] = \
+                    phase.digital.sampling_frequency
+
+
+def _read_experiment_phase(filename: Path, index: int) -> Phase:
+    """
+    Load a phase of an experiment file, used by the LazyPhases of
+    open_experiment.
+    """
+    with H5_FILES.borrow(filename) as h5file:
+        group = h5file[f'phases/{index:05d}']
+        spikes = group['spikes']
+        digital = None
+        if 'digital/edges' in group:
+            digital_group = group['digital']
+            digital = DigitalSignal(digital_group['edges'][()],
+                                    digital_group.attrs['length'],
+                                    digital_group.attrs['sampling_frequency'],
+                                    digital_group.attrs['high'])
+        elif 'digital' in group:
+            digital_group = group['digital']
+            digital = Signal(decode_digital(digital_group['starts'][()],
+                                            digital_group['values'][()],
+                                            digital_group.attrs['length']),
+                             digital_group.attrs['sampling_frequency'])
+        phase = Phase(
+            str(group.attrs['name']),
+            SpikeTrains(spikes['indices'][()], spikes['offsets'][()],
+                        spikes['labels'][()],
+                        spikes.attrs['sampling_frequency'],
+                        spikes['amplitudes'][()]
+                        if 'amplitudes' in spikes else None),
+            digital,
+            group.attrs['sampling_frequency'],
+            group.attrs.get('durate'))
+        for key in ['div', 'order']:
+            if key in group.attrs:
+                setattr(phase, key, int(group.attrs[key]))
+        phase.phase_type = group.attrs.get('phase_type')
+        phase.rest = group.attrs.get('rest', '')
+        return phase
+
+
+def open_experiment(filename: Path,
+                    max_bytes: Optional[int] = None) -> Experiment:
+    """
+    Open an experiment saved with save_experiment. Only the metadata of the
+    experiment are read: each phase is loaded when it's first accessed.
+    @param [in] filename: the path of the experiment file
+    @param [in] max_bytes: the memory budget of the loaded phases (see
+                           LazyPhases), None for no limit
+    @returns the experiment, its phases are a LazyPhases
+    """
+
+    filename = Path(filename).absolute()
+    with H5_FILES.borrow(filename) as h5file:
+        assert h5file.attrs.get('format') == EXPERIMENT_FORMAT, \
+            f'{filename} is not a PyCode experiment file'
+        experiment = Experiment(
+            str(h5file.attrs['name']), str(h5file.attrs['path']),
+            str(h5file.attrs['date']),
+            LazyPhases(partial(_read_experiment_phase, filename),
+                       int(h5file.attrs['phases']), max_bytes),
+            h5file.attrs['grounded_el'].tolist())
+        experiment.applied_operations = [
+            tuple(operation) for operation
+            in json.loads(h5file.attrs['applied_operations'])]
+    return experiment
@@ -3,19 +3,22 @@ Author: Mascelli Leonardo
 Last Edited: 22-09-2023
 """
 
-from copy import deepcopy
-from typing import List, Optional, Tuple, Union
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import Callable, Dict, List, Optional, Tuple, Union
 
 import numpy as np  # type: ignore
 from matplotlib.axes import Axes  # type: ignore
 from matplotlib.collections import PatchCollection  # type: ignore
 from matplotlib.patches import Rectangle  # type: ignore
+from scipy import fft as sp_fft  # type: ignore
 from scipy import signal  # type: ignore
 
-from .experiment import Experiment, Phase
-from .utils import (intervals_boundaries, is_monodimensional,
+from .experiment import DigitalSignal, Experiment, Phase, Signal
+from .utils import (IntervalSet, is_monodimensional, make_row,
                     mea_60_electrode_list)
 
+
 ###############################################################################
 #                                                                             #
 #                                   PLOTTING                                  #
@@ -35,18 +38,15 @@ def rasterplot(experiment: Experiment,
     """
 
     phase = experiment.phases[phase_index]
-    electrodes = []
-    spikes = []
-
-    # peaks.keys() are the electrodes numbers
-    for _, p in enumerate(phase.peaks.keys()):
-        electrodes.append(p)
-        spikes.append(phase.peaks[p][:])
+    # the times of all the spikes are computed at once and split in a view
+    # for each electrode
+    electrodes = phase.spikes.labels.tolist()
+    spikes = np.split(phase.spikes.indices / phase.sampling_frequency,
+                      phase.spikes.offsets[1:-1])
 
     digital = phase.digital
     if digital is not None and with_digital:
-        stim_intervals = intervals_boundaries(digital.data,
-                                              digital.sampling_frequency)
+        stim_intervals = stimulation_intervals(digital)
         stim_rectangles = [
             Rectangle((x[0], 0), x[1] - x[0], 60) for x in stim_intervals
         ]
@@ -70,18 +70,15 @@ def rasterplot_phase(phase: Phase,
     @returns the same ax passed as argument
     """
 
-    electrodes = []
-    spikes = []
-
-    # peaks.keys() are the electrodes numbers
-    for _, p in enumerate(phase.peaks.keys()):
-        electrodes.append(p)
-        spikes.append(phase.peaks[p][:])
+    # the times of all the spikes are computed at once and split in a view
+    # for each electrode
+    electrodes = phase.spikes.labels.tolist()
+    spikes = np.split(phase.spikes.indices / phase.sampling_frequency,
+                      phase.spikes.offsets[1:-1])
 
     digital = phase.digital
     if digital is not None and with_digital:
-        stim_intervals = intervals_boundaries(digital.data,
-                                              digital.sampling_frequency)
+        stim_intervals = stimulation_intervals(digital)
         stim_rectangles = [
             Rectangle((x[0], 0), x[1] - x[0], 60) for x in stim_intervals
         ]
@@ -117,6 +114,18 @@ def plot_signal_with_spikes(signal: np.ndarray,
 #                                                                             #
 ###############################################################################
 
+def stimulation_intervals(digital: Signal) -> IntervalSet:
+    """
+    @param [in] digital: the digital signal of a phase
+    @returns the stimulation intervals in seconds, the precomputed ones of a
+             DigitalSignal
+    """
+    if isinstance(digital, DigitalSignal):
+        return digital.intervals()
+    return IntervalSet.from_mask(np.ravel(digital.data) > 0,
+                                 digital.sampling_frequency)
+
+
 def spikes_count(experiment: Experiment,
                  phase_index: int,
                  interval: Optional[Tuple[float, float]] = None
@@ -131,17 +140,30 @@ def spikes_count(experiment: Experiment,
     """
 
     phase = experiment.phases[phase_index]
-    ret = []
     if interval is not None:
-        for electrode in phase.peaks.keys():
-            peaks = np.where(np.all([phase.peaks[electrode] >= interval[0],
-                                     phase.peaks[electrode] <= interval[1]],
-                                    0))
-            ret.append((electrode, len(peaks[0])))
+        counts = phase.spikes.counts(interval[0], interval[1])
     else:
-        for electrode in phase.peaks.keys():
-            ret.append((electrode, len(phase.peaks[electrode])))
-    return ret
+        counts = phase.spikes.counts()
+    return list(zip(phase.spikes.labels.tolist(), counts.tolist()))
+
+
+def spikes_count_matrix(experiment: Experiment,
+                        phase_index: int,
+                        intervals: Union[np.ndarray,
+                                         List[Tuple[float, float]]]
+                        ) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Compute the spike count of each electrode of a phase in many intervals
+    @param [in] phase
+    @param [in] intervals: a (N x 2) array or a list of (start, end) in
+                           seconds, the ends are included
+    @returns a couple (electrodes numbers, (electrodes x N) counts matrix)
+    """
+
+    phase = experiment.phases[phase_index]
+    intervals = np.asarray(intervals, dtype=np.float64).reshape(-1, 2)
+    return (phase.spikes.labels,
+            phase.spikes.count_matrix(intervals[:, 0], intervals[:, 1]))
 
 
 def mfr(experiment: Experiment,
@@ -160,7 +182,7 @@ def mfr(experiment: Experiment,
     """
 
     phase = experiment.phases[phase_index]
-    sc = spikes_count(phase, interval)
+    sc = spikes_count(experiment, phase_index, interval)
     if interval is not None:
         durate = interval[1] - interval[0]
     else:
@@ -185,7 +207,7 @@ def psth(experiment: Experiment,
          start: List[float],
          bin_size: float,
          bin_num: int,
-         net=False) -> Union[List[Tuple[int, List[float]]], List[float]]:
+         net=False) -> Union[List[Tuple[int, List[int]]], List[int]]:
     """
     Compute the PSTH (Post Stimulus Time Histogram) of a given phase.
     @param [in] experiment
@@ -194,39 +216,29 @@ def psth(experiment: Experiment,
     @param [in] bin_size: the size of the interval
     @param [in] bin_num: on how many inteveral compute it
     @param [in] net: if True average the psth on all channels
-    @returns a list of the psth of each channel or of the whole net
+    @returns a list of the psth of each channel or of the whole net, the i-th
+             bin counts the spikes in [s + i * BIN_SIZE, s + (i + 1) *
+             BIN_SIZE) seconds for each s in START
     """
 
     phase = experiment.phases[phase_index]
     active_els = mea_60_electrode_list(experiment.grounded_el)
-    ret_map = {}
-    for el in active_els:
-        ret_map[el] = []
-        for _ in range(bin_num):
-            ret_map[el].append(0)
-    for bin_i in range(bin_num):
-        for s in start[:-1]:  # TODO controllare che lo start dell'ultimo
-            # intervallo sia precedente a (phase.durate - (bin_size*bin_num))
-            sc = spikes_count(phase, (s, s+bin_size*bin_i))
-            for ael in active_els:
-                for el, c in sc:
-                    if ael == el:
-                        ret_map[el][bin_i] += c
+    # the bins of all the stimuli are counted at once
+    bins_starts = np.add.outer(np.asarray(start, dtype=np.float64),
+                               np.arange(bin_num) * bin_size)
+    counts = phase.spikes.count_matrix(bins_starts, bins_starts + bin_size,
+                                       closed=False)
+    counts = counts.reshape(len(phase.spikes), len(start), bin_num).sum(1)
+    histograms = np.zeros((len(active_els), bin_num), dtype=np.int64)
+    for i, el in enumerate(active_els):
+        if el in phase.spikes:
+            histograms[i] = counts[phase.spikes.position(el)]
 
     if not net:
-        ret_not_net = []
-        for el in ret_map.items():
-            ret_not_net.append((el, ret_map[el]))
-        return ret_not_net
+        return [(el, histogram) for el, histogram
+                in zip(active_els, histograms.tolist())]
     else:
-        ret_net = []
-        for _ in range(bin_num):
-            ret_net.append(0)
-        for el in ret_map.items():
-            ret_net.append((el, ret_map[el]))
-            for bin_i in range(bin_num):
-                ret_net[bin_i] += ret_map[el][bin_i]
-        return ret_net
+        return histograms.sum(0).tolist()
 
 
 def instantaneous_firing_rate(
@@ -243,20 +255,16 @@ def instantaneous_firing_rate(
     """
 
     phase = experiment.phases[phase_index]
-    ret = []
+    spikes = phase.spikes if interval is None \
+        else phase.spikes.window(*interval)
+    # the times of all the windowed spikes are computed at once and split in
+    # a view for each electrode
+    trains = dict(zip(spikes.labels.tolist(),
+                      np.split(spikes.indices / spikes.sampling_frequency,
+                               spikes.offsets[1:-1])))
     active_els = mea_60_electrode_list(experiment.grounded_el)
-    for i in active_els:
-        if i in phase.peaks.keys():
-            if interval is not None:
-                peaks = phase.peaks[i]
-                interval_peaks = peaks[np.all([peaks >= interval[0],
-                                               peaks <= interval[1]], 0)]
-                ret.append(np.diff(interval_peaks))
-            else:
-                ret.append(np.diff(phase.peaks[i]))
-        else:
-            ret.append(np.array([]))
-    return ret
+    return [np.diff(trains[i]) if i in trains else np.array([])
+            for i in active_els]
 
 
 ###############################################################################
@@ -265,21 +273,277 @@ def instantaneous_firing_rate(
 #                                                                             #
 ###############################################################################
 
+def _cutoff_key(cutoff) -> Union[float, Tuple[float, ...]]:
+    """@returns CUTOFF as a float or a tuple of floats, to be hashed"""
+    if np.ndim(cutoff) == 0:
+        return float(cutoff)
+    return tuple(float(value) for value in np.ravel(cutoff))
+
+
+def filter_design(order: int, cutoff: Union[float, Tuple[float, float]],
+                  sampling_frequency: float, btype: str) -> np.ndarray:
+    """
+    Design a Butterworth filter in second-order sections. The designs are
+    memoized, so the same filter is computed only once.
+    @param [in] order
+    @param [in] cutoff: in Hz, a couple (low, high) for band filters
+    @param [in] sampling_frequency: in Hz
+    @param [in] btype: 'highpass', 'lowpass', 'bandpass' or 'bandstop'
+    @returns the second-order sections of the filter. The array is shared
+             by all the callers, so it's read-only: copy it before passing it
+             to signal.sosfilt, that needs a writable one
+
+    The designs are memoized by _filter_design, on the cutoff converted to a
+    float or a tuple of floats, so any sequence can be passed as cutoff.
+    """
+    return _filter_design(order, _cutoff_key(cutoff), sampling_frequency,
+                          btype)
+
+
+@lru_cache(maxsize=None)
+def _filter_design(order: int, cutoff: Union[float, Tuple[float, ...]],
+                   sampling_frequency: float, btype: str) -> np.ndarray:
+    Wn = np.array(cutoff)/(0.5*sampling_frequency)
+    sos = signal.butter(order, Wn, btype=btype, output='sos')
+    sos.flags.writeable = False
+    return sos
+
+
 def filter_signal(data: np.ndarray, sampling_frequency: float,
                   cutoff: float, btype: str = 'highpass') -> np.ndarray:
-    Wn = cutoff/(0.5*sampling_frequency)
-    b, a = signal.butter(2, Wn, btype=btype)
-    return signal.lfilter(b, a, data)
+    return filter_signals(data, sampling_frequency, cutoff, btype)
+
+
+def filter_signals(data: np.ndarray, sampling_frequency: float,
+                   cutoff: Union[float, Tuple[float, float]],
+                   btype: str = 'highpass',
+                   order: int = 2,
+                   dtype: Optional[np.dtype] = None) -> np.ndarray:
+    """
+    Filter a (channels x samples) block of signals along the time axis with
+    a single sosfilt call.
+    @param [in] data: the signals, the time is the last axis
+    @param [in] sampling_frequency: in Hz
+    @param [in] cutoff: in Hz, a couple (low, high) for band filters
+    @param [in] btype: the filter type (see filter_design)
+    @param [in] order: the order of the Butterworth filter
+    @param [in] dtype: if given (e.g. np.float32) the filtering is computed
+                       with this precision
+    @returns the filtered signals
+    """
+    # sosfilt needs a writable copy of the shared design
+    sos = filter_design(order, cutoff, sampling_frequency, btype).astype(
+        dtype if dtype is not None else np.float64)
+    if dtype is not None:
+        data = np.asarray(data, dtype=dtype)
+    return signal.sosfilt(sos, data, axis=-1)
+
+
+def zero_phase_kernel(order: int, cutoff: Union[float, Tuple[float, float]],
+                      sampling_frequency: float, btype: str,
+                      tolerance: float = 1e-20) -> np.ndarray:
+    """
+    FIR kernel equivalent to the forward-backward (zero-phase) application of
+    the filter designed by filter_design: it's the autocorrelation of its
+    impulse response, truncated where the response energy falls under
+    TOLERANCE. The kernels are memoized by _zero_phase_kernel and shared, so
+    they are read-only.
+    @returns the symmetric kernel, of odd length, centred in the middle
+    """
+    return _zero_phase_kernel(order, _cutoff_key(cutoff), sampling_frequency,
+                              btype, tolerance)
+
+
+@lru_cache(maxsize=None)
+def _zero_phase_kernel(order: int, cutoff: Union[float, Tuple[float, ...]],
+                       sampling_frequency: float, btype: str,
+                       tolerance: float) -> np.ndarray:
+    sos = _filter_design(order, cutoff, sampling_frequency, btype).copy()
+    MAX_LENGTH = 1 << 22
+    length = 1024
+    while True:
+        impulse = np.zeros(length)
+        impulse[0] = 1
+        response = signal.sosfilt(sos, impulse)
+        energy = np.cumsum(response[::-1]**2)[::-1]
+        if energy[-length // 4] <= tolerance * energy[0] or \
+                length >= MAX_LENGTH:
+            break
+        length *= 2
+    response = response[:np.flatnonzero(energy > tolerance * energy[0])[-1]
+                        + 1]
+    kernel = signal.fftconvolve(response, response[::-1])
+    kernel.flags.writeable = False
+    return kernel
+
+
+def filter_signals_zero_phase(data: np.ndarray, sampling_frequency: float,
+                              cutoff: Union[float, Tuple[float, float]],
+                              btype: str = 'highpass',
+                              order: int = 2,
+                              block_size: int = 1 << 16,
+                              workers: Optional[int] = None,
+                              out: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    Zero-phase version of filter_signals, that does not shift the spikes in
+    time. The forward-backward filter is applied as a FIR kernel (see
+    zero_phase_kernel) with FFT overlap-save convolution over blocks of
+    BLOCK_SIZE samples: each block reads only its samples plus half a kernel
+    on both sides, so the only full-size array is the output.
+    The blocks of all the channels are distributed on a pool of threads.
+
+    @param [in] data: (channels x samples) signals, or a single signal. It
+                      can be any array-like that supports slicing (np.memmap,
+                      h5py Dataset, ...): only a block at a time is read
+    @param [in] sampling_frequency: in Hz
+    @param [in] cutoff: in Hz, a couple (low, high) for band filters
+    @param [in] btype: the filter type (see filter_design)
+    @param [in] order: the order of the Butterworth filter
+    @param [in] block_size: about how many samples are filtered at once
+    @param [in] workers: number of threads, all the cores if None
+    @param [in] out: optional preallocated output, same shape of DATA
+    @returns the filtered signals
+
+    Far from the edges the result is the one of signal.sosfiltfilt, at the
+    edges the signals are considered zero outside the recording.
+    """
+    kernel = zero_phase_kernel(order, cutoff, sampling_frequency, btype)
+    half = (len(kernel) - 1) // 2
+    nfft = sp_fft.next_fast_len(block_size + 2*half, real=True)
+    block_size = nfft - 2*half
+    kernel_fft = sp_fft.rfft(kernel, nfft)
+
+    shape = data.shape
+    n_channels = 1 if len(shape) == 1 else shape[0]
+    n_samples = shape[-1]
+    if out is None:
+        out = np.empty(shape)
+
+    def filter_block(channel: int, start: int):
+        stop = min(start + block_size, n_samples)
+        # the segment goes from start - half to stop + half, zero padded
+        # outside the signal
+        segment = np.zeros(nfft)
+        lo, hi = max(start - half, 0), min(stop + half, n_samples)
+        samples = data[lo:hi] if len(shape) == 1 else data[channel, lo:hi]
+        segment[lo - start + half:hi - start + half] = samples
+        filtered = sp_fft.irfft(sp_fft.rfft(segment) * kernel_fft, nfft)
+        if len(shape) == 1:
+            out[start:stop] = filtered[2*half:2*half + stop - start]
+        else:
+            out[channel, start:stop] = filtered[2*half:2*half + stop - start]
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(filter_block, channel, start)
+                   for channel in range(n_channels)
+                   for start in range(0, n_samples, block_size)]
+        for future in futures:
+            future.result()
+    return out
+
+
+class StreamingFilter:
+    """
+    Stateful version of filter_signals. The filter state (zi) is kept between
+    the calls of process, so feeding it with consecutive chunks of signals
+    gives, bit for bit, the same output of filtering the whole signals at
+    once with filter_signals, without transients at the chunks boundaries.
+    It is meant for chunked processing of long recordings or for the live
+    acquisition.
+    """
+
+    def __init__(self, sampling_frequency: float,
+                 cutoff: Union[float, Tuple[float, float]],
+                 btype: str = 'highpass',
+                 order: int = 2,
+                 dtype: Optional[np.dtype] = None):
+        """
+        @param [in] sampling_frequency: in Hz
+        @param [in] cutoff: in Hz, a couple (low, high) for band filters
+        @param [in] btype: the filter type (see filter_design)
+        @param [in] order: the order of the Butterworth filter
+        @param [in] dtype: if given (e.g. np.float32) the filtering is
+                           computed with this precision
+        """
+        # sosfilt needs a writable copy of the shared design
+        self.sos = filter_design(order, cutoff, sampling_frequency,
+                                 btype).astype(
+            dtype if dtype is not None else np.float64)
+        self.dtype = dtype
+        self.zi: Optional[np.ndarray] = None
+
+    def process(self, chunk: np.ndarray) -> np.ndarray:
+        """
+        Filter the next chunk of the signals.
+        @param [in] chunk: the next samples of the signals, the time is the
+                           last axis and the other ones must not change
+                           between the calls
+        @returns the filtered chunk
+        """
+        if self.dtype is not None:
+            chunk = np.asarray(chunk, dtype=self.dtype)
+        if self.zi is None:
+            self.zi = np.zeros((self.sos.shape[0],) + chunk.shape[:-1] + (2,),
+                               dtype=np.result_type(self.sos, chunk))
+        filtered, self.zi = signal.sosfilt(self.sos, chunk, axis=-1,
+                                           zi=self.zi)
+        return filtered
+
+    def reset(self):
+        """
+        Forget the filter state, so that the next chunk is filtered as the
+        beginning of new signals.
+        """
+        self.zi = None
+
+
+def _threshold_windows(nSamples: int,
+                       sf: float) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Windows where compute_threshold looks for the noise level.
+    @param [in] nSamples: number of points of the signal
+    @param [in] sf: sampling frequency
+    @returns a tuple of arrays with the starting and ending (excluded) sample
+             of each window
+    """
+    nWin = 30  # number of subdivision of the whole data
+    winDur = 200e-3  # duration of the window where to compute the threshold
+    winDur_samples = winDur*sf  # previous duration in samples
+    sample_starting_points = np.arange(
+        0, nSamples-1, np.round(nSamples/nWin), dtype=np.int32)[:nWin]
+    sample_ending_points = np.round(
+        sample_starting_points + int(winDur_samples))
+    return sample_starting_points, sample_ending_points
+
+
+def _median_noise(windows: np.ndarray) -> np.ndarray:
+    return np.median(np.abs(windows), axis=-1) / 0.6745
+
+
+def _mad_noise(windows: np.ndarray) -> np.ndarray:
+    return np.median(np.abs(windows - np.median(windows, axis=-1,
+                                                keepdims=True)),
+                     axis=-1) / 0.6745
+
+
+# estimators of the noise level of a window, computed along the last axis
+THRESHOLD_ESTIMATORS: Dict[str, Callable[[np.ndarray], np.ndarray]] = {
+    'std': lambda windows: np.std(windows, axis=-1),
+    'median': _median_noise,
+    'mad': _mad_noise,
+}
 
 
 def compute_threshold(data: np.ndarray,
                       sf: float = 10000,
-                      multCoeff: int = 8) -> float:
+                      multCoeff: int = 8,
+                      estimator: str = 'std') -> float:
     """
     Automatically find a threshold for spike detection
     @param [in] data: signal to process
     @param [in] sf: sampling frequency
     @param [in] multCoeff: how many std use as threshold
+    @param [in] estimator: the noise level estimator (see compute_thresholds)
     @returns the computed threshold
 
     This algorithm as well as the spike_detection_core one have been
@@ -291,24 +555,70 @@ def compute_threshold(data: np.ndarray,
 
     assert is_monodimensional(
         data), "ERROR: compute_threshold. DATA should be monodimensional"
-    nSamples = np.max(data.shape)  # number of points in data
-    nWin = 30  # number of subdivision of the whole data
-    winDur = 200e-3  # duration of the window where to compute the threshold
-    winDur_samples = winDur*sf  # previous duration in samples
-    sample_starting_points = np.arange(
-        0, nSamples-1, np.round(nSamples/nWin), dtype=np.int32)
-    sample_ending_points = np.round(
-        sample_starting_points + int(winDur_samples))
-    threshold = 100
+    return compute_thresholds(make_row(data), sf, multCoeff, estimator)[0]
+
+
+def compute_thresholds(data: np.ndarray,
+                       sf: float = 10000,
+                       multCoeff: float = 8,
+                       estimator: str = 'std') -> np.ndarray:
+    """
+    Batched version of compute_threshold: the noise level of all the windows
+    of all the channels is computed at once on strided views of DATA.
+    @param [in] data: (n_channels, n_samples) block of signals to process
+    @param [in] sf: sampling frequency
+    @param [in] multCoeff: how many noise levels use as threshold
+    @param [in] estimator: how to estimate the noise level of a window:
+                           - 'std': standard deviation (SpyCode)
+                           - 'median': median(|x|)/0.6745
+                           - 'mad': median(|x - median(x)|)/0.6745
+    @returns an array with the threshold of each channel
+    """
+
+    assert len(data.shape) == 2, \
+        "ERROR: compute_thresholds. DATA should be (channels x samples)"
+    assert estimator in THRESHOLD_ESTIMATORS, \
+        f"ERROR: compute_thresholds. Unknown estimator {estimator}"
+    noise = THRESHOLD_ESTIMATORS[estimator]
+    nSamples = data.shape[1]
+    starts, ends = _threshold_windows(nSamples, sf)
+    ends = np.minimum(ends, nSamples).astype(np.int64)
+    win_samples = int(np.max(ends - starts))
+
+    levels = np.full((data.shape[0], len(starts)), np.inf)
+    full = np.flatnonzero(ends - starts == win_samples)
+    levels[:, full] = noise(np.lib.stride_tricks.sliding_window_view(
+        data, win_samples, axis=1)[:, starts[full]])
+    # the windows truncated by the end of the signal
+    for i in np.flatnonzero(ends - starts != win_samples):
+        levels[:, i] = noise(data[:, starts[i]:ends[i]])
+
+    # as in SpyCode the noise level is never greater than 100
+    return np.minimum(np.min(levels, axis=1), 100) * multCoeff
+
+
+class DetectedSpikes:
+    """
+    Result of the spike detection on a signal. Only the detected peaks are
+    stored, in arrays as long as their number:
+    - indices: sample index (int64) of each peak
+    - amplitudes: peak to peak amplitude (float32) of each peak
+    - sampling_frequency: of the signal, in Hz
+    The times (in seconds) of the peaks are available as the times property.
+    """
+
+    def __init__(self, indices: np.ndarray, amplitudes: np.ndarray,
+                 sampling_frequency: float):
+        self.indices = indices
+        self.amplitudes = amplitudes
+        self.sampling_frequency = sampling_frequency
 
-    for i_win in range(0, nWin):
-        win_data = data[0, sample_starting_points[i_win]:
-                        sample_ending_points[i_win]],
-        new_threshold = np.std(win_data)
-        if new_threshold < threshold:
-            threshold = new_threshold
+    @property
+    def times(self) -> np.ndarray:
+        return self.indices / self.sampling_frequency
 
-    return threshold*multCoeff
+    def __len__(self) -> int:
+        return len(self.indices)
 
 
 def spike_detection_core(data: np.ndarray,
@@ -316,7 +626,7 @@ def spike_detection_core(data: np.ndarray,
                          peakDuration: float,
                          refrTime: float,
                          sampling_frequency: float
-                         ) -> Tuple[np.ndarray, np.ndarray]:
+                         ) -> DetectedSpikes:
     """
     The core routine of the spikes detection.
 
@@ -325,7 +635,7 @@ def spike_detection_core(data: np.ndarray,
     @param [in] peakDuration: in milliseconds
     @param [in] refrTime: in milliseconds
     @param [in] sampling_frequency: in Hz
-    @returns a tuple of arrays with peaks value and peaks time
+    @returns the detected peaks
     """
 
     assert is_monodimensional(
@@ -333,7 +643,8 @@ def spike_detection_core(data: np.ndarray,
 
     OVERLAP = 5
     nSamples = np.max(data.shape)  # number of points in data
-    ret = (np.zeros(nSamples), np.zeros(nSamples))
+    # peaks amplitudes and times
+    ret: Tuple[List[float], List[int]] = ([], [])
 
     # Convertion from milliseconds to number of samples
     SCALING_MS_TO_S = 1/1000
@@ -341,7 +652,6 @@ def spike_detection_core(data: np.ndarray,
     refrTime = np.round(refrTime*SCALING_MS_TO_S*sampling_frequency)
 
     newIndex = 1
-    indexPeak = 1
     interval = 0.
     sTimePeak = 0
     eTimePeak = 0
@@ -402,26 +712,227 @@ def spike_detection_core(data: np.ndarray,
                             eValuePeak = data[0, i]
 
             if np.abs(sValuePeak - eValuePeak) >= threshold:
-                ret[0][indexPeak] = np.abs(sValuePeak-eValuePeak)
+                ret[0].append(np.abs(sValuePeak-eValuePeak))
 
                 if np.abs(sValuePeak) > np.abs(eValuePeak):
-                    ret[1][indexPeak] = sTimePeak
+                    timePeak = sTimePeak
                 else:
-                    ret[1][indexPeak] = eTimePeak
+                    timePeak = eTimePeak
+                ret[1].append(timePeak)
 
-                if (ret[1][indexPeak]+refrTime) > eTimePeak and \
-                        (ret[1][indexPeak] + refrTime) < nSamples:
-                    newIndex = ret[1][indexPeak] + refrTime
+                if (timePeak+refrTime) > eTimePeak and \
+                        (timePeak + refrTime) < nSamples:
+                    newIndex = timePeak + refrTime
                 else:
                     newIndex = eTimePeak + 1
 
-                indexPeak = indexPeak + 1
+    return DetectedSpikes(np.array(ret[1], dtype=np.int64),
+                          np.array(ret[0], dtype=np.float32),
+                          sampling_frequency)
 
-    return ret
+
+# samples looked after the peak lifetime period when the end of a peak falls
+# exactly on its boundary (see spike_detection_core)
+PEAK_OVERLAP = 5
+# number of candidates whose peak lifetime windows are evaluated at once
+_CANDIDATES_BLOCK = 1 << 16
+
+
+def _evaluate_peaks(data: np.ndarray,
+                    first: int,
+                    last: int,
+                    n_samples: int,
+                    peak_duration: int,
+                    threshold: float,
+                    offset: int = 0
+                    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray,
+                               np.ndarray]:
+    """
+    Vectorized evaluation of the peak lifetime window of every local extremum
+    of DATA in the sample range [FIRST, LAST). It reproduces, candidate by
+    candidate, what the body of the spike_detection_core loop does.
+
+    @param [in] data: 1-D array holding the samples [OFFSET, OFFSET+len(DATA))
+                      of a signal of N_SAMPLES samples. It must cover at least
+                      [FIRST-1, min(LAST+PEAK_DURATION+PEAK_OVERLAP+1,
+                      N_SAMPLES))
+    @param [in] first: first sample (global index) to look for peaks
+    @param [in] last: last sample (excluded, global index)
+    @param [in] n_samples: number of samples of the whole signal
+    @param [in] peak_duration: in samples
+    @param [in] threshold
+    @param [in] offset: global index of DATA[0]
+    @returns a tuple (candidates, amplitudes, peak times, peak end times) of
+             the candidates whose peak to peak amplitude exceeds THRESHOLD
+    """
+
+    empty = np.zeros(0, dtype=np.int64)
+    lo = max(first, 2)
+    hi = min(last, n_samples - 1)
+    if hi <= lo:
+        return empty, np.zeros(0), empty, empty
+
+    # local extrema of the absolute value
+    absolute = np.abs(data[lo - offset - 1:hi - offset + 1])
+    centre = absolute[1:-1]
+    is_candidate = (centre > absolute[:-2]) & (centre >= absolute[2:])
+    candidates = np.flatnonzero(is_candidate) + lo
+    del absolute, centre, is_candidate
+
+    width = max(peak_duration - 1, 0)
+    span = max(peak_duration, 1) + PEAK_OVERLAP + 1
+    columns = np.arange(width)
+    ret_candidates, ret_amplitudes, ret_times, ret_ends = [], [], [], []
+
+    for b in range(0, len(candidates), _CANDIDATES_BLOCK):
+        cand = candidates[b:b + _CANDIDATES_BLOCK]
+        rows = np.arange(len(cand))
+
+        # the windows of this block are strided views of a single segment
+        # starting at the first sample after the first candidate
+        base = cand[0] + 1
+        segment = data[base - offset:cand[-1] + span - offset]
+        if len(segment) < cand[-1] + span - base:
+            segment = np.concatenate(
+                [segment, np.zeros(cand[-1] + span - base - len(segment))])
+        local = cand + 1 - base
+
+        interval = np.minimum(peak_duration, n_samples - cand)
+        s_value = data[cand - offset]
+        # with the sign of the starting value both the positive and the
+        # negative case become a search for the minimum after the peak
+        sign = np.where(s_value > 0, 1., -1.)
+        s_abs = sign * s_value
+
+        e_time = cand + 1
+        e_value = s_value.copy()
+        s_time = cand.copy()
+        if width > 0:
+            windows = sign[:, None] * np.lib.stride_tricks.sliding_window_view(
+                segment, width)[local]
+
+            valid = columns < (interval - 1)[:, None]
+            k_min = np.argmin(np.where(valid, windows, np.inf), axis=1)
+            y_min = windows[rows, k_min]
+            found = valid[rows, k_min] & (y_min < s_abs)
+            e_time = np.where(found, cand + 1 + k_min, e_time)
+            e_value = np.where(found, sign * y_min, e_value)
+
+            valid = columns < (e_time - cand - 1)[:, None]
+            k_max = np.argmax(np.where(valid, windows, -np.inf), axis=1)
+            y_max = windows[rows, k_max]
+            found = valid[rows, k_max] & (y_max > s_abs)
+            s_time = np.where(found, cand + 1 + k_max, s_time)
+            s_value = np.where(found, sign * y_max, s_value)
+            del windows, valid
+
+        extend = np.flatnonzero((e_time == cand + interval) &
+                                (cand + interval + PEAK_OVERLAP < n_samples))
+        if len(extend) > 0:
+            start = local[extend] + interval[extend]
+            windows = sign[extend, None] * segment[
+                start[:, None] + np.arange(PEAK_OVERLAP)]
+            k_min = np.argmin(windows, axis=1)
+            y_min = windows[np.arange(len(extend)), k_min]
+            found = y_min < sign[extend] * e_value[extend]
+            e_time[extend] = np.where(found, start + base + k_min,
+                                      e_time[extend])
+            e_value[extend] = np.where(found, sign[extend] * y_min,
+                                       e_value[extend])
+
+        amplitudes = np.abs(s_value - e_value)
+        detected = amplitudes >= threshold
+        ret_candidates.append(cand[detected])
+        ret_amplitudes.append(amplitudes[detected])
+        ret_times.append(np.where(np.abs(s_value) > np.abs(e_value),
+                                  s_time, e_time)[detected])
+        ret_ends.append(e_time[detected])
+
+    if len(ret_candidates) == 0:
+        return empty, np.zeros(0), empty, empty
+    return (np.concatenate(ret_candidates), np.concatenate(ret_amplitudes),
+            np.concatenate(ret_times), np.concatenate(ret_ends))
+
+
+def _refractory_filter(candidates: np.ndarray,
+                       peak_times: np.ndarray,
+                       end_times: np.ndarray,
+                       refr_time: int,
+                       n_samples: int,
+                       new_index: int = 1) -> Tuple[np.ndarray, int]:
+    """
+    Apply the refractory rule of spike_detection_core to the peaks found by
+    _evaluate_peaks. Only detected peaks move the refractory deadline, so the
+    sequential part of the algorithm runs on them alone.
+    @param [in] candidates: starting sample of each detected peak
+    @param [in] peak_times
+    @param [in] end_times
+    @param [in] refr_time: in samples
+    @param [in] n_samples: number of samples of the whole signal
+    @param [in] new_index: the refractory deadline before the first candidate
+    @returns a tuple (indices of the accepted peaks, refractory deadline after
+             the last one)
+    """
+    keep = []
+    for k, (candidate, time, end) in enumerate(
+            zip(candidates.tolist(), peak_times.tolist(), end_times.tolist())):
+        if candidate < new_index:
+            continue
+        keep.append(k)
+        if time + refr_time > end and time + refr_time < n_samples:
+            new_index = time + refr_time
+        else:
+            new_index = end + 1
+    return np.array(keep, dtype=np.int64), new_index
 
 
-def spike_detection(data: np.ndarray) -> Tuple[np.ndarray,
-                                               np.ndarray]:
+def spike_detection_core_vectorized(data: np.ndarray,
+                                    threshold: float,
+                                    peakDuration: float,
+                                    refrTime: float,
+                                    sampling_frequency: float
+                                    ) -> DetectedSpikes:
+    """
+    Same as spike_detection_core, but the local extrema and their peak
+    lifetime windows are evaluated with array operations and only the
+    detected peaks go through the (sequential) refractory rule.
+
+    @param [in] data: array where to look for peaks
+    @param [in] threshold
+    @param [in] peakDuration: in milliseconds
+    @param [in] refrTime: in milliseconds
+    @param [in] sampling_frequency: in Hz
+    @returns the detected peaks
+    """
+
+    assert is_monodimensional(data), \
+        "ERROR: spike_detection_core_vectorized. DATA should be " \
+        "monodimensional"
+
+    data = np.ravel(data)
+    nSamples = data.shape[0]
+
+    SCALING_MS_TO_S = 1/1000
+    peakDuration = int(np.round(
+        peakDuration*SCALING_MS_TO_S*sampling_frequency))
+    refrTime = int(np.round(refrTime*SCALING_MS_TO_S*sampling_frequency))
+
+    candidates, amplitudes, times, ends = _evaluate_peaks(
+        data, 0, nSamples, nSamples, peakDuration, threshold)
+    keep, _ = _refractory_filter(candidates, times, ends, refrTime, nSamples)
+
+    return DetectedSpikes(times[keep], amplitudes[keep].astype(np.float32),
+                          sampling_frequency)
+
+
+SPIKE_DETECTION_ENGINES = {
+    'loop': spike_detection_core,
+    'vectorized': spike_detection_core_vectorized,
+}
+
+
+def spike_detection(data: np.ndarray,
+                    engine: str = 'loop') -> DetectedSpikes:
     """
 NOTE:
     standard deviation coefficient: 8
@@ -435,46 +946,196 @@ NOTE:
     algorithm:
         for each electrode:
         3. auto compute threshold (data, sf=10000, multCoeff=8)
+
+    ENGINE selects the implementation of the core routine, one of the keys
+    of SPIKE_DETECTION_ENGINES ('loop' or 'vectorized'). Both give the same
+    peaks.
     """
+    assert engine in SPIKE_DETECTION_ENGINES, \
+        f"ERROR: spike_detection. Unknown engine {engine}"
     data_mean = np.mean(data, axis=1)
     data = data-data_mean
-    return spike_detection_core(data,
-                                compute_threshold(data),
-                                2,
-                                1,
-                                10000)
+    return SPIKE_DETECTION_ENGINES[engine](data,
+                                           compute_threshold(data),
+                                           2,
+                                           1,
+                                           10000)
 
 
-# TODO respect the coding convenction of immutable objects
-# the way is probably through
-# from copy import deepcopy
-# and making deepcopy of experiment
+class SpikeDetectionParams:
+    """
+    Collection of the parameters of the whole spike detection pipeline
+    applied to a raw electrode signal (filtering, threshold computation and
+    peaks detection). The default values are the SpyCode ones:
+    - cutoff: cutoff frequency (in Hz) of the high pass filter
+    - mult_coeff: how many std use as threshold
+    - peak_duration: peak lifetime period (in milliseconds)
+    - refr_time: refractory period (in milliseconds)
+    - engine: the spike_detection_core implementation to use
+    - estimator: the noise level estimator used for the threshold
+    - zero_phase: filter with filter_signals_zero_phase instead of the
+                  causal filter of SpyCode
+    """
+
+    def __init__(self,
+                 cutoff: float = 70.,
+                 mult_coeff: float = 8,
+                 peak_duration: float = 2.,
+                 refr_time: float = 1.,
+                 engine: str = 'vectorized',
+                 estimator: str = 'std',
+                 zero_phase: bool = False):
+        self.cutoff = cutoff
+        self.mult_coeff = mult_coeff
+        self.peak_duration = peak_duration
+        self.refr_time = refr_time
+        self.engine = engine
+        self.estimator = estimator
+        self.zero_phase = zero_phase
+
+
+def detect_spikes(data: np.ndarray,
+                  sampling_frequency: float,
+                  params: Optional[SpikeDetectionParams] = None
+                  ) -> DetectedSpikes:
+    """
+    Apply the whole spike detection pipeline to a raw electrode signal.
+    @param [in] data: the raw signal (monodimensional)
+    @param [in] sampling_frequency: in Hz
+    @param [in] params: the detection parameters, SpyCode ones if None
+    @returns the detected peaks
+    """
+    if params is None:
+        params = SpikeDetectionParams()
+    if params.zero_phase:
+        data = filter_signals_zero_phase(make_row(data), sampling_frequency,
+                                         params.cutoff)
+    else:
+        data = filter_signal(make_row(data), sampling_frequency,
+                             params.cutoff)
+    data = data - np.mean(data, axis=1)
+    return SPIKE_DETECTION_ENGINES[params.engine](
+        data,
+        compute_threshold(data, sampling_frequency, params.mult_coeff,
+                          params.estimator),
+        params.peak_duration,
+        params.refr_time,
+        sampling_frequency)
+
+
+def detect_spikes_chunked(read: Callable[[int, int], np.ndarray],
+                          n_samples: int,
+                          sampling_frequency: float,
+                          params: Optional[SpikeDetectionParams] = None,
+                          chunk_size: int = 1 << 20) -> DetectedSpikes:
+    """
+    Same as detect_spikes, but the signal is never held in memory as a whole:
+    it is requested in chunks of CHUNK_SIZE samples through the READ
+    callback, so the memory used is bounded by the chunk size and not by
+    the length of the recording.
+    @param [in] read: a function that, given a couple of samples (start,
+                      stop), returns the raw signal in that range
+    @param [in] n_samples: number of samples of the whole signal
+    @param [in] sampling_frequency: in Hz
+    @param [in] params: the detection parameters, SpyCode ones if None
+    @param [in] chunk_size: number of samples read at once
+    @returns the detected peaks
+
+    The signal is read twice. The first pass computes the mean of the
+    filtered signal and collects the windows used for the threshold, the
+    second one runs the detection carrying across the chunks boundaries the
+    filter state, the refractory deadline and the samples still needed to
+    evaluate the peaks at the end of a chunk.
+    The peaks are evaluated with the vectorized engine (PARAMS.engine is not
+    used) and are the ones found by detect_spikes on the whole signal, up to
+    the rounding of the mean that is accumulated chunk by chunk.
+    """
+    if params is None:
+        params = SpikeDetectionParams()
+    assert not params.zero_phase, \
+        "ERROR: detect_spikes_chunked. Only the causal filter can be streamed"
+
+    def filtered_chunks():
+        streaming_filter = StreamingFilter(sampling_frequency, params.cutoff)
+        for start in range(0, n_samples, chunk_size):
+            stop = min(start + chunk_size, n_samples)
+            yield start, stop, streaming_filter.process(
+                np.ravel(read(start, stop)))
+
+    # first pass: mean and threshold windows
+    win_starts, win_ends = _threshold_windows(n_samples, sampling_frequency)
+    win_ends = np.minimum(win_ends, n_samples).astype(np.int64)
+    windows = [np.zeros(e - s) for s, e in zip(win_starts, win_ends)]
+    total = 0.
+    for start, stop, chunk in filtered_chunks():
+        total += np.sum(chunk)
+        for window, s, e in zip(windows, win_starts, win_ends):
+            lo, hi = max(s, start), min(e, stop)
+            if lo < hi:
+                window[lo - s:hi - s] = chunk[lo - start:hi - start]
+    mean = total / n_samples
+    noise = THRESHOLD_ESTIMATORS[params.estimator]
+    threshold = 100
+    for window in windows:
+        threshold = min(threshold, noise(window - mean))
+    threshold *= params.mult_coeff
+
+    # second pass: detection
+    SCALING_MS_TO_S = 1/1000
+    peak_duration = int(np.round(
+        params.peak_duration*SCALING_MS_TO_S*sampling_frequency))
+    refr_time = int(np.round(
+        params.refr_time*SCALING_MS_TO_S*sampling_frequency))
+    lookahead = max(peak_duration, 1) + PEAK_OVERLAP + 1
+
+    new_index = 1
+    evaluated = 0  # first sample whose candidacy is not evaluated yet
+    pending = np.zeros(0)  # samples from evaluated - 1 onwards
+    pending_start = 0
+    ret_indices = [np.zeros(0, dtype=np.int64)]
+    ret_amplitudes = [np.zeros(0, dtype=np.float32)]
+    for start, stop, chunk in filtered_chunks():
+        buffer = np.concatenate([pending, chunk - mean])
+        last = n_samples if stop == n_samples else \
+            max(stop - lookahead, evaluated)
+        candidates, amplitudes, times, ends = _evaluate_peaks(
+            buffer, evaluated, last, n_samples, peak_duration, threshold,
+            pending_start)
+        keep, new_index = _refractory_filter(
+            candidates, times, ends, refr_time, n_samples, new_index)
+        ret_indices.append(times[keep])
+        ret_amplitudes.append(amplitudes[keep].astype(np.float32))
+
+        evaluated = last
+        pending_start = max(evaluated - 1, 0)
+        pending = buffer[pending_start - (stop - len(buffer)):]
+
+    return DetectedSpikes(np.concatenate(ret_indices),
+                          np.concatenate(ret_amplitudes), sampling_frequency)
 
 
 def set_intervals_to_zero(
         experiment: Experiment,
         phase_index: int,
-        intervals: List[Tuple[float, float]]) -> Experiment:
+        intervals: Union[List[Tuple[float, float]], IntervalSet]
+) -> Experiment:
     """
     Set to zero the selected intervals
     @param [in] phase
-    @param [in] intervals: list of (start, end) of the intervals
-    @returns a new experiment with the cleared intervals
+    @param [in] intervals: list of (start, end) of the intervals, or an
+                           IntervalSet, in seconds (ends included)
+    @returns a new experiment with the cleared intervals, sharing with
+             EXPERIMENT all the unchanged data
     """
 
-    experiment_ = deepcopy(experiment)
-    phase = experiment_.phases[phase_index]
-
-    els = phase.peaks.keys()
-    for el in els:
-        peaks = phase.peaks[el]
-        for peak in peaks:
-            for interval in intervals:
-                if peak >= interval[0] and peak <= interval[1]:
-                    peaks = peaks[peaks != peak]
-                    break
-        phase.peaks[el] = peaks
-    return experiment_
+    if not isinstance(intervals, IntervalSet):
+        intervals = IntervalSet.from_pairs(intervals)
+    phase = experiment.phases[phase_index]
+    spikes = phase.spikes
+    # a single search of all the spikes of all the electrodes
+    keep = ~intervals.contains(spikes.indices / spikes.sampling_frequency)
+    return experiment.replace_phase(
+        phase_index, phase.replace(spikes=spikes.select(keep)))
 
 
 def clear_around_stimulation_boundaries(experiment: Experiment,
@@ -491,13 +1152,9 @@ def clear_around_stimulation_boundaries(experiment: Experiment,
     phase = experiment.phases[phase_index]
 
     if phase.digital is not None:
-        digital = phase.digital.data
-        stimuli = intervals_boundaries(
-            digital, phase.digital.sampling_frequency)
-        intervals = []
-        for x0, x1 in stimuli:
-            intervals.append((x0, x0 + guard))
-            intervals.append((x1, x1 + guard))
-        return set_intervals_to_zero(phase, intervals)
+        stimuli = stimulation_intervals(phase.digital)
+        intervals = IntervalSet(stimuli.starts, stimuli.starts + guard).union(
+            IntervalSet(stimuli.ends, stimuli.ends + guard))
+        return set_intervals_to_zero(experiment, phase_index, intervals)
     else:
         assert False, "clearing around stimulation on a not stimulation phase"
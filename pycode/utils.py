@@ -8,7 +8,7 @@ This file contains some useful functions and constants for:
     * working with electrode index of MEAs
 """
 
-from typing import List, Optional, Tuple, Union
+from typing import Iterator, List, Optional, Sequence, Tuple, Union
 
 import matplotlib.pyplot as plt
 import numpy as np
@@ -143,12 +143,117 @@ def data_in_intervals(
     return ret
 
 
+class IntervalSet:
+    """
+    A set of disjoint closed intervals [STARTS[i], ENDS[i]], sorted by their
+    start. Overlapping or touching intervals are merged when the set is built,
+    so that the membership of many values is found with a binary search
+    (np.searchsorted) instead of comparing each value with each interval.
+    """
+
+    def __init__(self, starts: np.ndarray, ends: np.ndarray):
+        """
+        @param [in] starts: the beginning of the intervals, in any order
+        @param [in] ends: the end of each interval (included)
+        """
+        starts = np.asarray(starts).ravel()
+        ends = np.asarray(ends).ravel()
+        assert starts.shape == ends.shape, \
+            "starts and ends should have the same length"
+        assert np.all(starts <= ends), "an interval ends before its start"
+        order = np.argsort(starts, kind='stable')
+        starts, ends = starts[order], ends[order]
+        if len(starts) > 1:
+            # an interval is merged with the previous ones if it starts
+            # before the end of any of them
+            reach = np.maximum.accumulate(ends)
+            first = np.concatenate(([True], starts[1:] > reach[:-1]))
+            groups = np.flatnonzero(first)
+            starts = starts[groups]
+            ends = np.maximum.reduceat(ends, groups)
+        self.starts = starts
+        self.ends = ends
+
+    @classmethod
+    def from_pairs(cls, intervals: Sequence[Tuple[float, float]]
+                   ) -> 'IntervalSet':
+        """@param [in] intervals: a list of (start, end)"""
+        pairs = np.asarray(intervals, dtype=np.float64).reshape(-1, 2)
+        return cls(pairs[:, 0], pairs[:, 1])
+
+    @classmethod
+    def from_mask(cls, mask: np.ndarray,
+                  sampling_freq: Optional[float] = None) -> 'IntervalSet':
+        """
+        Build the intervals where MASK is True: each one goes from its first
+        True sample to the first False one after it (or the length of MASK if
+        it ends True).
+        @param [in] mask: a monodimensional boolean array
+        @param [in] sampling_freq: if provided the intervals are in seconds
+                                   instead of samples
+        """
+        edges = np.flatnonzero(np.diff(np.ravel(mask).view(np.int8),
+                                       prepend=0, append=0))
+        if sampling_freq is not None:
+            return cls(edges[0::2] / sampling_freq,
+                       edges[1::2] / sampling_freq)
+        return cls(edges[0::2], edges[1::2])
+
+    def __len__(self) -> int:
+        return len(self.starts)
+
+    def __iter__(self) -> Iterator[Tuple[float, float]]:
+        return zip(self.starts.tolist(), self.ends.tolist())
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, IntervalSet) \
+            and np.array_equal(self.starts, other.starts) \
+            and np.array_equal(self.ends, other.ends)
+
+    def to_list(self) -> List[Tuple[float, float]]:
+        return list(self)
+
+    def union(self, other: 'IntervalSet') -> 'IntervalSet':
+        return IntervalSet(np.concatenate((self.starts, other.starts)),
+                           np.concatenate((self.ends, other.ends)))
+
+    def intersection(self, other: 'IntervalSet') -> 'IntervalSet':
+        # the intervals of OTHER overlapping the i-th one are in [lo[i], hi[i])
+        lo = np.searchsorted(other.ends, self.starts, 'left')
+        hi = np.searchsorted(other.starts, self.ends, 'right')
+        counts = np.maximum(hi - lo, 0)
+        mine = np.repeat(np.arange(len(self)), counts)
+        # the position of each overlap among the ones of its interval
+        rank = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts,
+                                                   counts)
+        theirs = np.repeat(lo, counts) + rank
+        return IntervalSet(np.maximum(self.starts[mine], other.starts[theirs]),
+                           np.minimum(self.ends[mine], other.ends[theirs]))
+
+    def position(self, values: np.ndarray) -> np.ndarray:
+        """
+        @returns the index of the interval containing each value, -1 for the
+                 values outside the intervals
+        """
+        values = np.asarray(values)
+        index = np.searchsorted(self.starts, values, 'right') - 1
+        inside = index >= 0
+        inside[inside] = values[inside] <= self.ends[index[inside]]
+        return np.where(inside, index, -1)
+
+    def contains(self, values: np.ndarray) -> np.ndarray:
+        """@returns a boolean mask of the VALUES inside the intervals"""
+        return self.position(values) >= 0
+
+
 def intervals_boundaries(
     data: np.ndarray, sampling_freq: Optional[float] = None
 ) -> List[Tuple[Union[int, float], Union[int, float]]]:
     """
     Returns a list of couple (init time, final time) of a signal where its
-    value is 1 (or greater than 0).
+    value is 1 (or greater than 0). The final time is the one of the first
+    sample after the interval, the length of the signal if it ends during an
+    interval.
     @param [in] data: the array to find positive intervals into
     @param [in] sampling_freq: if this value is provided the returned values
                                will be tranformed in time values instead of
@@ -156,22 +261,7 @@ def intervals_boundaries(
     @returns list of couple (initial time, final fime) of each interval
              where the signal is positive.
     """
-    ret = list()
-    # starting points of an interval are those where the first derivative is
-    # positive
-    intervals_indices_start = np.where(np.gradient(data[:, 0]) > 0)[0]
-    # ending points of an interval are those where the first derivative is
-    # negative
-    intervals_indices_ends = np.where(np.gradient(data[:, 0]) < 0)[0]
-
-    for i, n in enumerate(intervals_indices_start):
-        if sampling_freq is not None:
-            ret.append(
-                # dividing by the sampling frequency gives the time value
-                (n / sampling_freq, intervals_indices_ends[i] / sampling_freq))
-        else:
-            ret.append((n, intervals_indices_ends[i]))
-    return ret
+    return IntervalSet.from_mask(np.ravel(data) > 0, sampling_freq).to_list()
 
 
 def average_waves(
@@ -240,7 +330,7 @@ def mea_60_electrode_list(grounded: List[int] = []) -> List[int]:
         ret = ret + list(range(i * 10 + 1, i * 10 + 9))
     ret = ret + list(range(82, 88))
     for g in grounded:
-        ret = ret.remove(g)  # type: ignore
+        ret.remove(g)
     return ret
 
 
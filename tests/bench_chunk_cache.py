@@ -0,0 +1,74 @@
+"""
+Throughput of the ChannelData reads with the default HDF5 chunk cache and with
+the one tuned on the access pattern (see pycode.hdf5.chunk_cache_settings).
+
+Run it from the tests folder, optionally passing the path of an MCS file:
+    python bench_chunk_cache.py [file.h5]
+otherwise a synthetic chunked and compressed file is used.
+"""
+import sys
+import tempfile
+from pathlib import Path
+from time import perf_counter
+
+import numpy as np
+from h5py import File
+
+from pycode.hdf5 import aligned_block_size, open_dataset
+
+from synthetic_h5 import make_mcs_file
+
+BLOCK_SIZE = 1 << 16
+
+
+def read_by_channel(dataset, block_size: int):
+    out = np.empty(block_size, dtype=dataset.dtype)
+    for row in range(dataset.shape[0]):
+        for start in range(0, dataset.shape[1], block_size):
+            stop = min(start + block_size, dataset.shape[1])
+            dataset.read_direct(out, np.s_[row, start:stop],
+                                np.s_[:stop - start])
+
+
+def read_by_time(dataset, block_size: int):
+    out = np.empty((dataset.shape[0], block_size), dtype=dataset.dtype)
+    for start in range(0, dataset.shape[1], block_size):
+        stop = min(start + block_size, dataset.shape[1])
+        dataset.read_direct(out, np.s_[:, start:stop], np.s_[:, :stop - start])
+
+
+def bench(path: Path):
+    with File(path, 'r') as h5:
+        analogs = h5['/Data/Recording_0/AnalogStream']
+        stream = analogs[f'Stream_{len(analogs.keys()) - 1}']
+        dataset = stream['ChannelData']
+        megabytes = dataset.size * dataset.dtype.itemsize / 1e6
+        print(f'{path.name}: {dataset.shape} {dataset.dtype}, '
+              f'chunks {dataset.chunks}, {dataset.compression} compression')
+        del dataset
+        for access, read in [('by_channel', read_by_channel),
+                             ('by_time', read_by_time)]:
+            for tuned in [False, True]:
+                dataset = open_dataset(stream, 'ChannelData', access) \
+                    if tuned else stream['ChannelData']
+                block_size = aligned_block_size(dataset, BLOCK_SIZE)
+                begin = perf_counter()
+                read(dataset, block_size)
+                elapsed = perf_counter() - begin
+                print(f'{access:>10} {"tuned" if tuned else "default":>7} '
+                      f'cache: {megabytes / elapsed:8.1f} MB/s')
+                # the cache is bound to the opened dataset
+                del dataset
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        bench(Path(sys.argv[1]))
+    else:
+        with tempfile.TemporaryDirectory() as tmp:
+            # 60 electrodes, 30 s at 10 KHz, 2 MB chunks
+            path = make_mcs_file(Path(tmp).joinpath('00000_DIV40_Basal_1.h5'),
+                                 n_channels=60, n_samples=300000,
+                                 chunks=(8, 1 << 16), compression='gzip',
+                                 compression_opts=1)
+            bench(path)
@@ -0,0 +1,90 @@
+"""Build small HDF5 files with the Multichannel Systems layout for tests."""
+from pathlib import Path
+from typing import List, Optional
+
+import numpy as np
+from h5py import File
+
+from pycode.utils import mea_60_electrode_index_to_label
+
+INFO_CHANNEL_DTYPE = np.dtype([
+    ('ChannelID', '<i4'), ('RowIndex', '<i4'), ('GroupID', '<i4'),
+    ('ElectrodeGroup', '<i4'), ('Label', 'S8'), ('RawDataType', 'S8'),
+    ('Unit', 'S4'), ('Exponent', '<i4'), ('ADZero', '<i4'), ('Tick', '<i8'),
+    ('ConversionFactor', '<i8'), ('ADCBits', '<i4'),
+    ('HighPassFilterType', 'S8'), ('HighPassFilterCutOff', 'S8'),
+    ('HighPassFilterOrder', '<i4'), ('LowPassFilterType', 'S8'),
+    ('LowPassFilterCutOff', 'S8'), ('LowPassFilterOrder', '<i4')])
+
+INFO_TIMESTAMP_DTYPE = np.dtype([
+    ('TimeStampEntityID', '<i4'), ('GroupID', '<i4'), ('Label', 'S8'),
+    ('Unit', 'S4'), ('Exponent', '<i4'), ('SourceChannelIDs', 'S8'),
+    ('SourceChannelLabels', 'S8')])
+
+TICK = 100  # microseconds, i.e. 10 KHz
+AD_ZERO = 3
+CONVERSION_FACTOR = 59605
+EXPONENT = -12
+
+
+def make_channel_data(n_channels: int, n_samples: int,
+                      seed: int = 0) -> np.ndarray:
+    """Noise with some spikes in ADC units."""
+    rng = np.random.default_rng(seed)
+    data = rng.normal(0, 200, size=(n_channels, n_samples))
+    for row in data:
+        positions = rng.integers(100, n_samples - 100, 30)
+        row[positions] -= 3000
+        row[positions + 3] += 1500
+    return np.round(data).astype(np.int32) + AD_ZERO
+
+
+def make_mcs_file(path: Path, n_channels: int = 6, n_samples: int = 20000,
+                  digital: Optional[np.ndarray] = None,
+                  spikes: Optional[List[np.ndarray]] = None,
+                  seed: int = 0, **dataset_options) -> Path:
+    """
+    Write an HDF5 file with the MCS layout: an AnalogStream with the
+    electrodes (preceded by a digital one if DIGITAL is passed) and,
+    optionally, a TimeStampStream with the SPIKES of each channel.
+    """
+    labels = [mea_60_electrode_index_to_label(i) for i in range(n_channels)]
+    with File(path, 'w') as h5:
+        recording = h5.create_group('/Data/Recording_0')
+        analogs = recording.create_group('AnalogStream')
+        streams = []
+        if digital is not None:
+            streams.append((np.reshape(digital, (1, -1)).astype(np.int32),
+                            [0]))
+        streams.append((make_channel_data(n_channels, n_samples, seed),
+                        labels))
+        for i, (data, stream_labels) in enumerate(streams):
+            stream = analogs.create_group(f'Stream_{i}')
+            info = np.zeros(len(stream_labels), dtype=INFO_CHANNEL_DTYPE)
+            info['ChannelID'] = np.arange(len(stream_labels)) + 100
+            info['RowIndex'] = np.arange(len(stream_labels))
+            info['Label'] = [str(label).encode() for label in stream_labels]
+            info['Unit'] = b'V'
+            info['Exponent'] = EXPONENT
+            info['ADZero'] = AD_ZERO
+            info['Tick'] = TICK
+            info['ConversionFactor'] = CONVERSION_FACTOR
+            stream['InfoChannel'] = info
+            stream.create_dataset('ChannelData', data=data,
+                                  **dataset_options)
+        if spikes is not None:
+            stream = recording.create_group('TimeStampStream/Stream_0')
+            info = np.zeros(len(spikes), dtype=INFO_TIMESTAMP_DTYPE)
+            info['TimeStampEntityID'] = np.arange(len(spikes))
+            info['Label'] = [str(label).encode()
+                             for label in labels[:len(spikes)]]
+            info['Unit'] = b's'
+            info['Exponent'] = -6
+            info['SourceChannelIDs'] = [str(i).encode()
+                                        for i in range(len(spikes))]
+            info['SourceChannelLabels'] = info['Label']
+            stream['InfoTimeStamp'] = info
+            for i, times in enumerate(spikes):
+                stream[f'TimeStampEntity_{i}'] = np.reshape(
+                    np.asarray(times, dtype=np.int64), (1, -1))
+    return path
@@ -0,0 +1,299 @@
+"""Tests of the experiment structures."""
+import pickle
+import unittest
+from copy import deepcopy
+
+import numpy as np
+
+from pycode.experiment import (DigitalSignal, Experiment, LazyPhases, Phase,
+                               PhaseProxy, Signal, SpikeTrains)
+from pycode.operation import (clear_around_stimulation_boundaries,
+                              instantaneous_firing_rate, mfr, psth,
+                              set_intervals_to_zero, spikes_count,
+                              spikes_count_matrix)
+from pycode.utils import mea_60_electrode_list
+
+
+class TestSpikeTrains(unittest.TestCase):
+    def setUp(self):
+        # times in seconds at 10 KHz
+        self.peaks = {12: np.array([0.5, 0.1, 0.3]), 21: np.array([]),
+                      47: np.array([0.0001, 0.2, 0.25, 0.9])}
+        self.amplitudes = {12: np.array([1., 2., 3.]), 21: np.array([]),
+                           47: np.array([4., 5., 6., 7.])}
+        self.spikes = SpikeTrains.from_dict(self.peaks, 10000,
+                                            self.amplitudes)
+
+    def test_layout(self):
+        self.assertEqual(self.spikes.labels.tolist(), [12, 21, 47])
+        self.assertEqual(self.spikes.offsets.tolist(), [0, 3, 3, 7])
+        self.assertEqual(self.spikes.indices.dtype, np.int64)
+        self.assertEqual(self.spikes.n_spikes(), 7)
+        # each train is sorted, with its amplitudes
+        self.assertEqual(self.spikes.samples(12).tolist(), [1000, 3000, 5000])
+        self.assertEqual(self.spikes.spikes_amplitudes(12).tolist(),
+                         [2., 3., 1.])
+        self.assertTrue(np.shares_memory(self.spikes.samples(47),
+                                         self.spikes.indices))
+        self.assertTrue(np.allclose(self.spikes.times(47), self.peaks[47]))
+        self.assertEqual(len(self.spikes.samples(21)), 0)
+        spikes = SpikeTrains.from_dict(self.peaks, 10000, dtype=np.int32)
+        self.assertEqual(spikes.indices.dtype, np.int32)
+        self.assertIsNone(spikes.spikes_amplitudes(12))
+
+    def test_counts_and_window(self):
+        self.assertEqual(self.spikes.counts().tolist(), [3, 0, 4])
+        self.assertEqual(self.spikes.counts(0.1, 0.3).tolist(), [2, 0, 2])
+        self.assertEqual(self.spikes.counts(t_start=0.4).tolist(), [1, 0, 1])
+        window = self.spikes.window(0.1, 0.3)
+        self.assertEqual(window.offsets.tolist(), [0, 2, 2, 4])
+        self.assertEqual(window.samples(47).tolist(), [2000, 2500])
+        self.assertEqual(window.spikes_amplitudes(47).tolist(), [5., 6.])
+
+    def test_count_matrix(self):
+        starts = np.array([0, 0.1, 0.2, 0.3, 0.6, 0.5])
+        stops = np.array([1, 0.3, 0.25, 0.2, 1, 0.5])
+        counts = self.spikes.count_matrix(starts, stops)
+        self.assertEqual(counts.shape, (3, 6))
+        for j, (start, stop) in enumerate(zip(starts, stops)):
+            self.assertEqual(counts[:, j].tolist(),
+                             self.spikes.counts(start, stop).tolist())
+        self.assertEqual(counts[:, 5].tolist(), [1, 0, 0])
+        self.assertEqual(self.spikes.count_matrix(
+            [0.1, 0.2], [0.2, 0.3], closed=False).tolist(),
+            [[1, 0], [0, 0], [0, 2]])
+
+    def test_peaks_view(self):
+        phase = Phase('phase', self.spikes, None, 10000, 1)
+        self.assertEqual(list(phase.peaks), [12, 21, 47])
+        self.assertIn(47, phase.peaks)
+        self.assertNotIn(48, phase.peaks)
+        self.assertTrue(np.allclose(phase.peaks[12], [0.1, 0.3, 0.5]))
+        self.assertEqual(phase.amplitudes[47].tolist(), [4., 5., 6., 7.])
+        # the times are computed at each access, the in place changes would
+        # be lost
+        times = phase.peaks[12]
+        with self.assertRaises(ValueError):
+            times[0] = 0.15
+        phase.peaks[12] = np.array([0.7])
+        phase.peaks[60] = np.array([0.2, 0.1])
+        self.assertEqual(phase.spikes.labels.tolist(), [12, 21, 47, 60])
+        self.assertEqual(phase.spikes.samples(60).tolist(), [1000, 2000])
+        self.assertEqual(phase.spikes.counts().tolist(), [1, 0, 4, 2])
+        del phase.peaks[21]
+        self.assertEqual(list(phase.peaks), [12, 47, 60])
+        self.assertEqual(phase.amplitudes[47].tolist(), [4., 5., 6., 7.])
+        self.assertRaises(KeyError, phase.peaks.__getitem__, 21)
+
+    def test_phase_from_dict(self):
+        phase = Phase('phase', self.peaks, None, 10000, 1,
+                      amplitudes=self.amplitudes)
+        self.assertEqual(phase.spikes.counts().tolist(), [3, 0, 4])
+        self.assertEqual(phase.to_dict()['peaks'].shape, (3, 2))
+        copy = pickle.loads(pickle.dumps(phase))
+        self.assertTrue(np.array_equal(copy.spikes.indices,
+                                       phase.spikes.indices))
+        self.assertEqual(list(copy.peaks), [12, 21, 47])
+
+    def test_statistics(self):
+        phase = Phase('phase', self.spikes, None, 10000, 2)
+        experiment = Experiment('exp', '', '', [phase])
+        self.assertEqual(spikes_count(experiment, 0),
+                         [(12, 3), (21, 0), (47, 4)])
+        self.assertEqual(spikes_count(experiment, 0, (0.2, 0.5)),
+                         [(12, 2), (21, 0), (47, 2)])
+        self.assertEqual(mfr(experiment, 0), [(12, 1.5), (21, 0), (47, 2)])
+        labels, counts = spikes_count_matrix(experiment, 0,
+                                             [(0.2, 0.5), (0, 0.1)])
+        self.assertEqual(labels.tolist(), [12, 21, 47])
+        self.assertEqual(counts.tolist(), [[2, 1], [0, 0], [2, 1]])
+        electrodes = mea_60_electrode_list(experiment.grounded_el)
+        rates = dict(zip(electrodes, instantaneous_firing_rate(experiment, 0)))
+        self.assertTrue(np.allclose(rates[12], [0.2, 0.2]))
+        self.assertTrue(np.allclose(rates[47], [0.1999, 0.05, 0.65]))
+        self.assertEqual(len(rates[21]), 0)
+        self.assertEqual(len(rates[13]), 0)
+        rates = dict(zip(electrodes, instantaneous_firing_rate(
+            experiment, 0, (0.2, 0.5))))
+        self.assertTrue(np.allclose(rates[12], [0.2]))
+        self.assertTrue(np.allclose(rates[47], [0.05]))
+
+    def test_psth(self):
+        phase = Phase('phase', self.spikes, None, 10000, 2)
+        experiment = Experiment('exp', '', '', [phase], [21])
+        histograms = dict(psth(experiment, 0, [0.02, 0.22], 0.1, 3))
+        self.assertEqual(len(histograms), 59)
+        self.assertNotIn(21, histograms)
+        # [0.02, 0.12), ..., [0.22, 0.32) and [0.22, 0.32), ..., [0.42, 0.52)
+        self.assertEqual(histograms[12], [2, 0, 2])
+        self.assertEqual(histograms[47], [1, 1, 1])
+        self.assertEqual(histograms[13], [0, 0, 0])
+        self.assertEqual(psth(experiment, 0, [0.02, 0.22], 0.1, 3, net=True),
+                         [3, 1, 3])
+
+
+class TestDigitalSignal(unittest.TestCase):
+    def test_dense(self):
+        # starting and ending ON
+        data = np.array([5, 5, 0, 0, 5, 0, 0, 5], dtype=np.int32)
+        digital = DigitalSignal.from_dense(data, 10)
+        self.assertEqual(digital.edges.tolist(), [0, 2, 4, 5, 7, 8])
+        self.assertEqual(digital.intervals(False).to_list(),
+                         [(0, 2), (4, 5), (7, 8)])
+        self.assertEqual(digital.intervals().to_list()[1], (0.4, 0.5))
+        self.assertEqual(digital.data.shape, (8, 1))
+        self.assertEqual(digital.data.dtype, np.int32)
+        self.assertTrue(np.array_equal(digital.data[:, 0], data))
+        self.assertEqual(digital.nbytes(), 48)
+        for data in [np.zeros(4), np.ones(4), np.array([])]:
+            digital = DigitalSignal.from_dense(data, 10)
+            self.assertEqual(len(digital.edges), 0)
+            self.assertTrue(np.array_equal(digital.data[:, 0], 0 * data))
+
+    def test_phase(self):
+        digital = DigitalSignal(np.array([10, 20]), 100, 10)
+        phase = Phase('stim', {}, digital, 10, 10)
+        self.assertEqual(phase.nbytes(), 8 + 16)
+        copy = phase.replace()
+        self.assertIs(copy.digital.edges, digital.edges)
+        self.assertFalse(digital.edges.flags.writeable)
+        self.assertEqual(copy.digital.data.sum(), 10)
+
+
+class TestLazyPhases(unittest.TestCase):
+    def setUp(self):
+        self.loads = []
+        # each phase has 10 spikes: 80 bytes of indices, 16 of offsets
+        self.phases = LazyPhases(self.load, 4, max_bytes=200)
+
+    def load(self, index):
+        self.loads.append(index)
+        phase = Phase(f'phase{index}', {12: np.arange(10) / 10000}, None,
+                      10000, 1)
+        phase.order = index
+        return phase
+
+    def test_lru(self):
+        self.assertEqual(len(self.phases), 4)
+        self.assertIsInstance(self.phases[0], PhaseProxy)
+        self.assertEqual(self.loads, [])
+        self.assertEqual(self.phases[0].order, 0)
+        self.assertEqual(self.phases[1].name, 'phase1')
+        self.assertEqual(self.phases[0].spikes.n_spikes(), 10)
+        self.assertEqual(self.loads, [0, 1])
+        # the least recently used phase is evicted
+        self.assertEqual(str(self.phases[-1]), 'phase3')
+        self.assertEqual(self.loads, [0, 1, 3])
+        self.assertFalse(self.phases.is_loaded(1))
+        self.assertTrue(self.phases.is_loaded(0))
+        self.assertEqual(self.phases.cached_bytes, 192)
+        self.phases[1].name
+        self.assertEqual(self.loads, [0, 1, 3, 1])
+        self.phases.set_max_bytes(None)
+        for phase in self.phases:
+            phase.order
+        self.assertEqual(self.loads, [0, 1, 3, 1, 0, 2])
+
+    def test_pinned(self):
+        # changed phases are never evicted
+        self.phases[0].div = 40
+        self.phases[1] = Phase('new', {}, None, 10000, 1)
+        for phase in self.phases[2:]:
+            phase.order
+        self.assertEqual(self.phases[0].div, 40)
+        self.assertEqual(self.phases[1].name, 'new')
+        self.assertEqual(self.loads, [0, 2, 3])
+
+    def test_changed_through_views(self):
+        # changes through the peaks or the spikes pin the phase
+        self.phases[0].peaks[12] = np.array([0.5])
+        del self.phases[1].peaks[12]
+        self.phases[2].spikes.set_times(60, np.array([0.1, 0.2]))
+        indices = self.phases[3].spikes.indices
+        self.assertFalse(indices.flags.writeable)
+        self.assertRaises(ValueError, indices.__setitem__, 0, 1)
+        self.phases[3].order
+        self.assertEqual(self.phases[0].spikes.n_spikes(), 1)
+        self.assertEqual(list(self.phases[1].peaks), [])
+        self.assertEqual(list(self.phases[2].peaks), [12, 60])
+        self.assertEqual(self.loads, [0, 1, 2, 3])
+        self.assertEqual(sorted(self.phases.pinned), [0, 1, 2])
+        # the copies are not bound to the LazyPhases
+        copy = pickle.loads(pickle.dumps(self.phases[3]))
+        self.assertIsNone(copy.spikes.on_change)
+
+    def test_copy(self):
+        experiment = Experiment('exp', '', '', self.phases)
+        for copy in [deepcopy(self.phases[2]),
+                     pickle.loads(pickle.dumps(self.phases[2]))]:
+            self.assertIsInstance(copy, Phase)
+            self.assertEqual(copy.order, 2)
+        self.assertEqual(experiment.to_dict()['phases'][3]['order'], 3)
+
+
+class TestStructuralSharing(unittest.TestCase):
+    def setUp(self):
+        digital = np.zeros((10000, 1))
+        digital[2000:4000] = 1
+        peaks = {12: np.array([0.1, 0.21, 0.3, 0.45]), 47: np.array([0.25])}
+        self.basal = Phase('basal', peaks, None, 10000, 1)
+        self.stim = Phase('stim', SpikeTrains.from_dict(
+            peaks, 10000, {12: np.arange(4.), 47: np.array([9.])}),
+            Signal(digital, 10000), 10000, 1)
+        self.stim.div = 40
+        self.experiment = Experiment('exp', '', '', [self.basal, self.stim])
+
+    def test_replace(self):
+        phase = self.stim.replace(durate=2)
+        self.assertEqual((phase.durate, phase.div), (2, 40))
+        self.assertIs(phase.digital.data, self.stim.digital.data)
+        self.assertIs(phase.spikes.indices, self.stim.spikes.indices)
+        self.assertFalse(self.stim.digital.data.flags.writeable)
+        self.assertFalse(self.stim.spikes.indices.flags.writeable)
+        # rebuilding the spikes of a copy leaves the original untouched
+        phase.peaks[12] = np.array([0.5])
+        self.assertEqual(self.stim.spikes.counts().tolist(), [4, 1])
+        self.assertRaises(AssertionError, self.stim.replace, peaks={})
+
+    def test_set_intervals_to_zero(self):
+        experiment = set_intervals_to_zero(self.experiment, 1,
+                                           [(0.2, 0.25), (0.4, 0.5)])
+        self.assertIsNot(experiment, self.experiment)
+        self.assertIs(experiment.phases[0].spikes.indices,
+                      self.basal.spikes.indices)
+        stim = experiment.phases[1]
+        self.assertTrue(np.allclose(stim.peaks[12], [0.1, 0.3]))
+        self.assertEqual(len(stim.peaks[47]), 0)
+        self.assertEqual(stim.amplitudes[12].tolist(), [0., 2.])
+        self.assertIs(stim.digital.data, self.stim.digital.data)
+        self.assertEqual(self.stim.spikes.counts().tolist(), [4, 1])
+        # the stimulation starts at 0.2 and ends at 0.4 seconds
+        cleared = clear_around_stimulation_boundaries(self.experiment, 1,
+                                                      0.06)
+        self.assertTrue(np.allclose(cleared.phases[1].peaks[12], [0.1, 0.3]))
+
+    def test_lazy_replace(self):
+        phases = LazyPhases(lambda i: self.experiment.phases[i].replace(), 2)
+        experiment = Experiment('exp', '', '', phases)
+        phases[0].name
+        changed = set_intervals_to_zero(experiment, 1, [(0, 1)])
+        self.assertIsInstance(changed.phases, LazyPhases)
+        self.assertEqual(changed.phases[1].spikes.n_spikes(), 0)
+        self.assertIs(changed.phases[0].spikes.indices,
+                      phases[0].spikes.indices)
+        self.assertEqual(phases[1].spikes.n_spikes(), 5)
+        changed.phases[0].peaks[12] = np.array([0.5])
+        self.assertEqual(phases[0].spikes.n_spikes(), 5)
+
+    def test_unchanged_phases_isolation(self):
+        experiment = set_intervals_to_zero(self.experiment, 0, [(0, 1)])
+        experiment.phases[1].peaks[12] = np.array([0.5])
+        experiment.phases[1].div = 41
+        self.assertEqual(self.stim.spikes.counts().tolist(), [4, 1])
+        self.assertEqual(self.stim.div, 40)
+        self.assertFalse(self.stim.spikes.indices.flags.writeable)
+        self.assertFalse(self.stim.digital.data.flags.writeable)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=1)
@@ -0,0 +1,323 @@
+"""Tests of the MultiChannel HDF5 classes on synthetic files."""
+import tempfile
+import unittest
+from pathlib import Path
+
+import numpy as np
+from h5py import File
+
+from pycode.hdf5 import (H5_FILES, H5Content, H5FilePool, aligned_block_size,
+                         chunk_cache_settings, memmap_dataset,
+                         read_time_stamps)
+from pycode.io import (load_peaks_from_hdf5, load_raw_signal_from_hdf5,
+                       load_raw_signals_from_hdf5)
+from pycode.utils import mea_60_electrode_index_to_label
+
+from synthetic_h5 import (AD_ZERO, CONVERSION_FACTOR, EXPONENT,
+                          make_mcs_file)
+
+
+class TestAnalogStream(unittest.TestCase):
+    N_CHANNELS = 5
+    N_SAMPLES = 3000
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = make_mcs_file(
+            Path(self.tmp.name).joinpath('00000_DIV40_Basal_1.h5'),
+            n_channels=self.N_CHANNELS, n_samples=self.N_SAMPLES)
+        with File(self.path, 'r') as h5:
+            self.mantissas = h5['/Data/Recording_0/AnalogStream/Stream_0/'
+                                'ChannelData'][:]
+        self.expected = (self.mantissas - AD_ZERO) * CONVERSION_FACTOR * \
+            np.power(10., EXPONENT)
+        self.content = H5Content(self.path)
+        self.analog = self.content.analogs[0]
+
+    def tearDown(self):
+        self.content.close()
+        H5_FILES.close_all()
+        self.tmp.cleanup()
+
+    def test_parse_signal(self):
+        for i in range(self.N_CHANNELS):
+            label = mea_60_electrode_index_to_label(i)
+            signal = self.analog.parse_signal(label)
+            self.assertEqual(signal.shape, (self.N_SAMPLES, 1))
+            self.assertTrue(np.array_equal(signal[:, 0], self.expected[i]))
+            signal = self.analog.parse_signal(label, dtype=np.float32)
+            self.assertEqual(signal.dtype, np.float32)
+            self.assertTrue(np.allclose(signal[:, 0], self.expected[i]))
+
+    def test_parse_signals(self):
+        labels = [mea_60_electrode_index_to_label(i) for i in [3, 0, 1, 2]]
+        signals = self.analog.parse_signals(labels)
+        self.assertTrue(np.array_equal(signals,
+                                       self.expected[[3, 0, 1, 2]]))
+        out = np.empty((len(labels), self.N_SAMPLES), dtype=np.float32)
+        self.assertIs(self.analog.parse_signals(labels, out=out), out)
+        self.assertTrue(np.allclose(out, self.expected[[3, 0, 1, 2]]))
+
+    def test_memmap(self):
+        with H5Content(self.path, memmap=True) as content:
+            analog = content.analogs[0]
+            self.assertIsInstance(analog.mapped_channels, np.memmap)
+            self.assertTrue(np.array_equal(analog.mapped_channels,
+                                           self.mantissas))
+            label = mea_60_electrode_index_to_label(3)
+            raw = analog.raw_signal(label, 100, 200)
+            # a view on the mapped file, not a copy
+            self.assertTrue(np.shares_memory(raw, analog.mapped_channels))
+            self.assertTrue(np.array_equal(raw, self.mantissas[3, 100:200]))
+            self.assertTrue(np.array_equal(
+                analog.parse_signal(label, 0.01, 0.02)[:, 0],
+                self.expected[3, 100:200]))
+            labels = [mea_60_electrode_index_to_label(i) for i in [2, 0]]
+            self.assertTrue(np.array_equal(analog.parse_signals(labels),
+                                           self.expected[[2, 0]]))
+
+    def test_load_raw_signal(self):
+        signal = load_raw_signal_from_hdf5(self.path, 2)
+        self.assertEqual(signal.shape, (1, self.N_SAMPLES))
+        self.assertTrue(np.allclose(signal[0], self.expected[2] * 1e6))
+        # 10 KHz: from 0.1 s to 0.15 s are the samples [1000, 1500)
+        signal = load_raw_signal_from_hdf5(self.path, 2, t_start=0.1,
+                                           t_stop=0.15)
+        self.assertTrue(np.allclose(signal[0],
+                                    self.expected[2, 1000:1500] * 1e6))
+
+    def test_load_raw_signals(self):
+        data, labels = load_raw_signals_from_hdf5(self.path)
+        self.assertEqual(data.shape, (self.N_CHANNELS, self.N_SAMPLES))
+        self.assertEqual(labels.tolist(),
+                         [mea_60_electrode_index_to_label(i)
+                          for i in range(self.N_CHANNELS)])
+        for i, row in enumerate(data):
+            self.assertTrue(np.array_equal(
+                row, load_raw_signal_from_hdf5(self.path, i)[0]))
+        data, labels = load_raw_signals_from_hdf5(
+            self.path, [4, 1, 2], np.float32, t_start=0.1, t_stop=0.2)
+        self.assertEqual(data.dtype, np.float32)
+        self.assertEqual(labels.tolist(),
+                         [mea_60_electrode_index_to_label(i)
+                          for i in [4, 1, 2]])
+        self.assertTrue(np.allclose(data,
+                                    self.expected[[4, 1, 2], 1000:2000] * 1e6))
+        self.assertRaises(AssertionError, load_raw_signals_from_hdf5,
+                          self.path, 'some')
+
+    def test_time_range(self):
+        label = mea_60_electrode_index_to_label(1)
+        self.assertEqual(self.analog.samples_range(0.1, 0.15), (1000, 1500))
+        self.assertEqual(self.analog.samples_range(0.10001, None),
+                         (1001, self.N_SAMPLES))
+        self.assertEqual(self.analog.samples_range(-1, 10),
+                         (0, self.N_SAMPLES))
+        signal = self.analog.parse_signal(label, 0.1, 0.15)
+        self.assertEqual(signal.shape, (500, 1))
+        self.assertTrue(np.array_equal(signal[:, 0],
+                                       self.expected[1, 1000:1500]))
+        self.assertTrue(np.array_equal(
+            self.content.get_signal(0, label, t_stop=0.01)[:, 0],
+            self.expected[1, :100]))
+        self.assertEqual(self.analog.parse_signal(label, 0.2, 0.1).shape,
+                         (0, 1))
+
+    def test_samples_range(self):
+        labels = [mea_60_electrode_index_to_label(i) for i in [4, 0, 1]]
+        signals = self.analog.parse_signals_samples(labels, 123, 2345)
+        self.assertTrue(np.array_equal(signals,
+                                       self.expected[[4, 0, 1], 123:2345]))
+        self.assertTrue(np.array_equal(
+            self.analog.parse_signals(labels, t_start=0.2),
+            self.expected[[4, 0, 1], 2000:]))
+        signal = self.analog.parse_signal_samples(labels[0], stop=17)
+        self.assertTrue(np.array_equal(signal[:, 0], self.expected[4, :17]))
+
+
+class TestH5ContentMetadata(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.spikes = [np.array([100, 2500, 7300]), np.array([]),
+                       np.array([400])]
+        self.path = make_mcs_file(
+            Path(self.tmp.name).joinpath('00000_DIV40_Stim_1.h5'),
+            n_channels=3, n_samples=1000, digital=np.zeros(1000),
+            spikes=self.spikes)
+
+    def tearDown(self):
+        H5_FILES.close_all()
+        self.tmp.cleanup()
+
+    def test_metadata(self):
+        with H5Content(self.path) as content:
+            self.check_metadata(content)
+
+    def check_metadata(self, content: H5Content):
+        self.assertEqual(len(content.analogs), 2)
+        analog = content.analogs[1]
+        labels = [mea_60_electrode_index_to_label(i) for i in range(3)]
+        self.assertEqual(analog.label_dict, {label: i for i, label in
+                                             enumerate(labels)})
+        self.assertEqual([int(c.label) for c in analog.info_channels],
+                         labels)
+        self.assertTrue(np.array_equal(analog.ticks, [100, 100, 100]))
+        time_stamps = content.time_stamps[0]
+        self.assertEqual(time_stamps.label_dict, {label: i for i, label in
+                                                  enumerate(labels)})
+        for label, spikes in zip(labels, self.spikes):
+            self.assertTrue(np.array_equal(
+                time_stamps.get_channel_events(label), spikes))
+            self.assertTrue(np.array_equal(content.get_events(1, label),
+                                           spikes / 100))
+
+    def test_bulk_events(self):
+        with File(self.path, 'r') as h5:
+            group = h5['/Data/Recording_0/TimeStampStream/Stream_0']
+            for workers in [1, 3]:
+                events = read_time_stamps(group, workers)
+                self.assertEqual(events.values.dtype, np.int64)
+                self.assertEqual(events.offsets.tolist(), [0, 3, 3, 4])
+                for channel_events, spikes in zip(events.split(),
+                                                  self.spikes):
+                    self.assertTrue(np.array_equal(channel_events, spikes))
+            events = read_time_stamps(group, in_seconds=True)
+            self.assertTrue(np.allclose(events[0], self.spikes[0] * 1e-6))
+            peaks = load_peaks_from_hdf5(group, workers=2)
+            self.assertEqual(len(peaks), 3)
+            for channel_events, spikes in zip(peaks.values(), self.spikes):
+                self.assertTrue(np.array_equal(channel_events, spikes))
+
+    def test_loaded_events(self):
+        with H5Content(self.path) as content:
+            time_stamps = content.time_stamps[0]
+            self.assertIs(time_stamps.load_events(), time_stamps.events)
+            for i, spikes in enumerate(self.spikes):
+                label = mea_60_electrode_index_to_label(i)
+                events = time_stamps.get_channel_events(label)
+                self.assertTrue(np.shares_memory(
+                    events, time_stamps.events.values) or len(events) == 0)
+                self.assertTrue(np.array_equal(events, spikes))
+            self.assertIsNone(time_stamps.get_channel_events(99))
+
+
+class TestChunkCache(unittest.TestCase):
+    N_CHANNELS = 6
+    N_SAMPLES = 5000
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = make_mcs_file(
+            Path(self.tmp.name).joinpath('00000_DIV40_Basal_1.h5'),
+            n_channels=self.N_CHANNELS, n_samples=self.N_SAMPLES,
+            chunks=(4, 1000), compression='gzip')
+        with File(self.path, 'r') as h5:
+            self.mantissas = h5['/Data/Recording_0/AnalogStream/Stream_0/'
+                                'ChannelData'][:]
+        self.expected = (self.mantissas - AD_ZERO) * CONVERSION_FACTOR * \
+            np.power(10., EXPONENT)
+
+    def tearDown(self):
+        H5_FILES.close_all()
+        self.tmp.cleanup()
+
+    def test_settings(self):
+        with File(self.path, 'r') as h5:
+            dataset = h5['/Data/Recording_0/AnalogStream/Stream_0/'
+                         'ChannelData']
+            chunk_bytes = 4 * 1000 * 4
+            nbytes, nslots, w0 = chunk_cache_settings(dataset, 'by_channel')
+            self.assertEqual((nbytes, w0), (1 << 20, 0))
+            self.assertTrue(all(nslots % d for d in range(2, nslots)))
+            self.assertGreaterEqual(nslots, 100 * (nbytes // chunk_bytes))
+            self.assertEqual(chunk_cache_settings(dataset, 'by_time')[2], 1)
+            self.assertRaises(AssertionError, chunk_cache_settings, dataset,
+                              'unknown')
+            self.assertEqual(aligned_block_size(dataset, 2500), 2000)
+            self.assertEqual(aligned_block_size(dataset, 10), 1000)
+
+    def test_access_patterns(self):
+        labels = [mea_60_electrode_index_to_label(i) for i in range(6)]
+        for access in ['by_channel', 'by_time', 'random']:
+            with H5Content(self.path, access) as content:
+                analog = content.analogs[0]
+                nslots, nbytes, w0 = analog.data_channels.id\
+                    .get_access_plist().get_chunk_cache()
+                self.assertEqual((nbytes, nslots, w0), chunk_cache_settings(
+                    analog.data_channels, access))
+                self.assertTrue(np.array_equal(analog.parse_signals(labels),
+                                               self.expected))
+            # the settings of a dataset still open would be kept
+            del analog, content
+
+    def test_no_memmap_of_chunked_data(self):
+        with H5Content(self.path, memmap=True) as content:
+            analog = content.analogs[0]
+            self.assertIsNone(memmap_dataset(analog.data_channels))
+            self.assertIsNone(analog.mapped_channels)
+            label = mea_60_electrode_index_to_label(5)
+            self.assertTrue(np.array_equal(analog.raw_signal(label, 10, 20),
+                                           self.mantissas[5, 10:20]))
+            self.assertTrue(np.array_equal(analog.parse_signal(label)[:, 0],
+                                           self.expected[5]))
+
+    def test_iter_signals(self):
+        labels = [mea_60_electrode_index_to_label(i) for i in [1, 4]]
+        with H5Content(self.path, 'by_time') as content:
+            blocks = list(content.analogs[0].iter_signals(
+                labels, t_start=0.015, t_stop=0.45, block_size=2500))
+        self.assertEqual([start for start, _ in blocks], [150, 2000, 4000])
+        self.assertTrue(np.array_equal(
+            np.concatenate([block for _, block in blocks], axis=1),
+            self.expected[[1, 4], 150:4500]))
+
+
+class TestH5FilePool(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.paths = [make_mcs_file(Path(self.tmp.name).joinpath(f'{i}.h5'),
+                                    n_channels=1, n_samples=1000)
+                      for i in range(4)]
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_lru_eviction(self):
+        pool = H5FilePool(max_open=2)
+        for path in self.paths[:3]:
+            with pool.borrow(path) as h5file:
+                self.assertTrue(h5file.id.valid)
+        self.assertEqual(len(pool), 2)
+        self.assertNotIn(self.paths[0], pool)
+        # a hit makes the file the most recently used
+        with pool.borrow(self.paths[1]):
+            pass
+        with pool.borrow(self.paths[3]):
+            pass
+        self.assertIn(self.paths[1], pool)
+        self.assertNotIn(self.paths[2], pool)
+        pool.close_all()
+        self.assertEqual(len(pool), 0)
+
+    def test_borrowed_files_are_not_closed(self):
+        pool = H5FilePool(max_open=1)
+        first = pool.acquire(self.paths[0])
+        with pool.borrow(self.paths[1]) as second:
+            self.assertEqual(len(pool), 2)
+            self.assertTrue(first.id.valid)
+        self.assertFalse(second.id.valid)
+        self.assertFalse(pool.close(self.paths[0]))
+        pool.release(self.paths[0])
+        self.assertTrue(pool.close(self.paths[0]))
+        self.assertFalse(first.id.valid)
+
+    def test_h5_content_close(self):
+        with H5Content(self.paths[0]) as content:
+            self.assertIn(self.paths[0], H5_FILES)
+            self.assertFalse(H5_FILES.close(self.paths[0]))
+        content.close()
+        self.assertTrue(H5_FILES.close(self.paths[0]))
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=1)
@@ -0,0 +1,118 @@
+"""Tests of the index of the phase files on synthetic HDF5 files."""
+import os
+import tempfile
+import unittest
+from pathlib import Path
+
+import numpy as np
+
+from pycode.hdf5 import H5_FILES
+from pycode.index import INDEX_FILENAME, PhaseIndex, phase_record
+
+from synthetic_h5 import make_mcs_file
+
+
+class TestPhaseIndex(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = Path(self.tmp.name)
+        self.root.joinpath('00001').mkdir()
+        spikes = [np.arange(10), np.arange(5)]
+        self.paths = [
+            make_mcs_file(self.root.joinpath('00000_DIV40_Basal_1.h5'),
+                          n_channels=2, n_samples=10000, spikes=spikes),
+            make_mcs_file(self.root.joinpath('00000_DIV41_Stim_2.h5'),
+                          n_channels=2, n_samples=20000, spikes=spikes,
+                          digital=np.zeros(20000)),
+            make_mcs_file(self.root.joinpath('00001/00001_DIV45_Stim_1.h5'),
+                          n_channels=3, n_samples=5000, spikes=spikes[:1],
+                          digital=np.zeros(5000)),
+        ]
+        self.corrupted = self.root.joinpath('00001/00001_DIV45_Basal_2.h5')
+        self.corrupted.write_bytes(b'not an hdf5 file')
+
+    def tearDown(self):
+        H5_FILES.close_all()
+        self.tmp.cleanup()
+
+    def test_scan(self):
+        with PhaseIndex(self.root) as index:
+            self.assertEqual(index.update(), 4)
+            self.assertEqual(len(index), 4)
+            self.assertEqual(index.update(), 0)
+            record = index.get(self.paths[1])
+            self.assertEqual(record.name, '00000')
+            self.assertEqual(record.div, 41)
+            self.assertEqual(record.phase_type, 'Stim')
+            self.assertEqual(record.order, 2)
+            self.assertTrue(record.digital)
+            self.assertEqual(record.analog_streams, 2)
+            self.assertEqual(record.channels, 2)
+            self.assertEqual(record.sampling_frequency, 10000)
+            self.assertEqual(record.durate, 2)
+            self.assertEqual(record.spikes, 15)
+            self.assertIsNone(record.error)
+            self.assertEqual(record.phase_info().div, 41)
+            self.assertIsNotNone(index.get(self.corrupted).error)
+        self.assertTrue(self.root.joinpath(INDEX_FILENAME).exists())
+
+    def test_queries(self):
+        with PhaseIndex(self.root) as index:
+            index.update()
+            self.assertEqual(
+                [record.path for record in index.find(phase_type='STIM',
+                                                      min_div=41)],
+                [self.paths[1], self.paths[2]])
+            self.assertEqual(
+                [record.path for record in index.find(name='00001',
+                                                      digital=False)],
+                [self.corrupted])
+            self.assertEqual(
+                [record.path for record in
+                 index.query('channels = ? AND durate < ?', (2, 1.5))],
+                [self.paths[0]])
+
+    def test_incremental_update(self):
+        with PhaseIndex(self.root) as index:
+            index.update()
+        # a changed, a removed and a new file
+        make_mcs_file(self.paths[0], n_channels=4, n_samples=10000)
+        os.utime(self.paths[0], (1, 1))
+        self.paths[2].unlink()
+        new = make_mcs_file(self.root.joinpath('00001/00001_DIV46_Basal_3.h5'),
+                            n_channels=1, n_samples=1000)
+        with PhaseIndex(self.root) as index:
+            self.assertEqual(index.update(), 2)
+            self.assertEqual(len(index), 4)
+            self.assertEqual(index.get(self.paths[0]).channels, 4)
+            self.assertIsNone(index.get(self.paths[2]))
+            self.assertEqual(index.get(new).div, 46)
+
+    def test_phase_record(self):
+        other = self.root.joinpath('notes.txt')
+        other.write_text('not a phase')
+        self.assertIsNone(phase_record(other))
+        nested_index = self.paths[2].parent.joinpath(INDEX_FILENAME)
+        # without an index the file is only scanned
+        record = phase_record(self.paths[2])
+        self.assertEqual(record.div, 45)
+        self.assertFalse(self.root.joinpath(INDEX_FILENAME).exists())
+        self.assertFalse(nested_index.exists())
+        # the nearest index among the parents is used
+        with PhaseIndex(self.root) as index:
+            self.assertEqual(len(index), 0)
+        self.assertEqual(phase_record(self.paths[2]).div, 45)
+        self.assertFalse(nested_index.exists())
+        with PhaseIndex(self.root) as index:
+            self.assertEqual(len(index), 1)
+            self.assertIsNone(index.get(other))
+
+    def test_phase_record_without_index(self):
+        # the index can't be opened
+        self.root.joinpath(INDEX_FILENAME).write_bytes(b'not a database')
+        record = phase_record(self.paths[1])
+        self.assertEqual(record.spikes, 15)
+        self.assertIsNone(record.error)
+
+if __name__ == '__main__':
+    unittest.main(verbosity=1)
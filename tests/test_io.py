@@ -0,0 +1,271 @@
+"""Tests of the loading functions on synthetic HDF5 files."""
+import tempfile
+import unittest
+from pathlib import Path
+
+import numpy as np
+from h5py import File
+
+from pycode.experiment import (DigitalSignal, Experiment, Phase, Signal,
+                               SpikeTrains)
+from pycode.hdf5 import H5_FILES
+from pycode.io import (decode_digital, detect_phase, detect_spikes_from_hdf5,
+                       encode_digital, load_digital_from_hdf5,
+                       load_experiment_from_hdf5_files,
+                       load_raw_signal_from_hdf5, open_experiment,
+                       save_experiment)
+from pycode.operation import SpikeDetectionParams, detect_spikes
+from pycode.utils import mea_60_electrode_index_to_label
+
+from synthetic_h5 import make_mcs_file
+
+
+class TestDetectPhase(unittest.TestCase):
+    N_CHANNELS = 4
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = make_mcs_file(
+            Path(self.tmp.name).joinpath('00000_DIV40_Basal_1.h5'),
+            n_channels=self.N_CHANNELS)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_detect_phase(self):
+        phase = detect_phase(self.path)
+        self.assertEqual(len(phase.peaks), self.N_CHANNELS)
+        self.assertEqual(phase.sampling_frequency, 10000)
+        self.assertEqual(phase.durate, 2)
+        self.assertEqual(phase.div, 40)
+        for i in range(self.N_CHANNELS):
+            label = mea_60_electrode_index_to_label(i)
+            expected = detect_spikes(
+                load_raw_signal_from_hdf5(self.path, i), 10000)
+            self.assertGreater(len(expected), 0)
+            self.assertTrue(np.array_equal(phase.peaks[label],
+                                           expected.times))
+            self.assertTrue(np.array_equal(phase.amplitudes[label],
+                                           expected.amplitudes))
+
+    def test_detect_phase_zero_phase(self):
+        params = SpikeDetectionParams(zero_phase=True)
+        phase = detect_phase(self.path, params)
+        expected = detect_spikes(load_raw_signal_from_hdf5(self.path, 0),
+                                 10000, params)
+        self.assertTrue(np.array_equal(
+            phase.peaks[mea_60_electrode_index_to_label(0)], expected.times))
+
+    def test_detect_phase_parallel(self):
+        serial = detect_phase(self.path)
+        parallel = detect_phase(self.path, workers=2)
+        self.assertEqual(list(serial.peaks), list(parallel.peaks))
+        for label in serial.peaks:
+            self.assertTrue(np.array_equal(serial.peaks[label],
+                                           parallel.peaks[label]))
+
+    def test_detect_phase_parallel_chunked(self):
+        # chunked data can't be memory mapped by the workers
+        path = make_mcs_file(
+            Path(self.tmp.name).joinpath('00000_DIV40_Basal_2.h5'),
+            n_channels=self.N_CHANNELS, chunks=(2, 5000))
+        serial = detect_phase(self.path)
+        parallel = detect_phase(path, workers=2)
+        for label in serial.peaks:
+            self.assertTrue(np.array_equal(serial.peaks[label],
+                                           parallel.peaks[label]))
+
+
+class TestChunkedSpikeDetection(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = make_mcs_file(
+            Path(self.tmp.name).joinpath('00000_DIV40_Basal_1.h5'),
+            n_channels=2, n_samples=30000, seed=3)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_chunked_detection(self):
+        for electrode_index in range(2):
+            expected = detect_spikes(
+                load_raw_signal_from_hdf5(self.path, electrode_index), 10000)
+            # chunk sizes that cut the signal also inside the peaks
+            for chunk_size in [30000, 4096, 1000, 77]:
+                detected = detect_spikes_from_hdf5(
+                    self.path, electrode_index, chunk_size=chunk_size)
+                self.assertTrue(np.array_equal(detected.indices,
+                                               expected.indices))
+                self.assertTrue(np.array_equal(detected.amplitudes,
+                                               expected.amplitudes))
+
+
+class TestLoadExperiment(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        folder = Path(self.tmp.name)
+        self.spikes = {}
+        self.paths = []
+        for order, phase_type in enumerate(['Basal', 'Stim', 'Basal']):
+            spikes = [np.arange(order, 1000, 100 + order), np.array([7])]
+            path = make_mcs_file(
+                folder.joinpath(f'00000_DIV40_{phase_type}_{order}.h5'),
+                n_channels=2, n_samples=1000, spikes=spikes,
+                digital=np.zeros(1000) if phase_type == 'Stim' else None)
+            self.spikes[path] = spikes
+            self.paths.append(path)
+        # a missing and a corrupted file among the good ones
+        self.paths.insert(1, folder.joinpath('00000_DIV40_Basal_9.h5'))
+        corrupted = folder.joinpath('00000_DIV40_Basal_8.h5')
+        corrupted.write_bytes(b'not an hdf5 file')
+        self.paths.append(corrupted)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def check_experiment(self, experiment, errors):
+        self.assertEqual(set(errors), set(self.paths[1::3]))
+        self.assertEqual(len(experiment.phases), 3)
+        self.assertEqual(experiment.name, '00000')
+        for phase, path in zip(experiment.phases, self.spikes):
+            self.assertEqual(phase.digital is not None, 'Stim' in path.name)
+            # the time stamps are in microseconds, the peaks in seconds
+            # rounded to the samples
+            for peaks, spikes in zip(phase.peaks.values(), self.spikes[path]):
+                self.assertTrue(np.array_equal(
+                    peaks, np.rint(spikes * 1e-6 * 10000) / 10000))
+
+    def test_serial(self):
+        errors = {}
+        self.check_experiment(
+            load_experiment_from_hdf5_files(self.paths, errors=errors),
+            errors)
+
+    def test_parallel(self):
+        for executor in ['thread', 'process']:
+            errors = {}
+            self.check_experiment(
+                load_experiment_from_hdf5_files(self.paths, workers=3,
+                                                executor=executor,
+                                                errors=errors),
+                errors)
+
+    def test_lazy(self):
+        errors = {}
+        experiment = load_experiment_from_hdf5_files(self.paths, lazy=True,
+                                                     errors=errors)
+        # the corrupted file fails only when its phase is loaded
+        self.assertEqual(set(errors), {self.paths[1]})
+        self.assertEqual(len(experiment.phases), 4)
+        self.assertEqual(experiment.name, '00000')
+        self.assertFalse(any(experiment.phases.is_loaded(i)
+                             for i in range(4)))
+        self.assertIsNotNone(experiment.phases[1].digital)
+        self.assertEqual(experiment.phases.is_loaded(1), True)
+        self.assertFalse(experiment.phases.is_loaded(0))
+        self.assertRaises(OSError, getattr, experiment.phases[3], 'peaks')
+
+
+class TestLoadDigital(unittest.TestCase):
+    def test_blocks(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            # ON at the beginning and at the end, runs across the blocks
+            digital = np.zeros(1000)
+            digital[:30] = 3
+            digital[100:400] = 3
+            digital[990:] = 3
+            path = make_mcs_file(Path(tmp).joinpath('00000_DIV40_Stim_1.h5'),
+                                 n_channels=1, n_samples=1000,
+                                 digital=digital)
+            with File(path, 'r') as h5file:
+                stream = h5file['/Data/Recording_0/AnalogStream/Stream_0']
+                for block_size in [1000, 100, 7]:
+                    signal = load_digital_from_hdf5(stream, block_size)
+                    self.assertEqual(signal.edges.tolist(),
+                                     [0, 30, 100, 400, 990, 1000])
+                    self.assertEqual(signal.high, 3)
+                    self.assertEqual(signal.sampling_frequency, 10000)
+                    self.assertTrue(np.array_equal(signal.data[:, 0],
+                                                   digital))
+
+
+class TestExperimentFile(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = Path(self.tmp.name).joinpath('00000.h5')
+        digital = np.zeros(5000)
+        digital[1000:1500] = 1
+        digital[3000:3010] = 1
+        peaks = {12: np.array([0.1, 0.3]), 47: np.array([0.2])}
+        basal = Phase('basal', peaks, None, 10000, 0.5)
+        basal.div, basal.phase_type, basal.order = 40, 'Basal', 1
+        stim = Phase('stim', SpikeTrains.from_dict(
+            peaks, 10000, {12: np.array([1., 2.]), 47: np.array([3.])}),
+            Signal(digital, 10000), 10000, 0.5)
+        stim.rest = 'x'
+        edges = Phase('edges', {},
+                      DigitalSignal(np.array([3, 7]), 10, 10000), 10000, 0.5)
+        self.experiment = Experiment('00000', 'folder', 'today',
+                                     [basal, stim, edges], [15])
+        self.experiment.applied_operations = [('mfr', ['0'])]
+
+    def tearDown(self):
+        H5_FILES.close_all()
+        self.tmp.cleanup()
+
+    def test_run_length(self):
+        for data in [np.array([0, 0, 1, 1, 1, 0]), np.array([1]),
+                     np.array([])]:
+            starts, values = encode_digital(data)
+            self.assertTrue(np.array_equal(
+                decode_digital(starts, values, len(data)), data))
+        starts, values = encode_digital(np.array([0, 0, 1, 1, 1, 0]))
+        self.assertEqual(starts.tolist(), [0, 2, 5])
+        self.assertEqual(values.tolist(), [0, 1, 0])
+
+    def test_round_trip(self):
+        save_experiment(self.experiment, self.path)
+        experiment = open_experiment(self.path)
+        self.assertEqual(experiment.name, '00000')
+        self.assertEqual(experiment.path, 'folder')
+        self.assertEqual(experiment.grounded_el, [15])
+        self.assertEqual(experiment.applied_operations, [('mfr', ['0'])])
+        self.assertEqual(len(experiment.phases), 3)
+        # the phases are loaded only when accessed
+        self.assertFalse(experiment.phases.is_loaded(0))
+        stim = experiment.phases[1]
+        self.assertFalse(experiment.phases.is_loaded(0))
+        self.assertIs(experiment.phases[1], stim)
+        for phase, expected in zip(experiment.phases,
+                                   self.experiment.phases):
+            self.assertEqual(phase.name, expected.name)
+            self.assertEqual(phase.sampling_frequency, 10000)
+            self.assertEqual(phase.durate, 0.5)
+            self.assertEqual(phase.div, expected.div)
+            self.assertEqual(phase.phase_type, expected.phase_type)
+            self.assertEqual(phase.order, expected.order)
+            self.assertEqual(phase.rest, expected.rest)
+            self.assertTrue(np.array_equal(phase.spikes.indices,
+                                           expected.spikes.indices))
+            self.assertEqual(list(phase.peaks), list(expected.peaks))
+        self.assertIsNone(experiment.phases[0].digital)
+        self.assertIsNone(experiment.phases[0].amplitudes)
+        self.assertEqual(stim.amplitudes[12].tolist(), [1., 2.])
+        self.assertTrue(np.array_equal(
+            stim.digital.data, self.experiment.phases[1].digital.data))
+        edges = experiment.phases[2].digital
+        self.assertIsInstance(edges, DigitalSignal)
+        self.assertEqual((edges.edges.tolist(), edges.length), ([3, 7], 10))
+        # an opened file can be overwritten, also with its own phases
+        experiment = open_experiment(self.path)
+        save_experiment(experiment, self.path)
+        experiment = open_experiment(self.path)
+        self.assertEqual(experiment.phases[0].div, 40)
+        self.assertEqual(experiment.phases[1].spikes.n_spikes(), 3)
+        # a file being read can't be overwritten
+        with H5_FILES.borrow(self.path):
+            self.assertRaises(OSError, save_experiment, experiment, self.path)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=1)
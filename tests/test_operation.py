@@ -0,0 +1,162 @@
+"""Tests of the signal processing operations on synthetic data."""
+import unittest
+
+import numpy as np
+from scipy import signal
+
+from pycode.operation import (_filter_design, compute_threshold,
+                              compute_thresholds, StreamingFilter,
+                              filter_design, filter_signal, filter_signals,
+                              filter_signals_zero_phase,
+                              spike_detection, spike_detection_core,
+                              spike_detection_core_vectorized)
+
+
+def make_spiking_signal(n_samples: int, n_spikes: int,
+                        seed: int = 0) -> np.ndarray:
+    """Gaussian noise with some biphasic spikes on top, as a row array."""
+    rng = np.random.default_rng(seed)
+    data = rng.standard_normal(n_samples)
+    positions = rng.integers(10, n_samples - 10, n_spikes)
+    data[positions] -= 12
+    data[positions + 3] += 6
+    return data.reshape(1, n_samples)
+
+
+class TestSpikeDetectionEngines(unittest.TestCase):
+    """The vectorized engine should find the same peaks of the loop one."""
+
+    def assertSameDetection(self, a, b):
+        self.assertTrue(np.array_equal(a.indices, b.indices))
+        self.assertTrue(np.array_equal(a.amplitudes, b.amplitudes))
+
+    def test_engines_equivalence(self):
+        data = make_spiking_signal(20000, 40)
+        for peak_duration, refr_time in [(2, 1), (1, 0), (0.1, 2), (3, 5)]:
+            self.assertSameDetection(
+                spike_detection_core(data, 5, peak_duration, refr_time, 1e4),
+                spike_detection_core_vectorized(
+                    data, 5, peak_duration, refr_time, 1e4))
+
+    def test_engines_equivalence_with_ties(self):
+        data = np.round(make_spiking_signal(5000, 10, seed=1))
+        self.assertSameDetection(
+            spike_detection_core(data, 3, 2, 1, 1e4),
+            spike_detection_core_vectorized(data, 3, 2, 1, 1e4))
+
+    def test_spike_detection_engine_selection(self):
+        data = make_spiking_signal(20000, 40, seed=2)
+        self.assertSameDetection(spike_detection(data, engine='loop'),
+                                 spike_detection(data, engine='vectorized'))
+        self.assertRaises(AssertionError, spike_detection, data, 'unknown')
+
+    def test_compact_result(self):
+        data = make_spiking_signal(20000, 40, seed=5)
+        detected = spike_detection(data, engine='vectorized')
+        self.assertEqual(detected.indices.dtype, np.int64)
+        self.assertEqual(detected.amplitudes.dtype, np.float32)
+        self.assertEqual(len(detected.amplitudes), len(detected))
+        self.assertTrue(np.all(detected.indices > 0))
+        self.assertTrue(np.allclose(detected.times * 10000,
+                                    detected.indices))
+
+
+class TestComputeThresholds(unittest.TestCase):
+    def test_batched_thresholds(self):
+        rng = np.random.default_rng(3)
+        data = rng.standard_normal((5, 30001)) * np.arange(1, 6)[:, None]
+        thresholds = compute_thresholds(data)
+        self.assertEqual(thresholds.shape, (5,))
+        for row, threshold in zip(data, thresholds):
+            self.assertEqual(compute_threshold(row.reshape(1, -1)),
+                             threshold)
+
+    def test_robust_estimators(self):
+        data = make_spiking_signal(40000, 200, seed=4)
+        for estimator in ['median', 'mad']:
+            # for gaussian noise all estimators give about its std
+            self.assertAlmostEqual(
+                compute_thresholds(data, multCoeff=1, estimator=estimator)[0],
+                1, delta=0.15)
+        self.assertRaises(AssertionError, compute_thresholds, data, 10000, 8,
+                          'unknown')
+
+
+class TestFiltering(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(6)
+        self.data = rng.standard_normal((4, 10000))
+
+    def test_block_filtering(self):
+        filtered = filter_signals(self.data, 10000, 70)
+        self.assertEqual(filtered.shape, self.data.shape)
+        for row, filtered_row in zip(self.data, filtered):
+            self.assertTrue(np.array_equal(
+                filter_signal(row.reshape(1, -1), 10000, 70)[0],
+                filtered_row))
+        # same filter of the (b, a) form
+        b, a = signal.butter(2, 70/5000, btype='highpass')
+        self.assertTrue(np.allclose(signal.lfilter(b, a, self.data),
+                                    filtered))
+
+    def test_cached_design(self):
+        _filter_design.cache_clear()
+        filter_signals(self.data, 10000, 70)
+        filter_signals(self.data, 10000, 70)
+        filter_signals(self.data, 10000, (300, 3000), btype='bandpass')
+        # the cutoff can be any sequence
+        filter_signals(self.data, 10000, [300, 3000], btype='bandpass')
+        filter_signals_zero_phase(self.data, 10000, [300, 3000],
+                                  btype='bandpass')
+        info = _filter_design.cache_info()
+        self.assertEqual(info.misses, 2)
+        self.assertEqual(info.hits, 3)
+        self.assertFalse(filter_design(2, 70, 10000,
+                                       'highpass').flags.writeable)
+
+    def test_single_precision(self):
+        filtered = filter_signals(self.data, 10000, 70, dtype=np.float32)
+        self.assertEqual(filtered.dtype, np.float32)
+        self.assertTrue(np.allclose(filtered,
+                                    filter_signals(self.data, 10000, 70),
+                                    atol=1e-4))
+
+    def test_streaming_filter(self):
+        whole = filter_signals(self.data, 10000, 70)
+        streaming_filter = StreamingFilter(10000, 70)
+        bounds = [0, 1, 100, 2500, 2501, 7000, 10000]
+        chunks = [streaming_filter.process(self.data[:, a:b])
+                  for a, b in zip(bounds[:-1], bounds[1:])]
+        self.assertTrue(np.array_equal(np.concatenate(chunks, axis=1), whole))
+
+        streaming_filter = StreamingFilter(10000, 70)
+        chunks = [streaming_filter.process(self.data[0, a:a + 333])
+                  for a in range(0, 10000, 333)]
+        self.assertTrue(np.array_equal(np.concatenate(chunks), whole[0]))
+
+        streaming_filter.reset()
+        self.assertTrue(np.array_equal(
+            streaming_filter.process(self.data[0]), whole[0]))
+
+    def test_zero_phase_filter(self):
+        # the shared design is read-only, sosfilt needs a writable one
+        sos = filter_design(2, 70, 10000, 'highpass').copy()
+        filtered = filter_signals_zero_phase(self.data, 10000, 70,
+                                             block_size=1000, workers=2)
+        # forward-backward filtering of the zero padded signals
+        padded = np.pad(self.data, ((0, 0), (5000, 5000)))
+        expected = signal.sosfilt(
+            sos, signal.sosfilt(sos, padded)[:, ::-1])[:, ::-1][:, 5000:-5000]
+        self.assertTrue(np.allclose(filtered, expected, atol=1e-8))
+        # far from the edges it's the same of sosfiltfilt
+        self.assertTrue(np.allclose(
+            filtered[:, 2000:-2000],
+            signal.sosfiltfilt(sos, self.data)[:, 2000:-2000], atol=1e-8))
+        self.assertTrue(np.array_equal(
+            filter_signals_zero_phase(self.data[1], 10000, 70,
+                                      block_size=1000),
+            filtered[1]))
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=1)
@@ -17,8 +17,7 @@ def test_sd():
     # filter it
     filtered_data = filter_signal(sd_data_el, 10e3, 70)
     # spike detection
-    sd_ts = spike_detection(filtered_data)[1]
-    sd_ts = sd_ts[np.where(sd_ts != 0)]
+    sd_ts = spike_detection(filtered_data).indices
 
     # load spike detection mc
     mc_sd_path = Path('E:/unige/PyCode/tests/experimenter_test/raw.h5')
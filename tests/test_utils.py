@@ -0,0 +1,44 @@
+"""Tests of the utility functions."""
+import unittest
+
+import numpy as np
+
+from pycode.utils import IntervalSet, intervals_boundaries
+
+
+class TestIntervalSet(unittest.TestCase):
+    """Test the sorted intervals structure."""
+
+    def test_normalization(self):
+        intervals = IntervalSet([5, 0, 2, 10, 11], [6, 3, 4, 12, 11.5])
+        self.assertEqual(intervals.to_list(), [(0, 4), (5, 6), (10, 12)])
+        self.assertEqual(len(IntervalSet([], [])), 0)
+        self.assertRaises(AssertionError, IntervalSet, [1], [0])
+
+    def test_set_operations(self):
+        a = IntervalSet.from_pairs([(0, 4), (5, 6), (10, 12)])
+        b = IntervalSet.from_pairs([(1, 2.5), (3.5, 5.5), (11, 20)])
+        expected = [(1, 2.5), (3.5, 4), (5, 5.5), (11, 12)]
+        self.assertEqual(a.intersection(b).to_list(), expected)
+        self.assertEqual(b.intersection(a).to_list(), expected)
+        self.assertEqual(a.intersection(IntervalSet([], [])).to_list(), [])
+        self.assertEqual(a.union(b).to_list(), [(0, 6), (10, 20)])
+
+    def test_membership(self):
+        intervals = IntervalSet.from_pairs([(0, 4), (5, 6)])
+        values = np.array([-1, 0, 4, 4.5, 5, 6, 7])
+        self.assertEqual(intervals.position(values).tolist(),
+                         [-1, 0, 0, -1, 1, 1, -1])
+        self.assertEqual(intervals.contains(values).tolist(),
+                         [False, True, True, False, True, True, False])
+
+    def test_boundaries(self):
+        # the signal starts and ends during an interval
+        data = np.array([[1], [1], [0], [0], [1], [1], [0], [1]])
+        self.assertEqual(intervals_boundaries(data), [(0, 2), (4, 6), (7, 8)])
+        self.assertEqual(intervals_boundaries(data, 2)[0], (0, 1))
+        self.assertEqual(intervals_boundaries(np.zeros((5, 1))), [])
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=1)
@@ -19,6 +19,7 @@ from PySide6.QtWidgets import (QApplication, QCheckBox,
                                QVBoxLayout, QWidget)
 
 from pycode.hdf5 import H5Content
+from pycode.index import phase_record
 from pycode.io import load_phase_from_hdf5
 from pycode.operation import rasterplot_phase
 
@@ -26,6 +27,9 @@ from pycode.operation import rasterplot_phase
 ROOT = None
 CURRENT_PATH = Optional[Path]
 STORED_H5: Dict[Path, H5Content] = {}
+# maximum number of H5Content kept in STORED_H5, the least recently used one
+# is closed when a new file is opened
+MAX_STORED_H5 = 16
 MODEL = QStandardItemModel()
 SIGNAL_INDEXES: Optional[Tuple[int, int]] = None
 
@@ -43,8 +47,8 @@ PLAYER.errorOccurred.connect(lambda _: print(PLAYER.errorString()))
 
 
 def plot_signal(path: Path, indexes: Tuple[int, int]):
-    content = H5Content(path)
-    plt.plot(content.analogs[indexes[0]].parse_signal(indexes[1]))
+    with H5Content(path) as content:
+        plt.plot(content.analogs[indexes[0]].parse_signal(indexes[1]))
     plt.show()
 
 
@@ -68,10 +72,12 @@ def rasterplot(path: Path):
 
 class FileTree(QWidget):
     class InfoH5:
-        def __init__(self, name, size, date):
+        def __init__(self, name, size, date, record=None):
             self.name = name
             self.size = size
             self.date = date
+            # the PhaseRecord of the file, from the nearest index if any
+            self.record = record
 
     def __init__(self, *kargs, **kwargs):
         super().__init__(*kargs, **kwargs)
@@ -104,10 +110,11 @@ class FileTree(QWidget):
                     ROOT.viewer.toggle_tree(False)
                 else:
                     file = CURRENT_PATH
+                    record = phase_record(file)
                     info_h5 = self.InfoH5(
                         file.name, f'{"%.2f" % (getsize(file) / 1024 / 1024)}'
                         ' MB', datetime.fromtimestamp(getctime(file))
-                        .strftime('%Y-%m-%d %H:%M:%S'))
+                        .strftime('%Y-%m-%d %H:%M:%S'), record)
                     ROOT.controls.enable_controls_phase(True)
                     ROOT.viewer.set_h5_info(info_h5=info_h5)
                 ROOT.controls.enable_controls_signal(False, False)
@@ -189,6 +196,15 @@ File name:      {info_h5.name}
 File size:      {info_h5.size}
 Creation date:  {info_h5.date}
                 '''
+                record = info_h5.record
+                if record is not None and record.error is None:
+                    content += f'''
+DIV:            {record.div}
+Type:           {record.phase_type}
+Channels:       {record.channels}
+Durate:         {record.durate} s
+Spikes:         {record.spikes}
+                    '''
                 self.info.setText(content)
 
     def get_h5_content(self, file_path: Path):
@@ -207,10 +223,13 @@ Creation date:  {info_h5.date}
     def populate_tree(self, file_path: Path):
         content = None
         if STORED_H5.get(file_path) is not None:
-            content = STORED_H5[file_path]
+            # moved at the end, as the most recently used
+            content = STORED_H5.pop(file_path)
         else:
+            while len(STORED_H5) >= MAX_STORED_H5:
+                STORED_H5.pop(next(iter(STORED_H5))).close()
             content = H5Content(file_path)
-            STORED_H5[file_path] = content
+        STORED_H5[file_path] = content
 
         MODEL.clear()
         MODEL.setHorizontalHeaderItem(0, QStandardItem("Data"))
@@ -18,6 +18,7 @@ import matplotlib.pyplot as plt
 
 from pycode.experiment import PhaseInfo
 from pycode.hdf5 import H5Content
+from pycode.index import phase_record
 from pycode.io import load_phase_from_hdf5
 from pycode.operation import rasterplot_phase
 
@@ -29,6 +30,7 @@ TAREA_INFO_PHASE = 1
 GLOBALS = {
     'curdir': Path(curdir).absolute(),
     'curfile': None,
+    'curcontent': None,
     'intro_shown': False,
     'tarea_state': TAREA_LIST_H5,
 }
@@ -39,6 +41,11 @@ GLOBALS = {
 
 
 def load_phase_info(file_path: Path) -> PhaseInfo:
+    # the metadata come from the nearest index among the parent directories,
+    # the file is opened only if it's not indexed yet or if it changed
+    record = phase_record(file_path)
+    if record is not None and record.error is None:
+        return record.phase_info()
     phase = load_phase_from_hdf5(file_path)
     return phase.phase_info()
 
@@ -107,8 +114,12 @@ class HDF5DirectoryTree(DirectoryTree):
                 file.visit(
                     lambda x: add_text(x))
                 self.screen.get_widget_by_id('tarea').remove_children()
+                # the file of the previous tree is given back to the pool
+                if GLOBALS['curcontent'] is not None:
+                    GLOBALS['curcontent'].close()
+                GLOBALS['curcontent'] = H5Content(message.path)
                 self.screen.get_widget_by_id('tarea').mount(
-                    PhaseTree(H5Content(message.path)))
+                    PhaseTree(GLOBALS['curcontent']))
 
 #                self.screen.get_widget_by_id('tarea').mount(TextArea(text))
 